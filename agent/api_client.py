@@ -6,10 +6,15 @@ import json
 from typing import Dict, Any, Optional, List
 from datetime import datetime
 import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Désactiver les warnings SSL pour le MVP (certificat self-signed)
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# backoff_jitter n'existe qu'à partir d'urllib3 2 (botocore impose encore 1.26 sous Python < 3.10)
+RETRY_JITTER = {'backoff_jitter': 1} if int(urllib3.__version__.split('.')[0]) >= 2 else {}
+
 class SaveOSAPIClient:
     """Client pour interagir avec l'API SaveOS"""
     
@@ -18,6 +23,13 @@ class SaveOSAPIClient:
         self.token = token
         self.verify_ssl = verify_ssl
         self.session = requests.Session()
+        # Nouvelles tentatives espacées et aléatoires sur les requêtes idempotentes quand l'API
+        # redémarre (les POST ne sont pas rejoués: le daemon passe par agent.runtime)
+        retry = Retry(total=3, backoff_factor=1, status_forcelist=[502, 503, 504],
+                      raise_on_status=False, **RETRY_JITTER)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         
         if self.token:
             self.session.headers.update({
@@ -116,6 +128,184 @@ class SaveOSAPIClient:
         except Exception as e:
             return {"success": False, "error": str(e)}
     
+    def create_restore_job(self, agent_id: int, snapshot_id: int, paths: List[str] = None,
+                           mode: str = "target", target_dir: Optional[str] = None,
+                           parallelism: int = 4) -> Dict[str, Any]:
+        """Crée un job de restauration"""
+        if not self.token:
+            return {"success": False, "error": "Token d'authentification requis"}
+        
+        data = {
+            "agent_id": agent_id,
+            "snapshot_id": snapshot_id,
+            "paths": paths or [],
+            "mode": mode,
+            "target_dir": target_dir,
+            "parallelism": parallelism
+        }
+        
+        try:
+            response = self.session.post(
+                f"{self.api_url}/api/v1/restore",
+                json=data,
+                verify=self.verify_ssl,
+                timeout=30
+            )
+            
+            if response.status_code == 200:
+                return {"success": True, "data": response.json()}
+            else:
+                return {
+                    "success": False,
+                    "error": f"HTTP {response.status_code}: {response.text}"
+                }
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    def list_restore_parts(self, job_id: int) -> Dict[str, Any]:
+        """Liste les archives préparées d'une restauration agent_pull"""
+        if not self.token:
+            return {"success": False, "error": "Token d'authentification requis"}
+        
+        try:
+            response = self.session.get(
+                f"{self.api_url}/api/v1/jobs/{job_id}/restore/parts",
+                verify=self.verify_ssl,
+                timeout=30
+            )
+            
+            if response.status_code == 200:
+                return {"success": True, "data": response.json()}
+            else:
+                return {
+                    "success": False,
+                    "error": f"HTTP {response.status_code}: {response.text}"
+                }
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    def download_restore_part(self, job_id: int, index: int, dest_path: str) -> Dict[str, Any]:
+        """Télécharge une archive de restauration en streaming vers dest_path"""
+        if not self.token:
+            return {"success": False, "error": "Token d'authentification requis"}
+        
+        try:
+            with self.session.get(
+                f"{self.api_url}/api/v1/jobs/{job_id}/restore/parts/{index}",
+                verify=self.verify_ssl,
+                stream=True,
+                timeout=30
+            ) as response:
+                if response.status_code != 200:
+                    return {
+                        "success": False,
+                        "error": f"HTTP {response.status_code}: {response.text}"
+                    }
+                
+                with open(dest_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+                        f.write(chunk)
+            
+            return {"success": True, "data": {"path": dest_path}}
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    def list_agent_jobs(self, wait: int = 0) -> Dict[str, Any]:
+        """Liste les jobs en attente que l'agent doit exécuter lui-même
+        
+        Avec wait > 0, le serveur garde la requête ouverte jusqu'à `wait` secondes
+        et répond dès qu'un job est assigné à l'agent.
+        """
+        if not self.token:
+            return {"success": False, "error": "Token d'authentification requis"}
+        
+        try:
+            response = self.session.get(
+                f"{self.api_url}/api/v1/agents/me/jobs",
+                params={"wait": wait} if wait else None,
+                verify=self.verify_ssl,
+                timeout=30 + wait
+            )
+            
+            if response.status_code == 200:
+                return {"success": True, "data": response.json()}
+            else:
+                return {
+                    "success": False,
+                    "error": f"HTTP {response.status_code}: {response.text}"
+                }
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    def start_job(self, job_id: int) -> Dict[str, Any]:
+        """Démarre un job côté agent et récupère le repository cible"""
+        if not self.token:
+            return {"success": False, "error": "Token d'authentification requis"}
+        
+        try:
+            response = self.session.post(
+                f"{self.api_url}/api/v1/jobs/{job_id}/start",
+                verify=self.verify_ssl,
+                timeout=30
+            )
+            
+            if response.status_code == 200:
+                return {"success": True, "data": response.json()}
+            else:
+                return {
+                    "success": False,
+                    "error": f"HTTP {response.status_code}: {response.text}"
+                }
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    def job_heartbeat(self, job_id: int, progress: Optional[int] = None,
+                      log: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Prolonge le bail d'un job en cours (la réponse indique une annulation)"""
+        if not self.token:
+            return {"success": False, "error": "Token d'authentification requis"}
+        
+        try:
+            response = self.session.post(
+                f"{self.api_url}/api/v1/jobs/{job_id}/heartbeat",
+                json={"progress": progress, "log": log or []},
+                verify=self.verify_ssl,
+                timeout=30
+            )
+            
+            if response.status_code == 200:
+                return {"success": True, "data": response.json()}
+            else:
+                return {
+                    "success": False,
+                    "error": f"HTTP {response.status_code}: {response.text}"
+                }
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    def report_job(self, job_id: int, report: Dict[str, Any]) -> Dict[str, Any]:
+        """Envoie le compte rendu d'un job exécuté par l'agent"""
+        if not self.token:
+            return {"success": False, "error": "Token d'authentification requis"}
+        
+        try:
+            response = self.session.post(
+                f"{self.api_url}/api/v1/jobs/{job_id}/report",
+                json=report,
+                verify=self.verify_ssl,
+                timeout=30
+            )
+            
+            if response.status_code == 200:
+                return {"success": True, "data": response.json()}
+            else:
+                return {
+                    "success": False,
+                    "error": f"HTTP {response.status_code}: {response.text}"
+                }
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
     def get_job_status(self, job_id: int) -> Dict[str, Any]:
         """Récupère le statut d'un job"""
         if not self.token:
@@ -4,15 +4,25 @@ Agent CLI SaveOS - Interface en ligne de commande pour l'agent de sauvegarde
 """
 import click
 import json
+import asyncio
 import time
 import sys
+import shutil
+import tarfile
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
 from agent.config import AgentConfig
 from agent.api_client import SaveOSAPIClient
+from agent.runtime import AsyncAPIClient, AgentRuntime, memory_usage
+from agent.transport import Spool
+from agent.relay import RelayApp
+from agent.journal import ChangeJournal, InotifyWatcher, FULL_WALK_INTERVAL
+from agent.index import FileIndex
+from agent.exclusions import ExclusionSet
 
 @click.group()
 @click.option('--config-dir', help='Répertoire de configuration personnalisé')
@@ -54,8 +64,9 @@ def register(ctx, api_url):
         agent_data = result['data']
         token = agent_data['token']
         
-        # Sauvegarder le token
-        if config_manager.save_token(token):
+        # Sauvegarder le token (et l'ID de l'agent, requis par les commandes qui le désignent)
+        config['agent_id'] = agent_data['id']
+        if config_manager.save_token(token) and config_manager.save_config(config):
             click.echo(f"✅ Agent enregistré avec succès!")
             click.echo(f"   ID: {agent_data['id']}")
             click.echo(f"   Hostname: {agent_data['hostname']}")
@@ -108,8 +119,9 @@ def status(ctx):
 @cli.command()
 @click.option('--source-paths', help='Chemins à sauvegarder (séparés par des virgules)')
 @click.option('--wait', is_flag=True, help='Attendre la fin du job')
+@click.option('--on-agent', is_flag=True, help='Exécuter borg sur cette machine (via le daemon)')
 @click.pass_context
-def backup(ctx, source_paths, wait):
+def backup(ctx, source_paths, wait, on_agent):
     """Lance une sauvegarde"""
     config_manager = ctx.obj['config']
     config = config_manager.load_config()
@@ -119,17 +131,8 @@ def backup(ctx, source_paths, wait):
         click.echo("❌ Agent non enregistré. Utilisez 'register' d'abord.", err=True)
         sys.exit(1)
     
-    # Récupérer l'ID de l'agent depuis le token (pour simplifier, on fait un heartbeat)
     client = SaveOSAPIClient(config['api_url'], token, config['verify_ssl'])
-    
-    # Envoyer un heartbeat pour récupérer l'ID de l'agent
-    heartbeat_result = client.send_heartbeat()
-    if not heartbeat_result['success']:
-        click.echo(f"❌ Erreur lors du heartbeat: {heartbeat_result['error']}", err=True)
-        sys.exit(1)
-    
-    # Pour simplifier, on assume que l'agent_id est 1 (dans un vrai système, il faudrait le récupérer)
-    agent_id = 1  # TODO: Récupérer l'ID réel de l'agent
+    agent_id = _agent_id(config_manager, config, client)
     
     # Préparer la configuration du job
     job_config = {
@@ -137,6 +140,21 @@ def backup(ctx, source_paths, wait):
         'repo_path': config['repo_path'],
         'passphrase': config['passphrase']
     }
+    exclusions = _load_exclusions(config)
+    if exclusions:
+        job_config['exclude_patterns'] = exclusions.patterns
+    if on_agent or config.get('execution') == 'agent':
+        # Le serveur choisit l'emplacement du repository central
+        job_config['execution'] = 'agent'
+        del job_config['repo_path']
+    
+    if config.get('change_index'):
+        # Estimation pré-vol pour le contrôle de quota du serveur
+        estimate = FileIndex(config_manager.config_dir / "index").estimate(
+            job_config['source_paths'], exclusions=exclusions
+        )
+        job_config['estimated_bytes'] = estimate['changed_bytes']
+        click.echo(f"🔎 {estimate['changed']} fichier(s) modifié(s), {_format_bytes(estimate['changed_bytes'])} à sauvegarder")
     
     click.echo("🚀 Lancement de la sauvegarde...")
     click.echo(f"   Chemins: {', '.join(job_config['source_paths'])}")
@@ -156,6 +174,58 @@ def backup(ctx, source_paths, wait):
         click.echo(f"❌ Erreur lors de la création du job: {job_result['error']}", err=True)
         sys.exit(1)
 
+@cli.command()
+@click.argument('snapshot_id', type=int)
+@click.option('--path', 'paths', multiple=True, help='Chemin ou motif à restaurer (répétable, défaut: tout)')
+@click.option('--target-dir', help='Répertoire de destination (avec --pull), sinon relatif à la racine des restaurations du serveur')
+@click.option('--pull', is_flag=True, help='Télécharger les fichiers sur cette machine')
+@click.option('--parallelism', default=4, help='Nombre de flux de restauration parallèles')
+@click.pass_context
+def restore(ctx, snapshot_id, paths, target_dir, pull, parallelism):
+    """Restaure tout ou partie d'un snapshot"""
+    config_manager = ctx.obj['config']
+    config = config_manager.load_config()
+    token = config_manager.get_token()
+    
+    if not token:
+        click.echo("❌ Agent non enregistré. Utilisez 'register' d'abord.", err=True)
+        sys.exit(1)
+    
+    if not pull and not target_dir:
+        click.echo("❌ --target-dir est requis sans --pull", err=True)
+        sys.exit(1)
+    
+    client = SaveOSAPIClient(config['api_url'], token, config['verify_ssl'])
+    agent_id = _agent_id(config_manager, config, client)
+    
+    click.echo(f"🚀 Lancement de la restauration du snapshot {snapshot_id}...")
+    job_result = client.create_restore_job(
+        agent_id,
+        snapshot_id,
+        paths=list(paths),
+        mode="agent_pull" if pull else "target",
+        target_dir=None if pull else target_dir,
+        parallelism=parallelism
+    )
+    
+    if not job_result['success']:
+        click.echo(f"❌ Erreur lors de la création du job: {job_result['error']}", err=True)
+        sys.exit(1)
+    
+    job_id = job_result['data']['id']
+    click.echo(f"✅ Job de restauration créé (ID: {job_id})")
+    
+    if pull:
+        job_data = _wait_for_job_completion(client, job_id, timeout=12 * 3600, label="Restauration")
+        if not job_data or job_data['status'] != 'completed':
+            sys.exit(1)
+        
+        destination = target_dir or str(Path.cwd())
+        if _pull_restore(client, job_id, destination, parallelism):
+            click.echo(f"📂 Fichiers restaurés dans {destination}")
+        else:
+            sys.exit(1)
+
 @cli.command()
 @click.pass_context
 def snapshots(ctx):
@@ -169,9 +239,7 @@ def snapshots(ctx):
         sys.exit(1)
     
     client = SaveOSAPIClient(config['api_url'], token, config['verify_ssl'])
-    
-    # Pour simplifier, on assume que l'agent_id est 1
-    agent_id = 1  # TODO: Récupérer l'ID réel de l'agent
+    agent_id = _agent_id(config_manager, config, client)
     
     snapshots_result = client.list_snapshots(agent_id)
     
@@ -185,6 +253,8 @@ def snapshots(ctx):
                 click.echo(f"     Taille: {_format_bytes(snapshot['size_bytes'])}")
                 click.echo(f"     Créé le: {created_at.strftime('%Y-%m-%d %H:%M:%S')}")
                 click.echo(f"     Type: {'Full' if snapshot['is_full'] else 'Incrémental'}")
+                if snapshot.get('excluded_bytes'):
+                    click.echo(f"     Exclu: {_format_bytes(snapshot['excluded_bytes'])}")
                 click.echo()
         else:
             click.echo("📭 Aucun snapshot trouvé")
@@ -195,7 +265,95 @@ def snapshots(ctx):
 @click.option('--interval', default=300, help='Intervalle en secondes entre les heartbeats')
 @click.pass_context
 def daemon(ctx, interval):
-    """Lance l'agent en mode daemon avec heartbeats réguliers"""
+    """Lance l'agent en mode daemon: heartbeats réguliers et exécution des jobs assignés"""
+    runtime = _build_runtime(ctx, interval)
+    config_manager = ctx.obj['config']
+    config = config_manager.load_config()
+    
+    watcher = None
+    if config.get('change_journal'):
+        journal = ChangeJournal(config_manager.config_dir / "journal")
+        watcher = InotifyWatcher(config['source_paths'], journal)
+        try:
+            watcher.start()
+            runtime.journal = journal
+            runtime.full_walk_interval = config.get('full_walk_interval', FULL_WALK_INTERVAL)
+            click.echo(f"📝 Journal des modifications actif ({len(watcher.watches)} répertoires suivis)")
+        except OSError as e:
+            click.echo(f"⚠️  Journal des modifications indisponible: {e}", err=True)
+            watcher = None
+    if not runtime.journal and config.get('change_index'):
+        runtime.index = FileIndex(config_manager.config_dir / "index")
+        runtime.full_walk_interval = config.get('full_walk_interval', FULL_WALK_INTERVAL)
+        click.echo("🔎 Index local des fichiers actif")
+    
+    click.echo(f"🔄 Démarrage du daemon (heartbeat toutes les {interval}s, "
+               f"{'HTTP/2' if runtime.client.http2 else 'HTTP/1.1'})")
+    click.echo("   Appuyez sur Ctrl+C pour arrêter")
+    
+    try:
+        asyncio.run(runtime.run())
+    except KeyboardInterrupt:
+        click.echo("\n🛑 Arrêt du daemon")
+    finally:
+        if watcher:
+            watcher.stop()
+
+@cli.command()
+@click.option('--duration', default=300, help='Durée de la mesure en secondes')
+@click.option('--interval', default=300, help='Intervalle en secondes entre les heartbeats')
+@click.pass_context
+def benchmark(ctx, duration, interval):
+    """Fait tourner le daemon pendant une durée donnée et mesure sa mémoire et ses requêtes"""
+    runtime = _build_runtime(ctx, interval, echo=lambda message: None)
+    
+    click.echo(f"⏱️  Mesure du daemon pendant {duration}s...")
+    started = time.monotonic()
+    try:
+        asyncio.run(runtime.run(duration=duration))
+    except KeyboardInterrupt:
+        pass
+    elapsed = max(time.monotonic() - started, 1e-3)
+    
+    memory = memory_usage()
+    requests = runtime.client.requests
+    per_hour = 3600 / elapsed
+    
+    click.echo("📈 Résultats:")
+    click.echo(f"   Transport: {'HTTP/2' if runtime.client.http2 else 'HTTP/1.1'}")
+    click.echo(f"   Durée: {elapsed:.0f}s, jobs exécutés: {runtime.jobs_run}")
+    if memory['rss'] is not None:
+        click.echo(f"   RSS: {_format_bytes(memory['rss'])}")
+    if memory['peak_rss'] is not None:
+        click.echo(f"   RSS maximal: {_format_bytes(memory['peak_rss'])}")
+    click.echo(f"   Requêtes/heure: {sum(requests.values()) * per_hour:.0f}")
+    for name, count in sorted(requests.items()):
+        click.echo(f"     {name}: {count * per_hour:.0f}")
+
+@cli.command()
+@click.option('--listen', default='0.0.0.0:8080', help='Adresse d\'écoute (hôte:port) pour les agents du site')
+@click.option('--upstream', help='URL de l\'API SaveOS (api_url de la configuration par défaut)')
+@click.option('--relay-token', envvar='SAVEOS_RELAY_TOKEN', required=True, help='Jeton du relais (RELAY_TOKENS côté API)')
+@click.option('--flush-interval', default=30, help='Intervalle en secondes entre deux envois de heartbeats')
+@click.pass_context
+def relay(ctx, listen, upstream, relay_token, flush_interval):
+    """Relaie les agents d'un site: heartbeats regroupés en lots, autres requêtes transmises"""
+    try:
+        import uvicorn
+    except ImportError:
+        click.echo("❌ Le mode relais nécessite uvicorn (pip install uvicorn)", err=True)
+        sys.exit(1)
+    
+    config = ctx.obj['config'].load_config()
+    host, _, port = listen.rpartition(':')
+    app = RelayApp(upstream or config['api_url'], relay_token, flush_interval=flush_interval,
+                   verify_ssl=config['verify_ssl'], echo=click.echo)
+    
+    click.echo(f"🔀 Relais en écoute sur {listen} vers {upstream or config['api_url']}")
+    uvicorn.run(app, host=host or '0.0.0.0', port=int(port), log_level='warning')
+
+def _build_runtime(ctx, interval: int, echo=click.echo):
+    """Configuration et runtime asyncio du daemon"""
     config_manager = ctx.obj['config']
     config = config_manager.load_config()
     token = config_manager.get_token()
@@ -204,23 +362,46 @@ def daemon(ctx, interval):
         click.echo("❌ Agent non enregistré. Utilisez 'register' d'abord.", err=True)
         sys.exit(1)
     
-    client = SaveOSAPIClient(config['api_url'], token, config['verify_ssl'])
-    
-    click.echo(f"🔄 Démarrage du daemon (heartbeat toutes les {interval}s)")
-    click.echo("   Appuyez sur Ctrl+C pour arrêter")
+    client = AsyncAPIClient(
+        config['api_url'], token, config['verify_ssl'],
+        pool_size=config.get('http_pool_size', 4),
+        retry_attempts=config.get('retry_attempts', 4)
+    )
+    runtime = AgentRuntime(
+        client,
+        ssh_key=config.get('ssh_key'),
+        heartbeat_interval=interval,
+        poll_wait=config.get('job_poll_interval', 60),
+        echo=echo,
+        spool=Spool(config_manager.config_dir / "spool"),
+        exclusions=_load_exclusions(config)
+    )
+    return runtime
+
+def _agent_id(config_manager, config: dict, client: SaveOSAPIClient) -> int:
+    """ID de l'agent: enregistré par 'register', sinon renvoyé par un heartbeat puis mémorisé"""
+    if config.get('agent_id'):
+        return config['agent_id']
     
+    heartbeat_result = client.send_heartbeat()
+    if not heartbeat_result['success']:
+        click.echo(f"❌ Erreur lors du heartbeat: {heartbeat_result['error']}", err=True)
+        sys.exit(1)
+    agent_id = heartbeat_result['data'].get('agent_id')
+    if not agent_id:
+        click.echo("❌ ID de l'agent inconnu. Utilisez 'register' à nouveau.", err=True)
+        sys.exit(1)
+    config['agent_id'] = agent_id
+    config_manager.save_config(config)
+    return agent_id
+
+def _load_exclusions(config: dict) -> ExclusionSet:
+    """Profils et motifs d'exclusion de la configuration"""
     try:
-        while True:
-            heartbeat_result = client.send_heartbeat("active")
-            if heartbeat_result['success']:
-                timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                click.echo(f"💓 Heartbeat envoyé à {timestamp}")
-            else:
-                click.echo(f"❌ Erreur heartbeat: {heartbeat_result['error']}", err=True)
-            
-            time.sleep(interval)
-    except KeyboardInterrupt:
-        click.echo("\n🛑 Arrêt du daemon")
+        return ExclusionSet.from_config(config)
+    except ValueError as e:
+        click.echo(f"❌ {e}", err=True)
+        sys.exit(1)
 
 @cli.command()
 @click.pass_context
@@ -237,6 +418,8 @@ def config_show(ctx):
     click.echo(f"   Chemins sources: {', '.join(config['source_paths'])}")
     click.echo(f"   Repository: {config['repo_path']}")
     click.echo(f"   Heartbeat: {config['heartbeat_interval']}s")
+    click.echo(f"   Exclusions: {', '.join(config.get('exclude_profiles') or []) or 'aucun profil'}"
+               f" + {len(config.get('exclude_patterns') or [])} motif(s)")
     click.echo(f"   Vérification SSL: {config['verify_ssl']}")
     
     token = config_manager.get_token()
@@ -253,8 +436,9 @@ def _format_bytes(bytes_count: int) -> str:
         bytes_count /= 1024.0
     return f"{bytes_count:.1f} PB"
 
-def _wait_for_job_completion(client: SaveOSAPIClient, job_id: int, timeout: int = 3600):
-    """Attend la fin d'un job avec timeout"""
+def _wait_for_job_completion(client: SaveOSAPIClient, job_id: int, timeout: int = 3600,
+                             label: str = "Sauvegarde") -> Optional[Dict[str, Any]]:
+    """Attend la fin d'un job avec timeout et retourne son état final"""
     start_time = time.time()
     
     while time.time() - start_time < timeout:
@@ -265,24 +449,64 @@ def _wait_for_job_completion(client: SaveOSAPIClient, job_id: int, timeout: int
             status = job_data['status']
             
             if status == 'completed':
-                click.echo("✅ Sauvegarde terminée avec succès!")
+                click.echo(f"✅ {label} terminée avec succès!")
                 if job_data.get('snapshot_id'):
                     click.echo(f"   Snapshot ID: {job_data['snapshot_id']}")
-                return
+                return job_data
             elif status == 'failed':
-                click.echo("❌ Sauvegarde échouée!")
+                click.echo(f"❌ {label} échouée!")
                 if job_data.get('error_message'):
                     click.echo(f"   Erreur: {job_data['error_message']}")
-                return
+                return job_data
             elif status == 'running':
-                click.echo("⏳ Sauvegarde en cours...")
+                progress = job_data.get('progress')
+                suffix = f" ({progress}%)" if progress else ""
+                click.echo(f"⏳ {label} en cours...{suffix}")
         else:
             click.echo(f"❌ Erreur lors de la vérification du job: {job_result['error']}")
-            return
+            return None
         
         time.sleep(10)  # Vérifier toutes les 10 secondes
     
     click.echo("⏰ Timeout atteint lors de l'attente du job")
+    return None
+
+def _pull_restore(client: SaveOSAPIClient, job_id: int, target_dir: str, parallelism: int) -> bool:
+    """Télécharge en parallèle les archives d'une restauration et les extrait dans target_dir"""
+    parts_result = client.list_restore_parts(job_id)
+    if not parts_result['success']:
+        click.echo(f"❌ Erreur lors de la récupération des archives: {parts_result['error']}", err=True)
+        return False
+    
+    parts = parts_result['data']['parts']
+    staging = Path(target_dir) / f".saveos-restore-{job_id}"
+    staging.mkdir(parents=True, exist_ok=True)
+    
+    try:
+        click.echo(f"📥 Téléchargement de {len(parts)} archive(s) en parallèle...")
+        with ThreadPoolExecutor(max_workers=max(parallelism, 1)) as executor:
+            downloads = list(executor.map(
+                lambda part: client.download_restore_part(
+                    job_id, part['index'], str(staging / f"part-{part['index']}.tar")
+                ),
+                parts
+            ))
+        
+        failed = [d['error'] for d in downloads if not d['success']]
+        if failed:
+            click.echo(f"❌ Erreur lors du téléchargement: {failed[0]}", err=True)
+            return False
+        
+        for download in downloads:
+            with tarfile.open(download['data']['path']) as tf:
+                if hasattr(tarfile, 'data_filter'):
+                    tf.extractall(target_dir, filter='data')
+                else:
+                    tf.extractall(target_dir)
+        
+        return True
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
 
 if __name__ == '__main__':
     cli()
\ No newline at end of file
@@ -7,6 +7,8 @@ import platform
 from pathlib import Path
 from typing import Dict, Any, Optional
 
+from agent.exclusions import DEFAULT_PROFILES
+
 class AgentConfig:
     """Gestionnaire de configuration de l'agent"""
     
@@ -31,12 +33,23 @@ class AgentConfig:
         # Configuration par défaut
         self.default_config = {
             "api_url": "https://localhost:8000",
+            "agent_id": None,  # Renseigné par 'register'
             "hostname": platform.node(),
             "platform": platform.system().lower(),
             "source_paths": self._get_default_source_paths(),
             "repo_path": str(self.config_dir / "borg_repo"),
             "passphrase": "changeme_default_passphrase",
             "heartbeat_interval": 300,  # 5 minutes
+            "execution": "server",  # "agent": borg tourne sur cette machine et pousse vers le repository central
+            "ssh_key": None,  # Clé SSH pour borg serve (exécution par l'agent)
+            "job_poll_interval": 60,  # Attente maximale (long-poll) des jobs à exécuter par le daemon
+            "http_pool_size": 4,  # Connexions simultanées vers l'API
+            "retry_attempts": 4,  # Tentatives par requête avant mise en file locale
+            "change_journal": False,  # Suivi inotify des source_paths: pas d'archive sans modification (Linux)
+            "change_index": False,  # Index local des fichiers (sans journal): estimation, pas d'archive sans modification
+            "full_walk_interval": 7 * 24 * 3600,  # Parcours complet de sécurité (secondes)
+            "exclude_profiles": list(DEFAULT_PROFILES),  # caches, dev, browsers, system, trash (agent/exclusions.py)
+            "exclude_patterns": [],  # Motifs sh: de borg propres à la machine (ex: "**/*.iso")
             "verify_ssl": False,  # Pour le MVP avec certificat self-signed
             "backup_schedule": "0 2 * * *",  # Tous les jours à 2h du matin
         }
@@ -0,0 +1,125 @@
+"""
+Exclusions des sauvegardes: profils intégrés (caches, dépendances, fichiers système) et motifs utilisateur
+
+Les motifs suivent la syntaxe `sh:` de borg (`*`, `?`, `[...]`, `**/`) et visent un
+chemin et tout ce qu'il contient. Ils sont compilés une fois en une seule expression
+régulière, utilisée par l'agent (parcours de l'index, journal des modifications, mesure
+des octets exclus), et transmis tels quels à borg (--pattern '! sh:...': les
+répertoires exclus ne sont pas parcourus).
+"""
+import os
+import re
+import platform
+from typing import Dict, Any, List, Optional, Iterable
+
+from agent.index import walk
+
+# Motifs par profil: communs ('all') puis propres à une plateforme (platform.system().lower())
+PROFILES: Dict[str, Dict[str, List[str]]] = {
+    'caches': {
+        'all': ['**/.cache', '**/.npm/_cacache', '**/.gradle/caches', '**/.m2/repository'],
+        'darwin': ['**/Library/Caches'],
+        'windows': ['**/AppData/Local/Temp', '**/AppData/Local/Microsoft/Windows/INetCache'],
+    },
+    'dev': {
+        'all': ['**/node_modules', '**/__pycache__', '**/*.pyc', '**/.venv', '**/.tox',
+                '**/.pytest_cache', '**/.mypy_cache', '**/.next/cache'],
+    },
+    'browsers': {
+        'linux': ['**/.mozilla/firefox/*/cache2', '**/.config/google-chrome/*/Cache',
+                  '**/.config/chromium/*/Cache'],
+        'darwin': ['**/Library/Application Support/Google/Chrome/*/Service Worker/CacheStorage'],
+        'windows': ['**/AppData/Local/Google/Chrome/User Data/*/Cache',
+                    '**/AppData/Local/Microsoft/Edge/User Data/*/Cache',
+                    '**/AppData/Local/Mozilla/Firefox/Profiles/*/cache2'],
+    },
+    'system': {
+        'all': ['**/*.vmem', '**/*.vswp'],
+        'windows': ['**/pagefile.sys', '**/hiberfil.sys', '**/swapfile.sys'],
+        'darwin': ['**/.Spotlight-V100', '**/.fseventsd'],
+    },
+    'trash': {
+        'all': ['**/.DS_Store', '**/Thumbs.db', '**/*.swp'],
+        'linux': ['**/.local/share/Trash', '**/.Trash-*'],
+        'darwin': ['**/.Trash'],
+        'windows': ['**/$RECYCLE.BIN'],
+    },
+}
+DEFAULT_PROFILES = ['caches', 'dev', 'browsers', 'system', 'trash']
+
+def profile_patterns(profiles: Iterable[str], system: Optional[str] = None) -> List[str]:
+    """Motifs des profils demandés pour une plateforme (celle de la machine par défaut)"""
+    system = (system or platform.system()).lower()
+    patterns = []
+    for name in profiles:
+        if name not in PROFILES:
+            raise ValueError(f"Profil d'exclusion inconnu: {name}")
+        patterns += PROFILES[name].get('all', []) + PROFILES[name].get(system, [])
+    return patterns
+
+def translate(pattern: str) -> str:
+    """Expression régulière équivalente à un motif sh: de borg (chemin sans '/' initial)"""
+    pattern = pattern.replace('\\', '/').lstrip('/')
+    regex, i = [], 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex.append('(?:[^/]*/)*')
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+            continue
+        char = pattern[i]
+        end = pattern.find(']', i + 2) if char == '[' else -1
+        if char == '*':
+            regex.append('[^/]*')
+        elif char == '?':
+            regex.append('[^/]')
+        elif end != -1:
+            body = pattern[i + 1:end]
+            negate = body[:1] == '!'
+            body = body[1:] if negate else body
+            regex.append(f"[{'^' if negate else ''}{body}]")
+            i = end
+        else:
+            regex.append(re.escape(char))
+        i += 1
+    # Le chemin lui-même et tout ce qu'il contient
+    return ''.join(regex) + r'(?:/.*)?\Z'
+
+def borg_args(patterns: Iterable[str]) -> List[str]:
+    """Arguments de `borg create`: exclusions sans parcours des répertoires exclus"""
+    args = []
+    for pattern in patterns:
+        args += ['--pattern', f'! sh:{pattern}']
+    return args
+
+class ExclusionSet:
+    """Motifs d'exclusion compilés en une seule expression régulière"""
+
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns = list(dict.fromkeys(pattern for pattern in patterns if pattern))
+        self._regex = None
+        if self.patterns:
+            self._regex = re.compile('|'.join(f'(?:{translate(pattern)})' for pattern in self.patterns), re.DOTALL)
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any], system: Optional[str] = None) -> 'ExclusionSet':
+        profiles = config.get('exclude_profiles', DEFAULT_PROFILES) or []
+        return cls(profile_patterns(profiles, system or config.get('platform')) + list(config.get('exclude_patterns') or []))
+
+    def __bool__(self) -> bool:
+        return bool(self.patterns)
+
+    def excluded(self, path: str) -> bool:
+        if self._regex is None:
+            return False
+        return self._regex.match(path.replace(os.sep, '/').lstrip('/')) is not None
+
+    def measure(self, roots: List[str]) -> Dict[str, int]:
+        """Octets et fichiers exclus sous les racines (parcours complet)"""
+        excluded = {'bytes': 0, 'files': 0}
+        for _ in walk(roots, exclusions=self, excluded=excluded):
+            pass
+        return {'excluded_bytes': excluded['bytes'], 'excluded_files': excluded['files']}
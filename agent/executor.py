@@ -0,0 +1,187 @@
+"""
+Exécution locale des sauvegardes demandées par le serveur SaveOS
+
+borg tourne sur la machine de l'agent et écrit directement dans le repository central
+(borg serve via SSH): chunking, compression et chiffrement se font ici, le serveur ne
+fait que coordonner. Le bail du job est prolongé pendant la sauvegarde; une annulation
+signalée par le serveur arrête borg sur un checkpoint.
+"""
+import os
+import json
+import signal
+import subprocess
+import threading
+from typing import Dict, Any, List, Optional, Callable
+
+from agent.api_client import SaveOSAPIClient
+from agent.exclusions import borg_args
+
+# Délai laissé à borg entre SIGINT (checkpoint) et SIGKILL
+CANCEL_GRACE = 30
+
+def parse_create_stats(stdout: str) -> Dict[str, Any]:
+    """Statistiques de `borg create --json`, au format attendu par le serveur"""
+    try:
+        archive = json.loads(stdout).get('archive', {})
+    except ValueError:
+        return {}
+    stats = archive.get('stats', {})
+    return {
+        'original_size': stats.get('original_size', 0),
+        'compressed_size': stats.get('compressed_size', 0),
+        'deduplicated_size': stats.get('deduplicated_size', 0),
+        'nfiles': stats.get('nfiles', 0),
+        'duration': archive.get('duration', 0)
+    }
+
+class BackupExecutor:
+    """Exécute un job de sauvegarde reçu du serveur avec le borg local"""
+
+    def __init__(self, client: SaveOSAPIClient, ssh_key: Optional[str] = None,
+                 on_log: Optional[Callable[[str], None]] = None):
+        self.client = client
+        self.ssh_key = ssh_key
+        # Reçoit chaque ligne de journal de borg create au fil de l'eau
+        self.on_log = on_log
+
+    def _env(self, spec: Dict[str, Any]) -> Dict[str, str]:
+        env = {
+            **os.environ,
+            'BORG_PASSPHRASE': spec['passphrase'],
+            'BORG_UNKNOWN_UNENCRYPTED_REPO_ACCESS_IS_OK': 'yes',
+            'BORG_RELOCATED_REPO_ACCESS_IS_OK': 'yes'
+        }
+        if self.ssh_key:
+            env['BORG_RSH'] = f"ssh -i {self.ssh_key} -o BatchMode=yes"
+        return env
+
+    def _borg(self, args: List[str], env: Dict[str, str]) -> subprocess.CompletedProcess:
+        return subprocess.run(['borg'] + args, env=env, capture_output=True, text=True, check=False)
+
+    def _archive_names(self, repository: str, env: Dict[str, str]) -> Optional[List[str]]:
+        """Noms des archives du repository, None s'il est inaccessible"""
+        listing = self._borg(['list', '--json', repository], env)
+        if listing.returncode != 0:
+            return None
+        return [a.get('name', a.get('archive')) for a in json.loads(listing.stdout).get('archives', [])]
+
+    def _prepare(self, spec: Dict[str, Any], env: Dict[str, str]) -> Dict[str, Any]:
+        """Crée le repository au besoin et met de côté le checkpoint d'une tentative interrompue"""
+        repository = spec['repository']
+        archive_name = spec['archive_name']
+
+        names = self._archive_names(repository, env)
+        if names is None:
+            # Première sauvegarde de l'agent: le repository n'existe pas encore
+            init = self._borg(['init', '--encryption=repokey', repository], env)
+            if init.returncode != 0:
+                raise RuntimeError(init.stderr)
+            return {'completed': False, 'checkpoints': []}
+
+        if archive_name in names:
+            # Archive d'une tentative précédente dont le compte rendu n'est pas arrivé
+            return {'completed': True, 'checkpoints': []}
+
+        checkpoints = [name for name in names if name.startswith(f"{archive_name}.checkpoint")]
+        if f"{archive_name}.checkpoint" in checkpoints:
+            new_name = f"{archive_name}.checkpoint.resume{len(checkpoints)}"
+            rename = self._borg(['rename', f"{repository}::{archive_name}.checkpoint", new_name], env)
+            if rename.returncode != 0:
+                raise RuntimeError(rename.stderr)
+            checkpoints[checkpoints.index(f"{archive_name}.checkpoint")] = new_name
+        return {'completed': False, 'checkpoints': checkpoints}
+
+    def _discard_checkpoints(self, spec: Dict[str, Any], env: Dict[str, str]):
+        names = [
+            name for name in self._archive_names(spec['repository'], env) or []
+            if name.startswith(f"{spec['archive_name']}.checkpoint")
+        ]
+        if names:
+            self._borg(['delete', spec['repository']] + names, env)
+
+    def _keep_alive(self, job_id: int, interval: float, cancel: threading.Event, done: threading.Event):
+        """Prolonge le bail du job et relève les demandes d'annulation"""
+        while not done.wait(interval):
+            beat = self.client.job_heartbeat(job_id)
+            if beat['success'] and beat['data'].get('cancel'):
+                cancel.set()
+                return
+
+    def _create(self, spec: Dict[str, Any], env: Dict[str, str],
+                cancel: threading.Event) -> subprocess.CompletedProcess:
+        cmd = ['borg', 'create', '--json', '--checkpoint-interval', str(spec['checkpoint_interval'])]
+        if spec.get('compression'):
+            cmd += ['--compression', spec['compression']]
+        cmd += borg_args(spec.get('exclude_patterns') or [])
+
+        # Archive toujours complète: le cache de fichiers de borg évite de relire l'inchangé
+        cmd += [f"{spec['repository']}::{spec['archive_name']}"] + spec['source_paths']
+
+        process = subprocess.Popen(cmd, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, text=True)
+        # stderr est lu ligne à ligne pour être transmis pendant la sauvegarde
+        stderr_lines = []
+        reader = threading.Thread(target=self._read_log, args=(process.stderr, stderr_lines), daemon=True)
+        reader.start()
+
+        signalled = False
+        while True:
+            try:
+                process.wait(timeout=CANCEL_GRACE if signalled else 1)
+                break
+            except subprocess.TimeoutExpired:
+                if signalled:
+                    process.kill()
+                    process.wait()
+                    break
+                if cancel.is_set():
+                    process.send_signal(signal.SIGINT)
+                    signalled = True
+
+        stdout = process.stdout.read()
+        reader.join()
+        return subprocess.CompletedProcess(cmd, process.returncode, stdout, ''.join(stderr_lines))
+
+    def _read_log(self, stream, lines: List[str]):
+        for line in stream:
+            lines.append(line)
+            if self.on_log:
+                self.on_log(line.rstrip('\n'))
+
+    def run(self, spec: Dict[str, Any], cancel: Optional[threading.Event] = None) -> Dict[str, Any]:
+        """Exécute la sauvegarde et retourne le compte rendu à envoyer au serveur
+        
+        `cancel` permet à l'appelant de signaler lui-même une annulation reçue du serveur.
+        """
+        env = self._env(spec)
+        cancel = cancel or threading.Event()
+        done = threading.Event()
+        # Renouvellement bien avant l'expiration du bail
+        keep_alive = threading.Thread(
+            target=self._keep_alive,
+            args=(spec['job_id'], max(spec['lease_ttl'] / 4, 1), cancel, done),
+            daemon=True
+        )
+        keep_alive.start()
+
+        try:
+            resume = self._prepare(spec, env)
+            if resume['completed']:
+                return {'success': True, 'stats': {}, 'existing': True}
+
+            result = self._create(spec, env, cancel)
+            if result.returncode == 0:
+                if resume['checkpoints']:
+                    self._borg(['delete', spec['repository']] + resume['checkpoints'], env)
+                return {'success': True, 'stats': parse_create_stats(result.stdout)}
+
+            if cancel.is_set():
+                # Les checkpoints d'une sauvegarde annulée ne seront jamais repris
+                self._discard_checkpoints(spec, env)
+                return {'success': False, 'cancelled': True}
+            return {'success': False, 'error': result.stderr.strip() or f"borg create: code {result.returncode}"}
+        except Exception as e:
+            return {'success': False, 'error': str(e)}
+        finally:
+            done.set()
+            keep_alive.join()
@@ -0,0 +1,197 @@
+"""
+Index local des fichiers sauvegardés (SQLite: chemin, taille, mtime, inode)
+
+Sans journal des modifications, l'agent compare un parcours de ses source_paths
+(os.scandir sur plusieurs threads) à l'état enregistré lors de la dernière sauvegarde
+réussie. Il en tire une estimation des octets modifiés (contrôle de quota) et évite
+une sauvegarde quand rien n'a changé. Toute sauvegarde lancée reste complète: borg
+parcourt l'arborescence entière.
+"""
+import os
+import time
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Iterator, Tuple
+
+from agent.journal import FULL_WALK_INTERVAL
+
+# Répertoires lus simultanément
+SCAN_WORKERS = 8
+# Lignes insérées par transaction pendant le parcours
+SCAN_BATCH = 5000
+
+Entry = Tuple[str, int, int, int]
+
+def _scan_dir(path: str, exclusions=None, inside: bool = False,
+              measure: bool = False) -> Tuple[List[Entry], List[Tuple[str, bool]], int, int]:
+    """Fichiers (chemin, taille, mtime_ns, inode) et sous-répertoires d'un répertoire
+
+    Les entrées exclues ne sont pas retournées; leurs octets sont comptés, et les
+    répertoires exclus ne sont parcourus que pour cette mesure (`measure`).
+    """
+    files, dirs = [], []
+    excluded_bytes = excluded_files = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                skip = inside or (exclusions is not None and exclusions.excluded(entry.path))
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not skip or measure:
+                            dirs.append((entry.path, skip))
+                        continue
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if skip:
+                    excluded_bytes += st.st_size
+                    excluded_files += 1
+                else:
+                    files.append((entry.path, st.st_size, st.st_mtime_ns, st.st_ino))
+    except OSError:
+        pass
+    return files, dirs, excluded_bytes, excluded_files
+
+def walk(roots: List[str], workers: int = SCAN_WORKERS, exclusions=None,
+         excluded: Optional[Dict[str, int]] = None) -> Iterator[List[Entry]]:
+    """Parcourt les racines en parallèle, un lot de fichiers par répertoire lu
+
+    Avec `exclusions` (ExclusionSet), les chemins exclus sont écartés; `excluded` reçoit
+    alors leurs octets et leur nombre ('bytes', 'files').
+    """
+    measure = excluded is not None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for root in roots:
+            if os.path.isdir(root) and not os.path.islink(root):
+                pending.add(pool.submit(_scan_dir, root, exclusions, False, measure))
+            elif os.path.lexists(root):
+                st = os.lstat(root)
+                yield [(root, st.st_size, st.st_mtime_ns, st.st_ino)]
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, dirs, excluded_bytes, excluded_files = future.result()
+                pending.update(pool.submit(_scan_dir, path, exclusions, inside, measure) for path, inside in dirs)
+                if measure:
+                    excluded['bytes'] += excluded_bytes
+                    excluded['files'] += excluded_files
+                if files:
+                    yield files
+
+class FileIndex:
+    """État des fichiers au moment de la dernière sauvegarde réussie"""
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # Utilisé depuis le thread d'exécution des jobs, un appel à la fois
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.directory / "index.db"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        for table in ("files", "scan"):
+            self.db.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER) WITHOUT ROWID"
+            )
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.commit()
+
+    def _meta(self, key: str) -> Optional[str]:
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value: str):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    _CHANGED = (
+        "FROM scan s LEFT JOIN files f ON f.path = s.path "
+        "WHERE f.path IS NULL OR f.size != s.size OR f.mtime_ns != s.mtime_ns OR f.inode != s.inode"
+    )
+
+    def scan(self, roots: List[str], workers: int = SCAN_WORKERS, exclusions=None) -> Dict[str, int]:
+        """Parcourt les racines et compare le résultat à l'état de la dernière sauvegarde"""
+        with self._lock:
+            self.db.execute("DELETE FROM scan")
+            total = 0
+            batch = []
+            excluded = {'bytes': 0, 'files': 0}
+            for files in walk(roots, workers, exclusions, excluded):
+                batch.extend(files)
+                if len(batch) >= SCAN_BATCH:
+                    self.db.executemany("INSERT OR REPLACE INTO scan VALUES (?, ?, ?, ?)", batch)
+                    total += len(batch)
+                    batch = []
+            self.db.executemany("INSERT OR REPLACE INTO scan VALUES (?, ?, ?, ?)", batch)
+            total += len(batch)
+            self._set_meta('scan_roots', '\n'.join(roots))
+            self.db.commit()
+
+            changed, changed_bytes = self.db.execute(f"SELECT count(*), coalesce(sum(s.size), 0) {self._CHANGED}").fetchone()
+            deleted = self.db.execute(
+                "SELECT count(*) FROM files f WHERE NOT EXISTS (SELECT 1 FROM scan s WHERE s.path = f.path)"
+            ).fetchone()[0]
+            return {'files': total, 'changed': changed, 'changed_bytes': changed_bytes, 'deleted': deleted,
+                    'excluded_bytes': excluded['bytes'], 'excluded_files': excluded['files']}
+
+    def estimate(self, roots: List[str], workers: int = SCAN_WORKERS, exclusions=None) -> Dict[str, int]:
+        """Octets modifiés depuis la dernière sauvegarde, sans toucher à l'index (lecture seule)"""
+        counts = {'files': 0, 'changed': 0, 'changed_bytes': 0}
+        # Connexion propre: l'estimation peut tourner pendant une sauvegarde du daemon
+        db = sqlite3.connect(str(self.directory / "index.db"))
+        try:
+            for files in walk(roots, workers, exclusions):
+                for start in range(0, len(files), 500):
+                    chunk = files[start:start + 500]
+                    known = {
+                        row[0]: row for row in db.execute(
+                            f"SELECT path, size, mtime_ns, inode FROM files WHERE path IN ({','.join('?' * len(chunk))})",
+                            [entry[0] for entry in chunk]
+                        )
+                    }
+                    for entry in chunk:
+                        if known.get(entry[0]) != entry:
+                            counts['changed'] += 1
+                            counts['changed_bytes'] += entry[1]
+                counts['files'] += len(files)
+        finally:
+            db.close()
+        return counts
+
+    def full_walk_reason(self, roots: List[str], interval: float = FULL_WALK_INTERVAL,
+                         now: Optional[float] = None) -> Optional[str]:
+        """Motif d'une sauvegarde sans consulter l'index, None s'il suffit"""
+        last_full = self._meta('last_full_walk')
+        if not last_full:
+            return "index vide"
+        if self._meta('roots') != '\n'.join(roots):
+            return "source_paths modifiés"
+        if (now or time.time()) - float(last_full) >= interval:
+            return "parcours complet périodique"
+        return None
+
+    def plan(self, roots: List[str], interval: float = FULL_WALK_INTERVAL, exclusions=None) -> Dict[str, Any]:
+        """Décide entre une sauvegarde (complète) et aucune sauvegarde"""
+        started_at = time.time()
+        counts = self.scan(roots, exclusions=exclusions)
+        plan = {'skip': False, 'started_at': started_at,
+                'reason': self.full_walk_reason(roots, interval, started_at), **counts}
+        # Un fichier supprimé est aussi une modification
+        plan['skip'] = not plan['reason'] and not counts['changed'] and not counts['deleted']
+        return plan
+
+    def complete(self, plan: Dict[str, Any]):
+        """Enregistre le dernier parcours comme état sauvegardé"""
+        with self._lock:
+            self.db.execute(f"INSERT OR REPLACE INTO files SELECT s.* {self._CHANGED}")
+            self.db.execute("DELETE FROM files WHERE NOT EXISTS (SELECT 1 FROM scan s WHERE s.path = files.path)")
+            self._set_meta('last_full_walk', str(plan['started_at']))
+            self._set_meta('roots', self._meta('scan_roots') or '')
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,256 @@
+"""
+Journal des modifications du système de fichiers (Linux, inotify)
+
+Le daemon surveille les source_paths et note chaque chemin modifié dans un journal
+persistant. Quand le journal est fiable et ne contient aucun chemin sauvegardé, la
+sauvegarde demandée n'a pas lieu d'être: aucune archive n'est créée. Sinon borg parcourt
+toute l'arborescence, de sorte que chaque archive reste complète (le cache de fichiers
+de borg évite de relire les fichiers inchangés).
+
+Le journal ne peut pas être cru quand la surveillance a démarré après la dernière
+sauvegarde (redémarrage du daemon), que la file inotify a débordé ou que la limite de
+watches est atteinte; une sauvegarde périodique a lieu de toute façon.
+"""
+import os
+import json
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Iterable, Tuple
+
+# Parcours complet au moins une fois par semaine
+FULL_WALK_INTERVAL = 7 * 24 * 3600
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW)
+_EVENT = struct.Struct('iIII')
+
+def _within(path: str, roots: Iterable[str]) -> bool:
+    return any(path == root or path.startswith(root.rstrip(os.sep) + os.sep) for root in roots)
+
+class ChangeJournal:
+    """Ensemble persistant des chemins modifiés depuis la dernière sauvegarde
+
+    Les chemins sont ajoutés à la fin d'un fichier (un par ligne); une sauvegarde réussie
+    retire ceux qu'elle a couverts, ceux arrivés pendant la sauvegarde restent.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._dirty_file = self.directory / "dirty"
+        self._state_file = self.directory / "state.json"
+        self._lock = threading.Lock()
+        self._seen = set(self._read_dirty()[0])
+
+    def _read_dirty(self) -> Tuple[List[str], int]:
+        try:
+            data = self._dirty_file.read_bytes()
+        except FileNotFoundError:
+            return [], 0
+        # Une ligne incomplète (arrêt brutal pendant l'écriture) n'est pas retenue
+        end = data.rfind(b'\n') + 1
+        return [os.fsdecode(line) for line in data[:end].splitlines() if line], end
+
+    @property
+    def state(self) -> Dict[str, Any]:
+        try:
+            return json.loads(self._state_file.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return {}
+
+    def _update_state(self, **values):
+        state = {**self.state, **values}
+        tmp = self._state_file.with_suffix('.tmp')
+        tmp.write_text(json.dumps(state), encoding='utf-8')
+        os.replace(tmp, self._state_file)
+
+    def mark(self, paths: Iterable[str]):
+        with self._lock:
+            new = [path for path in dict.fromkeys(paths) if path not in self._seen]
+            if not new:
+                return
+            with open(self._dirty_file, 'ab') as f:
+                f.write(b''.join(os.fsencode(path) + b'\n' for path in new))
+            self._seen.update(new)
+
+    def mark_overflow(self):
+        """Des événements ont été perdus: seul un parcours complet est fiable"""
+        with self._lock:
+            self._update_state(overflow_at=time.time())
+
+    def start_watching(self, roots: List[str]):
+        with self._lock:
+            self._update_state(watching_since=time.time(), roots=roots)
+
+    def stop_watching(self):
+        with self._lock:
+            self._update_state(watching_since=None)
+
+    def pending(self) -> Tuple[List[str], int]:
+        """Chemins en attente et position du journal qu'ils occupent"""
+        with self._lock:
+            return self._read_dirty()
+
+    def full_walk_reason(self, source_paths: List[str], interval: float = FULL_WALK_INTERVAL,
+                         now: Optional[float] = None) -> Optional[str]:
+        """Motif d'une sauvegarde sans consulter le journal, None s'il peut être cru"""
+        now = now or time.time()
+        state = self.state
+        last_full = state.get('last_full_walk')
+        if not state.get('watching_since'):
+            return "surveillance inactive"
+        if not last_full or last_full < state['watching_since']:
+            return "aucun parcours complet depuis le début de la surveillance"
+        if state.get('overflow_at') and state['overflow_at'] >= last_full:
+            return "événements perdus"
+        if not all(_within(path, state.get('roots', [])) for path in source_paths):
+            return "chemins hors surveillance"
+        if now - last_full >= interval:
+            return "parcours complet périodique"
+        return None
+
+    def complete(self, plan: Dict[str, Any]):
+        """Retire du journal les chemins couverts par une sauvegarde réussie"""
+        with self._lock:
+            data = self._dirty_file.read_bytes() if self._dirty_file.exists() else b''
+            rest = data[plan['offset']:]
+            tmp = self._dirty_file.with_suffix('.tmp')
+            tmp.write_bytes(rest)
+            os.replace(tmp, self._dirty_file)
+            self._seen = {os.fsdecode(line) for line in rest.splitlines() if line}
+            self._update_state(last_full_walk=plan['started_at'])
+
+def plan_backup(journal: ChangeJournal, source_paths: List[str],
+                interval: float = FULL_WALK_INTERVAL, exclusions=None) -> Dict[str, Any]:
+    """Décide si une sauvegarde (toujours complète) est nécessaire d'après le journal"""
+    started_at = time.time()
+    paths, offset = journal.pending()
+    plan = {'skip': False, 'offset': offset, 'started_at': started_at, 'changed': None,
+            'reason': journal.full_walk_reason(source_paths, interval, started_at)}
+    if plan['reason']:
+        return plan
+
+    # Un chemin supprimé est aussi une modification; un chemin exclu n'en est pas une
+    plan['changed'] = sum(
+        1 for path in set(paths)
+        if _within(path, source_paths) and not (exclusions is not None and exclusions.excluded(path))
+    )
+    plan['skip'] = not plan['changed']
+    return plan
+
+class InotifyWatcher:
+    """Alimente le journal à partir des événements inotify des source_paths"""
+
+    def __init__(self, roots: List[str], journal: ChangeJournal):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.journal = journal
+        self.watches: Dict[int, str] = {}
+        self._fd = None
+        self._libc = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _add_watch(self, path: str) -> bool:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            if ctypes.get_errno() == errno.ENOSPC:
+                # fs.inotify.max_user_watches atteint: une partie de l'arborescence n'est pas suivie
+                self.journal.mark_overflow()
+            return False
+        self.watches[wd] = path
+        return True
+
+    def _watch_tree(self, root: str, mark: bool = False):
+        """Surveille un répertoire et ses sous-répertoires (et note leur contenu s'il est nouveau)"""
+        for dirpath, dirnames, filenames in os.walk(root):
+            if not self._add_watch(dirpath):
+                dirnames[:] = []
+                continue
+            if mark:
+                self.journal.mark([dirpath] + [os.path.join(dirpath, name) for name in dirnames + filenames])
+
+    def _forget_tree(self, path: str):
+        """Un répertoire déplacé: ses watches désignent désormais un autre chemin"""
+        for wd, watched in list(self.watches.items()):
+            if watched == path or watched.startswith(path + os.sep):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self.watches[wd]
+
+    def _handle(self, data: bytes):
+        dirty = []
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+            offset += _EVENT.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                self.journal.mark_overflow()
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            base = self.watches.get(wd)
+            if base is None:
+                continue
+
+            path = os.path.join(base, os.fsdecode(name)) if name else base
+            dirty.append(path)
+            if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                self._forget_tree(path)
+            elif mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_tree(path, mark=True)
+
+        self.journal.mark(dirty)
+
+    def _run(self):
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self._fd], [], [], 0.5)
+            if ready:
+                self._handle(os.read(self._fd, 256 * 1024))
+
+    def start(self):
+        """Pose les watches puis suit les événements en tâche de fond (OSError hors Linux)"""
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify indisponible sur ce système")
+        self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+
+        for root in self.roots:
+            self._watch_tree(root)
+        # Les changements antérieurs à ce point ne sont pas connus
+        self.journal.start_watching(self.roots)
+
+        self._thread = threading.Thread(target=self._run, name="change-journal", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self.journal.stop_watching()
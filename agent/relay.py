@@ -0,0 +1,174 @@
+"""
+Relais SaveOS pour les sites dont les agents passent par un hôte unique
+
+Les agents du site pointent leur api_url sur le relais. Leurs heartbeats sont acquittés
+sur place, regroupés (le dernier par agent) puis transmis à l'API en lots via
+/agents/heartbeats/batch; toutes les autres requêtes (jobs, comptes rendus,
+téléchargements) sont relayées telles quelles sur une connexion persistante.
+Application ASGI sans framework, servie par uvicorn.
+"""
+import asyncio
+import json
+import time
+from typing import Dict, Any, Optional, Callable
+
+import httpx
+
+from agent.runtime import http2_available
+from agent.transport import backoff_delay
+
+# Heartbeats transmis par requête (limite acceptée par l'API)
+RELAY_BATCH_SIZE = 5000
+HEARTBEAT_PATH = "/api/v1/agents/heartbeat"
+BATCH_PATH = "/api/v1/agents/heartbeats/batch"
+# En-têtes propres à une connexion, jamais relayés
+HOP_BY_HOP = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te',
+    'trailer', 'transfer-encoding', 'upgrade', 'host', 'content-length'
+}
+# Le corps relayé est décompressé par httpx
+DECODED = {'content-encoding'}
+
+class RelayApp:
+    """Application ASGI du relais"""
+
+    def __init__(self, upstream: str, relay_token: str, flush_interval: float = 30,
+                 verify_ssl: bool = False, transport: Optional[httpx.AsyncBaseTransport] = None,
+                 echo: Callable[[str], None] = print):
+        self.relay_token = relay_token
+        self.flush_interval = flush_interval
+        self.echo = echo
+        self.http = httpx.AsyncClient(
+            base_url=upstream.rstrip('/'),
+            verify=verify_ssl,
+            http2=http2_available(),
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            # Les attentes de job (long-poll) durent jusqu'à deux minutes
+            timeout=httpx.Timeout(180, connect=10),
+            transport=transport
+        )
+        # Dernier statut reçu par jeton d'agent, en attente d'envoi
+        self.pending: Dict[str, str] = {}
+        self.stats = {'heartbeats': 0, 'batches': 0, 'forwarded': 0, 'rejected': 0}
+        self._flusher = None
+
+    async def flush(self) -> bool:
+        """Transmet les heartbeats en attente; ceux d'un lot refusé sont gardés pour le prochain envoi"""
+        pending, self.pending = self.pending, {}
+        items = list(pending.items())
+
+        for start in range(0, len(items), RELAY_BATCH_SIZE):
+            batch = items[start:start + RELAY_BATCH_SIZE]
+            try:
+                response = await self.http.post(
+                    BATCH_PATH,
+                    json={'heartbeats': [{'token': token, 'status': status} for token, status in batch]},
+                    headers={'Authorization': f'Bearer {self.relay_token}'}
+                )
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                self.echo(f"❌ Envoi des heartbeats impossible: {e}")
+                # Un heartbeat reçu entre-temps est plus récent que celui du lot
+                for token, status in items[start:]:
+                    self.pending.setdefault(token, status)
+                return False
+
+            self.stats['batches'] += 1
+            rejected = response.json().get('rejected', [])
+            self.stats['rejected'] += len(rejected)
+        return True
+
+    async def _flush_loop(self):
+        failures = 0
+        while True:
+            delay = self.flush_interval if not failures else backoff_delay(failures, self.flush_interval, 600)
+            await asyncio.sleep(delay)
+            if not self.pending:
+                continue
+            failures = 0 if await self.flush() else failures + 1
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self._flusher = asyncio.ensure_future(self._flush_loop())
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._flusher:
+                    self._flusher.cancel()
+                await self.flush()
+                await self.http.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _read_body(self, receive) -> bytes:
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                return body
+
+    async def _respond(self, send, status: int, payload: Any):
+        body = json.dumps(payload).encode()
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'application/json')]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _heartbeat(self, headers: Dict[str, str], body: bytes, send):
+        """Acquitte le heartbeat d'un agent; il partira avec le prochain lot"""
+        authorization = headers.get('authorization', '')
+        if not authorization.lower().startswith('bearer '):
+            await self._respond(send, 401, {'detail': "Token d'authentification requis"})
+            return
+        try:
+            status = json.loads(body or b'{}').get('status', 'active')
+        except ValueError:
+            await self._respond(send, 422, {'detail': 'Corps JSON invalide'})
+            return
+
+        self.pending[authorization[7:]] = status
+        self.stats['heartbeats'] += 1
+        await self._respond(send, 200, {
+            'message': 'Heartbeat reçu (relais)',
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime())
+        })
+
+    async def _forward(self, scope, body: bytes, send):
+        """Relaie une requête vers l'API en transmettant la réponse au fil de l'eau"""
+        headers = [(name, value) for name, value in scope['headers'] if name.decode().lower() not in HOP_BY_HOP]
+        url = scope['path'] + (f"?{scope['query_string'].decode()}" if scope['query_string'] else '')
+        request = self.http.build_request(scope['method'], url, headers=headers, content=body)
+        try:
+            response = await self.http.send(request, stream=True)
+        except httpx.HTTPError as e:
+            await self._respond(send, 502, {'detail': f"API injoignable: {e}"})
+            return
+
+        self.stats['forwarded'] += 1
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': response.status_code,
+                'headers': [
+                    (name.encode(), value.encode()) for name, value in response.headers.items()
+                    if name.lower() not in HOP_BY_HOP | DECODED
+                ]
+            })
+            async for chunk in response.aiter_bytes():
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            await response.aclose()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+
+        body = await self._read_body(receive)
+        if scope['method'] == 'POST' and scope['path'] == HEARTBEAT_PATH:
+            headers = {name.decode().lower(): value.decode() for name, value in scope['headers']}
+            await self._heartbeat(headers, body, send)
+        else:
+            await self._forward(scope, body, send)
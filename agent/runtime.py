@@ -0,0 +1,412 @@
+"""
+Runtime asyncio du daemon de l'agent SaveOS
+
+Heartbeats de l'agent, attente des jobs (long-poll), bail des jobs en cours et envoi
+du journal de borg tournent en parallèle sur une seule connexion HTTP/2 persistante
+(httpx). borg s'exécute dans un thread, un job à la fois; son journal transite par un
+tampon borné, si bien que la mémoire de l'agent reste stable quelle que soit la durée
+des sauvegardes.
+"""
+import asyncio
+import random
+import threading
+import time
+from collections import Counter, deque
+from typing import Dict, Any, List, Optional, Callable
+
+import httpx
+
+from agent.executor import BackupExecutor
+from agent.transport import RETRYABLE_STATUS, CircuitBreaker, Spool, backoff_delay
+from agent.journal import ChangeJournal, FULL_WALK_INTERVAL, plan_backup
+from agent.index import FileIndex
+from agent.exclusions import ExclusionSet
+
+# Lignes de journal gardées entre deux envois (les plus anciennes sont perdues au-delà)
+LOG_BUFFER_LINES = 500
+# Fréquence d'envoi du journal d'un job en cours
+LOG_SHIP_INTERVAL = 5
+# Attente maximale d'un job acceptée par le serveur
+MAX_POLL_WAIT = 120
+# Tentatives par requête et bornes du délai exponentiel entre deux tentatives
+RETRY_ATTEMPTS = 4
+RETRY_BASE = 1.0
+RETRY_CAP = 60.0
+# File locale: fréquence de vidage, étalement après le retour de l'API, taille des lots
+SPOOL_FLUSH_INTERVAL = 15
+SPOOL_FLUSH_JITTER = 30
+SPOOL_BATCH = 20
+
+def http2_available() -> bool:
+    """HTTP/2 demande le paquet h2 (httpx[http2])"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def memory_usage() -> Dict[str, Optional[int]]:
+    """Mémoire résidente actuelle et maximale du processus, en octets (None si inconnue)"""
+    usage = {'rss': None, 'peak_rss': None}
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    usage['rss'] = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        # Kio sous Linux
+        usage['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        pass
+    return usage
+
+class LogBuffer:
+    """Tampon borné des lignes de journal, alimenté par le thread de borg"""
+
+    def __init__(self, max_lines: int = LOG_BUFFER_LINES):
+        self._lines = deque(maxlen=max_lines)
+        self._lock = threading.Lock()
+
+    def append(self, line: str):
+        with self._lock:
+            self._lines.append(line)
+
+    def drain(self) -> List[str]:
+        with self._lock:
+            lines = list(self._lines)
+            self._lines.clear()
+        return lines
+
+class AsyncAPIClient:
+    """Client asyncio de l'API SaveOS (mêmes retours que SaveOSAPIClient)"""
+
+    def __init__(self, api_url: str, token: str, verify_ssl: bool = False,
+                 transport: Optional[httpx.AsyncBaseTransport] = None, pool_size: int = 4,
+                 retry_attempts: int = RETRY_ATTEMPTS, retry_base: float = RETRY_BASE,
+                 retry_cap: float = RETRY_CAP, breaker: Optional[CircuitBreaker] = None):
+        self.http2 = http2_available()
+        self.retry_attempts = max(1, retry_attempts)
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+        self.breaker = breaker or CircuitBreaker()
+        self.http = httpx.AsyncClient(
+            base_url=f"{api_url.rstrip('/')}/api/v1",
+            headers={'Authorization': f'Bearer {token}'},
+            verify=verify_ssl,
+            http2=self.http2,
+            # En HTTP/2 toutes les requêtes partagent une connexion; la marge ne sert
+            # qu'aux serveurs HTTP/1.1 (une connexion par requête simultanée)
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(30, connect=10),
+            transport=transport
+        )
+        # Nombre de requêtes par point d'accès
+        self.requests = Counter()
+
+    async def _request(self, name: str, method: str, path: str, retry: bool = True, **kwargs) -> Dict[str, Any]:
+        """Requête avec nouvelles tentatives; `retryable` signale un échec dû à l'indisponibilité de l'API"""
+        error = None
+        for attempt in range(self.retry_attempts if retry else 1):
+            if attempt:
+                await asyncio.sleep(backoff_delay(attempt - 1, self.retry_base, self.retry_cap))
+            if not self.breaker.allow():
+                return {"success": False, "error": "API indisponible (disjoncteur ouvert)", "retryable": True}
+
+            self.requests[name] += 1
+            try:
+                response = await self.http.request(method, path, **kwargs)
+            except httpx.HTTPError as e:
+                self.breaker.record_failure()
+                error = str(e) or type(e).__name__
+                continue
+
+            if response.status_code in RETRYABLE_STATUS:
+                self.breaker.record_failure()
+                error = f"HTTP {response.status_code}: {response.text}"
+                continue
+
+            # Toute autre réponse prouve que l'API est joignable
+            self.breaker.record_success()
+            if response.status_code == 200:
+                return {"success": True, "data": response.json()}
+            return {"success": False, "error": f"HTTP {response.status_code}: {response.text}"}
+
+        return {"success": False, "error": error, "retryable": True}
+
+    async def send_heartbeat(self, status: str = "active", retry: bool = True) -> Dict[str, Any]:
+        return await self._request('heartbeat', 'POST', '/agents/heartbeat', retry=retry,
+                                   json={"status": status, "config": {}})
+
+    async def list_agent_jobs(self, wait: int = 0) -> Dict[str, Any]:
+        # La boucle d'attente gère elle-même ses reprises
+        return await self._request('jobs', 'GET', '/agents/me/jobs', retry=False,
+                                   params={"wait": wait} if wait else None, timeout=30 + wait)
+
+    async def start_job(self, job_id: int) -> Dict[str, Any]:
+        return await self._request('start', 'POST', f'/jobs/{job_id}/start')
+
+    async def job_heartbeat(self, job_id: int, progress: Optional[int] = None,
+                            log: Optional[List[str]] = None, retry: bool = True,
+                            estimated_bytes: Optional[int] = None) -> Dict[str, Any]:
+        payload = {"progress": progress, "log": log or []}
+        if estimated_bytes is not None:
+            payload["estimated_bytes"] = estimated_bytes
+        return await self._request('job_heartbeat', 'POST', f'/jobs/{job_id}/heartbeat', retry=retry,
+                                   json=payload)
+
+    async def report_job(self, job_id: int, report: Dict[str, Any], retry: bool = True) -> Dict[str, Any]:
+        return await self._request('report', 'POST', f'/jobs/{job_id}/report', retry=retry, json=report)
+
+    async def aclose(self):
+        await self.http.aclose()
+
+class _ThreadClient:
+    """Façade synchrone pour BackupExecutor: ses appels passent par la connexion de la boucle"""
+
+    def __init__(self, client: AsyncAPIClient, loop: asyncio.AbstractEventLoop, log: LogBuffer):
+        self.client = client
+        self.loop = loop
+        self.log = log
+
+    def job_heartbeat(self, job_id: int, progress: Optional[int] = None) -> Dict[str, Any]:
+        coro = self.client.job_heartbeat(job_id, progress, self.log.drain())
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+class AgentRuntime:
+    """Boucles du daemon: heartbeats de l'agent et exécution des jobs assignés"""
+
+    def __init__(self, client: AsyncAPIClient, ssh_key: Optional[str] = None,
+                 heartbeat_interval: float = 300, poll_wait: int = 60,
+                 echo: Callable[[str], None] = print, spool: Optional[Spool] = None,
+                 journal: Optional[ChangeJournal] = None, full_walk_interval: float = FULL_WALK_INTERVAL,
+                 index: Optional[FileIndex] = None, exclusions: Optional[ExclusionSet] = None):
+        self.client = client
+        # Motifs d'exclusion (profils et motifs utilisateur) appliqués aux sauvegardes locales
+        self.exclusions = exclusions
+        # Journal des modifications, ou à défaut index local: sauvegardes incrémentales
+        # entre deux parcours complets
+        self.journal = journal
+        self.index = index
+        self.full_walk_interval = full_walk_interval
+        # Messages non remis, renvoyés après le retour de l'API
+        self.spool = spool
+        self.ssh_key = ssh_key
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_wait = max(1, min(int(poll_wait), MAX_POLL_WAIT))
+        self.echo = echo
+        self.log = LogBuffer()
+        self.jobs_run = 0
+        self._stop = None
+
+    async def _sleep(self, seconds: float):
+        """Attente interrompue par l'arrêt du runtime"""
+        try:
+            await asyncio.wait_for(self._stop.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    def _spool(self, result: Dict[str, Any], kind: str, payload: Dict[str, Any], key: Optional[str] = None) -> bool:
+        """Garde un message que l'API n'a pas pu recevoir; vrai s'il a été mis en file"""
+        if result['success'] or not result.get('retryable') or self.spool is None:
+            return False
+        self.spool.put(kind, payload, key)
+        return True
+
+    async def _heartbeats(self):
+        while not self._stop.is_set():
+            result = await self.client.send_heartbeat("active")
+            if result['success']:
+                self.echo(f"💓 Heartbeat envoyé à {time.strftime('%Y-%m-%d %H:%M:%S')}")
+            else:
+                self.echo(f"❌ Erreur heartbeat: {result['error']}")
+                # Seul le dernier heartbeat compte
+                self._spool(result, 'heartbeat', {'status': 'active'}, key='agent')
+            await self._sleep(self.heartbeat_interval)
+
+    async def _deliver(self, kind: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Renvoie un message de la file (sans nouvelle tentative: le vidage s'arrête au premier échec)"""
+        if kind == 'heartbeat':
+            return await self.client.send_heartbeat(payload['status'], retry=False)
+        if kind == 'log':
+            return await self.client.job_heartbeat(payload['job_id'], log=payload['log'], retry=False)
+        return await self.client.report_job(payload['job_id'], payload['report'], retry=False)
+
+    async def _flush_spool(self):
+        """Vide la file locale par lots une fois l'API revenue"""
+        while not self._stop.is_set():
+            await self._sleep(SPOOL_FLUSH_INTERVAL)
+            if not len(self.spool) or self.client.breaker.state != 'closed':
+                continue
+            # Étalement: les agents coupés ensemble ne vident pas leur file au même instant
+            await self._sleep(random.random() * SPOOL_FLUSH_JITTER)
+
+            for path, kind, payload in self.spool.items(SPOOL_BATCH):
+                result = await self._deliver(kind, payload)
+                if not result['success'] and result.get('retryable'):
+                    break
+                # Remis, ou refusé définitivement (job repris entre-temps, etc.)
+                self.spool.remove(path)
+
+    async def _jobs(self, executor: BackupExecutor):
+        failures = 0
+        while not self._stop.is_set():
+            # Une seule requête ouverte: le serveur répond dès qu'un job est assigné
+            poll = asyncio.ensure_future(self.client.list_agent_jobs(wait=self.poll_wait))
+            stop = asyncio.ensure_future(self._stop.wait())
+            await asyncio.wait({poll, stop}, return_when=asyncio.FIRST_COMPLETED)
+            stop.cancel()
+            if not poll.done():
+                poll.cancel()
+                return
+
+            result = poll.result()
+            if not result['success']:
+                # Serveur injoignable: délai exponentiel aléatoire, pas de reconnexion en rafale
+                await self._sleep(backoff_delay(failures, RETRY_BASE, RETRY_CAP))
+                failures += 1
+                continue
+            failures = 0
+
+            started = False
+            for job in result['data']:
+                if self._stop.is_set():
+                    return
+                started = await self._run_job(executor, job['id']) or started
+            if result['data'] and not started:
+                # Jobs en attente mais non démarrables (repository occupé): pas de nouvelle demande immédiate
+                await self._sleep(backoff_delay(1, self.poll_wait, self.poll_wait))
+
+    async def _ship_log(self, job_id: int, cancel: threading.Event):
+        """Envoie le journal de borg au fil de l'eau (prolonge aussi le bail)"""
+        while not cancel.is_set():
+            await asyncio.sleep(LOG_SHIP_INTERVAL)
+            lines = self.log.drain()
+            if not lines:
+                continue
+            beat = await self.client.job_heartbeat(job_id, log=lines)
+            if beat['success'] and beat['data'].get('cancel'):
+                cancel.set()
+            self._spool(beat, 'log', {'job_id': job_id, 'log': lines})
+
+    async def _announce_estimate(self, job_id: int, plan: Optional[Dict[str, Any]]) -> Optional[str]:
+        """Envoie l'estimation pré-vol au serveur avant borg; retourne le motif d'un refus (quota)"""
+        estimated_bytes = plan.get('changed_bytes') if plan else None
+        if estimated_bytes is None:
+            return None
+        beat = await self.client.job_heartbeat(job_id, estimated_bytes=estimated_bytes)
+        # API injoignable: le quota sera vérifié sur l'usage réel au compte rendu
+        if not beat['success']:
+            return None
+        return beat['data'].get('error')
+
+    async def _run_job(self, executor: BackupExecutor, job_id: int) -> bool:
+        """Exécute localement un job assigné à l'agent et en rend compte au serveur (False s'il n'a pas démarré)"""
+        start_result = await self.client.start_job(job_id)
+        if not start_result['success']:
+            # Déjà pris, annulé entre-temps ou repository occupé
+            self.echo(f"⚠️  Job {job_id} non démarré: {start_result['error']}")
+            return False
+
+        spec = start_result['data']
+        loop = asyncio.get_running_loop()
+        tracker, plan = None, None
+        # Exclusions de l'agent complétées par celles de la configuration du job côté serveur
+        exclusions = ExclusionSet((self.exclusions.patterns if self.exclusions else [])
+                                  + list(spec.get('exclude_patterns') or []))
+        spec = {**spec, 'exclude_patterns': exclusions.patterns}
+        if self.journal:
+            tracker = self.journal
+            plan = plan_backup(self.journal, spec['source_paths'], self.full_walk_interval, exclusions)
+            if plan['reason']:
+                self.echo(f"📂 Journal non consulté: {plan['reason']}")
+            else:
+                self.echo(f"📝 {plan['changed']} chemin(s) modifié(s) d'après le journal")
+        elif self.index:
+            tracker = self.index
+            # Parcours de l'arborescence: hors de la boucle, qui continue de servir le bail
+            plan = await loop.run_in_executor(None, self.index.plan, spec['source_paths'],
+                                              self.full_walk_interval, exclusions)
+            self.echo(f"🔎 {plan['changed']} fichier(s) modifié(s), "
+                      f"{plan['changed_bytes']} octet(s) à relire (estimation)")
+            if plan['reason']:
+                self.echo(f"📂 Index non consulté: {plan['reason']}")
+
+        refused = None
+        if not (plan and plan.get('skip')):
+            refused = await self._announce_estimate(job_id, plan)
+
+        if plan and plan.get('skip'):
+            self.echo(f"⏭️  Aucune modification depuis le dernier snapshot (job {job_id})")
+            report = {'success': True, 'skipped': True}
+        elif refused:
+            report = {'success': False, 'error': refused}
+        else:
+            excluded_bytes = plan.get('excluded_bytes') if plan else None
+            if exclusions and excluded_bytes is None:
+                # Sans index, la mesure demande son propre parcours des source_paths
+                measured = await loop.run_in_executor(None, exclusions.measure, spec['source_paths'])
+                excluded_bytes = measured['excluded_bytes']
+
+            self.echo(f"🚀 Sauvegarde locale {spec['archive_name']} (job {job_id})")
+            self.log.drain()
+            cancel = threading.Event()
+            shipper = asyncio.ensure_future(self._ship_log(job_id, cancel))
+            try:
+                # borg (bloquant) dans un thread; la boucle continue de servir heartbeats et journal
+                report = await loop.run_in_executor(None, executor.run, spec, cancel)
+            finally:
+                shipper.cancel()
+            self.jobs_run += 1
+            if tracker and report.get('success') and not report.get('existing'):
+                tracker.complete(plan)
+            if report.get('success') and not report.get('existing') and excluded_bytes is not None:
+                report['stats'] = {**report.get('stats', {}), 'excluded_bytes': excluded_bytes}
+                self.echo(f"🚫 {excluded_bytes} octet(s) exclu(s)")
+
+        lines = self.log.drain()
+        if lines:
+            beat = await self.client.job_heartbeat(job_id, log=lines)
+            self._spool(beat, 'log', {'job_id': job_id, 'log': lines})
+
+        report_result = await self.client.report_job(job_id, report)
+        if self._spool(report_result, 'report', {'job_id': job_id, 'report': report}, key=str(job_id)):
+            self.echo(f"📥 Compte rendu du job {job_id} mis en attente (API indisponible)")
+        elif not report_result['success']:
+            self.echo(f"❌ Compte rendu du job {job_id} refusé: {report_result['error']}")
+        elif report.get('success'):
+            self.echo(f"✅ Job {job_id} terminé")
+        elif report.get('cancelled'):
+            self.echo(f"🛑 Job {job_id} annulé")
+        else:
+            self.echo(f"❌ Job {job_id} échoué: {report.get('error')}")
+        return True
+
+    def stop(self):
+        """Arrête le runtime après le job en cours"""
+        if self._stop:
+            self._stop.set()
+
+    async def run(self, duration: Optional[float] = None):
+        """Lance les boucles du daemon (indéfiniment, ou pendant `duration` secondes)"""
+        self._stop = asyncio.Event()
+        executor = BackupExecutor(
+            _ThreadClient(self.client, asyncio.get_running_loop(), self.log),
+            ssh_key=self.ssh_key,
+            on_log=self.log.append
+        )
+        tasks = [asyncio.ensure_future(self._heartbeats()), asyncio.ensure_future(self._jobs(executor))]
+        if self.spool is not None:
+            tasks.append(asyncio.ensure_future(self._flush_spool()))
+        try:
+            if duration is None:
+                await asyncio.gather(*tasks)
+            else:
+                await asyncio.wait(tasks, timeout=duration)
+        finally:
+            # Un job en cours va jusqu'au bout: borg ne peut pas être abandonné dans son thread
+            self._stop.set()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.client.aclose()
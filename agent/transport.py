@@ -0,0 +1,116 @@
+"""
+Transport résilient de l'agent SaveOS
+
+Quand l'API redémarre, des milliers d'agents ne doivent pas revenir tous en même temps:
+les nouvelles tentatives attendent un délai exponentiel tiré au hasard (full jitter),
+un disjoncteur coupe les appels tant que l'API ne répond plus, et ce qui n'a pas pu
+être remis (heartbeats, journal, comptes rendus de jobs) est gardé sur disque puis
+renvoyé par lots après le retour de l'API.
+"""
+import os
+import json
+import time
+import random
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple, Callable
+
+# Réponses qui signalent une indisponibilité passagère de l'API
+RETRYABLE_STATUS = {429, 502, 503, 504}
+
+def backoff_delay(attempt: int, base: float, cap: float, rng: Callable[[], float] = random.random) -> float:
+    """Délai avant la tentative suivante: uniforme entre 0 et min(cap, base * 2^attempt)"""
+    return rng() * min(cap, base * 2 ** attempt)
+
+class CircuitBreaker:
+    """Disjoncteur: après `threshold` échecs consécutifs, plus d'appel pendant `reset_timeout`
+
+    Le délai avant l'appel de test est allongé au hasard (jusqu'au double) pour que les
+    agents coupés ensemble ne testent pas l'API au même instant.
+    """
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30,
+                 clock: Callable[[], float] = time.monotonic, rng: Callable[[], float] = random.random):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.rng = rng
+        self.failures = 0
+        self._retry_at = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self._retry_at is None:
+            return 'closed'
+        if self._probing or self.clock() >= self._retry_at:
+            return 'half_open'
+        return 'open'
+
+    def allow(self) -> bool:
+        """Vrai si un appel peut partir (un seul appel de test à la fois une fois le délai écoulé)"""
+        if self._retry_at is None:
+            return True
+        if self._probing or self.clock() < self._retry_at:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self._retry_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._probing or self.failures >= self.threshold:
+            self._retry_at = self.clock() + self.reset_timeout * (1 + self.rng())
+            self._probing = False
+
+class Spool:
+    """File locale des messages non remis à l'API (un fichier JSON par message)
+
+    Un message posé avec une clé remplace le précédent de même type et même clé: seul le
+    dernier heartbeat de l'agent est renvoyé, un compte rendu de job n'est gardé qu'une fois.
+    """
+
+    def __init__(self, directory: Path, max_items: int = 1000):
+        self.directory = Path(directory)
+        self.max_items = max_items
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _paths(self) -> List[Path]:
+        return sorted(self.directory.glob('*.json'))
+
+    def __len__(self) -> int:
+        return len(self._paths())
+
+    def put(self, kind: str, payload: Dict[str, Any], key: Optional[str] = None):
+        if key is not None:
+            for path in self.directory.glob(f"*-{kind}-{key}.json"):
+                path.unlink(missing_ok=True)
+
+        paths = self._paths()
+        # File pleine: les messages les plus anciens sont perdus, sauf les comptes rendus
+        droppable = [path for path in paths if '-report-' not in path.name]
+        for path in droppable[:max(0, len(paths) - self.max_items + 1)]:
+            path.unlink(missing_ok=True)
+
+        name = f"{time.time_ns():020d}-{kind}-{key if key is not None else os.getpid()}.json"
+        tmp = self.directory / f".{name}.tmp"
+        tmp.write_text(json.dumps(payload), encoding='utf-8')
+        os.replace(tmp, self.directory / name)
+
+    def items(self, limit: int) -> List[Tuple[Path, str, Dict[str, Any]]]:
+        """Les `limit` messages les plus anciens: (fichier, type, contenu)"""
+        items = []
+        for path in self._paths()[:limit]:
+            try:
+                payload = json.loads(path.read_text(encoding='utf-8'))
+            except (OSError, ValueError):
+                path.unlink(missing_ok=True)
+                continue
+            items.append((path, path.name.split('-')[1], payload))
+        return items
+
+    def remove(self, path: Path):
+        path.unlink(missing_ok=True)
@@ -13,6 +13,12 @@ from api.database import get_db, Agent
 
 security = HTTPBearer()
 
+# Jetons des relais de confiance (séparés par des virgules), conservés hachés (cf. AuthManager.hash_token)
+RELAY_TOKENS = {
+    hashlib.sha256(token.strip().encode()).hexdigest()
+    for token in os.getenv("RELAY_TOKENS", "").split(",") if token.strip()
+}
+
 class AuthManager:
     """Gestionnaire d'authentification pour les agents"""
     
@@ -53,4 +59,20 @@ async def get_current_agent(
     agent.last_seen = datetime.utcnow()
     db.commit()
     
-    return agent
\ No newline at end of file
+    return agent
+
+async def get_current_relay(
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+) -> str:
+    """Vérifie le jeton d'un relais de confiance et retourne son empreinte"""
+    
+    hashed_token = AuthManager.hash_token(credentials.credentials)
+    
+    if hashed_token not in RELAY_TOKENS:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Jeton de relais invalide",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    
+    return hashed_token
@@ -2,7 +2,7 @@
 Configuration de la base de données PostgreSQL pour SaveOS
 """
 import os
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, Text, BigInteger, ForeignKey
+from sqlalchemy import create_engine, inspect, text, Column, Integer, String, DateTime, Boolean, Text, BigInteger, Float, ForeignKey
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
@@ -24,6 +24,8 @@ class Tenant(Base):
     name = Column(String(255), nullable=False)
     quota_bytes = Column(BigInteger, default=1000000000)  # 1GB par défaut
     retention_policy = Column(Text, default='{"daily": 30, "weekly": 12, "monthly": 12}')
+    used_bytes = Column(BigInteger, default=0, nullable=False)  # Compteur d'usage tenu à jour de façon incrémentale
+    preemptions = Column(Integer, default=0, nullable=False)  # Jobs interrompus au profit d'une restauration
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Relations
@@ -56,6 +58,8 @@ class Agent(Base):
     last_seen = Column(DateTime, default=datetime.utcnow)
     config = Column(Text)  # Configuration JSON de l'agent
     status = Column(String(50), default="active")  # active, inactive, error
+    compression = Column(String(64))  # Spécification --compression recommandée (ex: zstd,3)
+    compression_updated_at = Column(DateTime)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Relations
@@ -69,17 +73,21 @@ class Job(Base):
     id = Column(Integer, primary_key=True, index=True)
     agent_id = Column(Integer, ForeignKey("agents.id"), nullable=False)
     type = Column(String(50), nullable=False)  # backup, restore, check
-    status = Column(String(50), default="pending")  # pending, running, completed, failed
+    status = Column(String(50), default="pending")  # pending, running, completed, failed, cancelled
     started_at = Column(DateTime)
     finished_at = Column(DateTime)
     snapshot_id = Column(Integer, ForeignKey("snapshots.id"), nullable=True)
     error_message = Column(Text)
+    progress = Column(Integer, default=0)  # Avancement en pourcentage
     config = Column(Text)  # Configuration spécifique du job
+    attempts = Column(Integer, default=0)  # Nombre d'exécutions (reprises comprises)
+    worker_id = Column(String(255))  # Worker détenant le bail d'exécution
+    lease_expires_at = Column(DateTime)  # Échéance du bail, prolongée par le heartbeat
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Relations
     agent = relationship("Agent", back_populates="jobs")
-    snapshot = relationship("Snapshot", back_populates="job")
+    snapshot = relationship("Snapshot", foreign_keys=[snapshot_id])
 
 class Snapshot(Base):
     """Table des snapshots/archives"""
@@ -88,14 +96,48 @@ class Snapshot(Base):
     id = Column(Integer, primary_key=True, index=True)
     job_id = Column(Integer, ForeignKey("jobs.id"), nullable=False)
     name = Column(String(255), nullable=False)  # Nom du snapshot Borg
-    repo_path = Column(String(512), nullable=False)  # Chemin du repository
+    repo_path = Column(String(512), nullable=False, index=True)  # Chemin du repository
     size_bytes = Column(BigInteger, default=0)
+    excluded_bytes = Column(BigInteger)  # Octets écartés par les exclusions (mesurés par l'agent)
     is_full = Column(Boolean, default=True)
     checksum = Column(String(128))
+    missing_since = Column(DateTime)  # Archive absente du repository (constaté par réconciliation)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Relations
-    job = relationship("Job", back_populates="snapshot")
+    job = relationship("Job", foreign_keys=[job_id])
+
+class RepoVerification(Base):
+    """État de la vérification tournante (borg check partiel) d'un repository"""
+    __tablename__ = "repo_verifications"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    agent_id = Column(Integer, ForeignKey("agents.id"), nullable=False)
+    repo_path = Column(String(512), unique=True, nullable=False)
+    position = Column(Float, default=0.0)  # Fraction du repository vérifiée dans le cycle courant
+    cycle_started_at = Column(DateTime, default=datetime.utcnow)
+    last_check_at = Column(DateTime)
+    last_full_verified_at = Column(DateTime)
+    throughput_bytes = Column(Float, default=0.0)  # Débit de vérification (octets/s) du dernier passage
+    
+    # Relations
+    agent = relationship("Agent")
+
+class ReplicationState(Base):
+    """Filigrane de réplication hors site d'un repository"""
+    __tablename__ = "replication_states"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    agent_id = Column(Integer, ForeignKey("agents.id"), nullable=False)
+    repo_path = Column(String(512), unique=True, nullable=False)
+    target = Column(String(512))  # Destination de la dernière réplication
+    watermark_snapshot_id = Column(Integer)  # Dernier snapshot présent sur la copie hors site
+    watermark_at = Column(DateTime)  # Date de création de ce snapshot
+    last_replicated_at = Column(DateTime)
+    last_transfer_bytes = Column(BigInteger, default=0)
+    
+    # Relations
+    agent = relationship("Agent")
 
 def get_db():
     """Générateur de session de base de données"""
@@ -105,6 +147,39 @@ def get_db():
     finally:
         db.close()
 
+# Colonnes ajoutées à des tables existantes, que create_all ne modifie pas:
+# (table, colonne, type SQL avec défaut), appliquées par upgrade_schema au démarrage
+SCHEMA_UPGRADES = [
+    # Rattrapé ensuite par la réconciliation des quotas
+    ("tenants", "used_bytes", "BIGINT NOT NULL DEFAULT 0"),
+    ("jobs", "progress", "INTEGER DEFAULT 0"),
+    ("agents", "compression", "VARCHAR(64)"),
+    ("agents", "compression_updated_at", "TIMESTAMP"),
+    ("snapshots", "missing_since", "TIMESTAMP"),
+    ("jobs", "attempts", "INTEGER DEFAULT 0"),
+    ("jobs", "worker_id", "VARCHAR(255)"),
+    ("jobs", "lease_expires_at", "TIMESTAMP"),
+    ("tenants", "preemptions", "INTEGER NOT NULL DEFAULT 0"),
+    ("snapshots", "excluded_bytes", "BIGINT"),
+]
+# Index ajoutés après coup: (nom, table, colonne)
+INDEX_UPGRADES = [
+    ("ix_snapshots_repo_path", "snapshots", "repo_path"),
+]
+
+def upgrade_schema(bind=engine):
+    """Ajoute aux tables déjà créées les colonnes et index apparus depuis (idempotent)"""
+    inspector = inspect(bind)
+    tables = set(inspector.get_table_names())
+    with bind.begin() as conn:
+        for table, column, ddl in SCHEMA_UPGRADES:
+            if table in tables and column not in {c['name'] for c in inspector.get_columns(table)}:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+        for name, table, column in INDEX_UPGRADES:
+            if table in tables and name not in {i['name'] for i in inspector.get_indexes(table)}:
+                conn.execute(text(f"CREATE INDEX {name} ON {table} ({column})"))
+
 def create_tables():
-    """Créer toutes les tables"""
-    Base.metadata.create_all(bind=engine)
\ No newline at end of file
+    """Créer toutes les tables, puis mettre à niveau celles qui existaient déjà"""
+    Base.metadata.create_all(bind=engine)
+    upgrade_schema()
\ No newline at end of file
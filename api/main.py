@@ -7,21 +7,41 @@ Licensed under GNU Affero General Public License v3.0 (AGPL-3.0)
 See LICENSE file for details.
 """
 import os
-from fastapi import FastAPI, Depends, HTTPException, status
+import time
+from fastapi import FastAPI, Depends, HTTPException, Header, Query, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
+from fastapi.responses import Response, StreamingResponse, FileResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import func, update, case
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Dict, Any, Optional, Tuple
 from datetime import datetime
+from urllib.parse import quote
 import json
+from prometheus_client import CollectorRegistry, Gauge, generate_latest, CONTENT_TYPE_LATEST
 
-from api.database import get_db, create_tables, Agent, Job, Snapshot, Tenant
+from api.database import get_db, create_tables, Agent, Job, Snapshot, Tenant, RepoVerification, ReplicationState
 from api.schemas import (
     AgentRegister, AgentResponse, AgentHeartbeat, AgentStats,
-    JobCreate, JobResponse, SnapshotResponse
+    JobCreate, JobResponse, SnapshotResponse, JobType, CatalogMatch,
+    DirectoryListing, RestoreCreate, RepositoryInfo, AgentJobSpec, AgentJobProgress, AgentJobReport,
+    RelayedHeartbeat, HeartbeatBatch, HeartbeatBatchResult
+)
+from api.auth import AuthManager, get_current_agent, get_current_relay
+from worker.tasks import enqueue_backup_job, resolve_repository, BorgManager
+from worker.catalog import catalog_path, search_catalog, ensure_listing, list_directory, path_stats
+from worker.diffs import diff_cache_path, stream_diff, iter_cached_diff
+from worker.restore import enqueue_restore_job, restore_staging_dir, restore_target_dir
+from worker.object_store import refresh_repository
+from worker import repo_cache
+from worker.replication import replication_lag
+from worker.cancellation import request_interrupt, INTERRUPTIBLE_TYPES
+from worker.preemption import preempt_for_restore
+from worker.object_store import REPO_STORAGE
+from worker.agent_jobs import (
+    AGENT_REPO_URL, pending_agent_jobs, start_agent_job, renew_agent_job, complete_agent_job,
+    notify_agent, wait_for_wakeup, job_log, job_config
 )
-from api.auth import AuthManager, get_current_agent
-from worker.tasks import enqueue_backup_job
 
 # Configuration
 API_VERSION = "v1"
@@ -60,6 +80,74 @@ async def metrics():
     # TODO: Implémenter les métriques Prometheus
     return {"agents_total": 0, "jobs_total": 0}
 
+def render_repository_metrics(db: Session) -> bytes:
+    """Métriques Prometheus des repositories (vérification tournante, réplication hors site) et des préemptions"""
+    registry = CollectorRegistry()
+    coverage = Gauge(
+        'saveos_repo_verification_coverage',
+        "Fraction du repository vérifiée dans le cycle courant",
+        ['repo'], registry=registry
+    )
+    throughput = Gauge(
+        'saveos_repo_verification_throughput_bytes',
+        "Débit de vérification du dernier passage (octets/s)",
+        ['repo'], registry=registry
+    )
+    last_full = Gauge(
+        'saveos_repo_last_full_verification_timestamp_seconds',
+        "Horodatage de la dernière vérification complète",
+        ['repo'], registry=registry
+    )
+
+    for state in db.query(RepoVerification).all():
+        coverage.labels(repo=state.repo_path).set(state.position or 0.0)
+        throughput.labels(repo=state.repo_path).set(state.throughput_bytes or 0.0)
+        if state.last_full_verified_at:
+            last_full.labels(repo=state.repo_path).set(
+                (state.last_full_verified_at - datetime(1970, 1, 1)).total_seconds()
+            )
+
+    replication_lag_seconds = Gauge(
+        'saveos_repo_replication_lag_seconds',
+        "Âge du plus ancien snapshot absent de la copie hors site",
+        ['repo'], registry=registry
+    )
+    replication_bytes = Gauge(
+        'saveos_repo_replication_last_transfer_bytes',
+        "Volume transféré par la dernière réplication",
+        ['repo'], registry=registry
+    )
+
+    missing_snapshots = Gauge(
+        'saveos_repo_snapshots_missing',
+        "Snapshots en base dont l'archive n'existe plus dans le repository",
+        ['repo'], registry=registry
+    )
+    for repo_path, count in db.query(Snapshot.repo_path, func.count(Snapshot.id)).filter(
+        Snapshot.missing_since.isnot(None)
+    ).group_by(Snapshot.repo_path).all():
+        missing_snapshots.labels(repo=repo_path).set(count)
+
+    now = datetime.utcnow()
+    for state in db.query(ReplicationState).all():
+        replication_lag_seconds.labels(repo=state.repo_path).set(replication_lag(db, state, now))
+        replication_bytes.labels(repo=state.repo_path).set(state.last_transfer_bytes or 0)
+
+    preemptions = Gauge(
+        'saveos_tenant_preemptions_total',
+        "Jobs du tenant interrompus au profit d'une restauration",
+        ['tenant'], registry=registry
+    )
+    for tenant_id, count in db.query(Tenant.id, Tenant.preemptions).all():
+        preemptions.labels(tenant=str(tenant_id)).set(count or 0)
+
+    return generate_latest(registry)
+
+@app.get("/metrics/repositories")
+async def repository_metrics(db: Session = Depends(get_db)):
+    """Vérification et réplication par repository (format Prometheus)"""
+    return Response(content=render_repository_metrics(db), media_type=CONTENT_TYPE_LATEST)
+
 # === ENDPOINTS AGENTS ===
 
 @app.post(f"{API_PREFIX}/agents/register", response_model=AgentResponse)
@@ -139,7 +227,46 @@ async def agent_heartbeat(
     
     db.commit()
     
-    return {"message": "Heartbeat reçu", "timestamp": datetime.utcnow()}
+    return {"message": "Heartbeat reçu", "agent_id": current_agent.id, "timestamp": datetime.utcnow()}
+
+def apply_heartbeat_batch(db: Session, heartbeats: List[RelayedHeartbeat],
+                          now: Optional[datetime] = None) -> Dict[str, Any]:
+    """Applique un lot de heartbeats: une requête pour les jetons, un seul UPDATE pour les agents"""
+    now = now or datetime.utcnow()
+    hashed = [AuthManager.hash_token(heartbeat.token) for heartbeat in heartbeats]
+    
+    agent_ids = dict(
+        (token, agent_id) for agent_id, token in
+        db.query(Agent.id, Agent.token).filter(Agent.token.in_(set(hashed))).all()
+    )
+    # Le dernier heartbeat d'un agent dans le lot l'emporte
+    statuses = {
+        agent_ids[token]: heartbeat.status.value
+        for token, heartbeat in zip(hashed, heartbeats) if token in agent_ids
+    }
+    
+    if statuses:
+        db.execute(
+            update(Agent)
+            .where(Agent.id.in_(statuses.keys()))
+            .values(last_seen=now, status=case(statuses, value=Agent.id))
+        )
+        db.commit()
+    
+    return {
+        'accepted': len(statuses),
+        'rejected': [index for index, token in enumerate(hashed) if token not in agent_ids]
+    }
+
+@app.post(f"{API_PREFIX}/agents/heartbeats/batch", response_model=HeartbeatBatchResult)
+async def agent_heartbeat_batch(
+    batch: HeartbeatBatch,
+    relay: str = Depends(get_current_relay),
+    db: Session = Depends(get_db)
+):
+    """Heartbeats de nombreux agents transmis en une requête par un relais de confiance"""
+    
+    return apply_heartbeat_batch(db, batch.heartbeats)
 
 @app.get(f"{API_PREFIX}/agents/stats", response_model=AgentStats)
 async def get_agent_stats(
@@ -148,13 +275,13 @@ async def get_agent_stats(
 ):
     """Récupère les statistiques de l'agent"""
     
-    # Compter les snapshots
-    snapshots = db.query(Snapshot).join(Job).filter(
+    # Compter les snapshots (agrégat SQL, sans charger les lignes)
+    total_snapshots, total_size_bytes = db.query(
+        func.count(Snapshot.id),
+        func.coalesce(func.sum(Snapshot.size_bytes), 0)
+    ).join(Job, Snapshot.job_id == Job.id).filter(
         Job.agent_id == current_agent.id
-    ).all()
-    
-    total_snapshots = len(snapshots)
-    total_size_bytes = sum(s.size_bytes for s in snapshots)
+    ).one()
     
     # Dernière sauvegarde
     last_job = db.query(Job).filter(
@@ -174,6 +301,26 @@ async def get_agent_stats(
 
 # === ENDPOINTS JOBS ===
 
+def check_tenant_quota(db: Session, agent: Agent, job_config: Dict[str, Any]):
+    """Refuse un job si le compteur d'usage du tenant (plus l'estimation éventuelle) dépasse le quota"""
+    
+    tenant = db.query(Tenant).filter(Tenant.id == agent.tenant_id).first()
+    if not tenant or not tenant.quota_bytes:
+        return
+    
+    # Estimation pré-vol fournie par l'agent, sinon on vérifie seulement l'usage courant
+    try:
+        estimated_bytes = max(int(job_config.get('estimated_bytes', 0)), 0)
+    except (TypeError, ValueError):
+        estimated_bytes = 0
+    
+    used_bytes = tenant.used_bytes or 0
+    if used_bytes + estimated_bytes > tenant.quota_bytes:
+        raise HTTPException(
+            status_code=status.HTTP_507_INSUFFICIENT_STORAGE,
+            detail=f"Quota dépassé: {used_bytes + estimated_bytes} / {tenant.quota_bytes} octets"
+        )
+
 @app.post(f"{API_PREFIX}/backup", response_model=JobResponse)
 async def create_backup_job(
     job_data: JobCreate,
@@ -189,11 +336,23 @@ async def create_backup_job(
             detail="Un agent ne peut créer des jobs que pour lui-même"
         )
     
+    # Vérifier le quota avant d'admettre une sauvegarde
+    if job_data.type == JobType.BACKUP:
+        check_tenant_quota(db, current_agent, job_data.config or {})
+    
+    # Sauvegarde exécutée par l'agent: borg 1.x n'écrit pas directement dans un bucket
+    on_agent = (job_data.config or {}).get('execution') == 'agent'
+    if on_agent and (job_data.type != JobType.BACKUP or not AGENT_REPO_URL or REPO_STORAGE == 's3'):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Exécution par l'agent indisponible (sauvegardes uniquement, AGENT_REPO_URL requis, stockage local)"
+        )
+    
     # Créer le job
     new_job = Job(
         agent_id=current_agent.id,
         type=job_data.type.value,
-        config=str(job_data.config) if job_data.config else None,
+        config=json.dumps(job_data.config) if job_data.config else None,
         status="pending"
     )
     
@@ -201,6 +360,11 @@ async def create_backup_job(
     db.commit()
     db.refresh(new_job)
     
+    # L'agent récupérera lui-même le job (sa requête d'attente est réveillée)
+    if on_agent:
+        notify_agent(current_agent.id)
+        return new_job
+    
     # Envoyer le job dans la queue Redis
     try:
         enqueue_backup_job(new_job.id)
@@ -216,6 +380,70 @@ async def create_backup_job(
     
     return new_job
 
+@app.post(f"{API_PREFIX}/restore", response_model=JobResponse)
+async def create_restore_job(
+    restore_data: RestoreCreate,
+    current_agent: Agent = Depends(get_current_agent),
+    db: Session = Depends(get_db)
+):
+    """Lance un job de restauration (extraction parallèle de chemins d'un snapshot)"""
+    
+    if restore_data.agent_id != current_agent.id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Un agent ne peut créer des jobs que pour lui-même"
+        )
+    
+    snapshot = get_agent_snapshot(db, restore_data.snapshot_id, current_agent)
+    
+    if restore_data.mode.value == "target":
+        if not restore_data.target_dir:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Un répertoire cible est requis en mode target"
+            )
+        try:
+            restore_target_dir(current_agent.id, restore_data.target_dir)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    
+    new_job = Job(
+        agent_id=current_agent.id,
+        type=JobType.RESTORE.value,
+        snapshot_id=snapshot.id,
+        config=json.dumps({
+            'snapshot_id': snapshot.id,
+            'paths': restore_data.paths,
+            'mode': restore_data.mode.value,
+            'target_dir': restore_data.target_dir,
+            'parallelism': restore_data.parallelism
+        }),
+        status="pending"
+    )
+    
+    db.add(new_job)
+    db.commit()
+    db.refresh(new_job)
+    
+    try:
+        enqueue_restore_job(new_job.id)
+    except Exception as e:
+        new_job.status = "failed"
+        new_job.error_message = f"Erreur lors de l'ajout à la queue: {str(e)}"
+        db.commit()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Erreur lors de la création du job"
+        )
+    
+    # Tous les workers occupés: un job moins prioritaire cède sa place (n'échoue pas la demande)
+    try:
+        preempt_for_restore(db)
+    except Exception as e:
+        print(f"Préemption impossible pour la restauration {new_job.id}: {e}")
+    
+    return new_job
+
 @app.get(f"{API_PREFIX}/backup/{{agent_id}}/snapshots", response_model=List[SnapshotResponse])
 async def list_agent_snapshots(
     agent_id: int,
@@ -232,12 +460,287 @@ async def list_agent_snapshots(
         )
     
     # Récupérer les snapshots
-    snapshots = db.query(Snapshot).join(Job).filter(
+    snapshots = db.query(Snapshot).join(Job, Snapshot.job_id == Job.id).filter(
         Job.agent_id == agent_id
     ).order_by(Snapshot.created_at.desc()).all()
     
     return snapshots
 
+def repository_metadata(borg: BorgManager) -> Dict[str, Any]:
+    """Archives et statistiques d'un repository, sans toucher au repository si le cache est à jour"""
+    if not (repo_cache.get(borg.repo_path, 'archives') and repo_cache.get(borg.repo_path, 'info')):
+        refresh_repository(borg.repo_path)
+    return {'archives': borg.list_archives(), 'info': borg.repo_info()}
+
+@app.get(f"{API_PREFIX}/backup/{{agent_id}}/repository", response_model=RepositoryInfo)
+async def get_agent_repository(
+    agent_id: int,
+    current_agent: Agent = Depends(get_current_agent),
+    db: Session = Depends(get_db)
+):
+    """Archives et volumes (total, dédupliqué) du repository d'un agent"""
+    
+    if agent_id != current_agent.id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Un agent ne peut consulter que son propre repository"
+        )
+    
+    repo = resolve_repository(db, current_agent)
+    if not os.path.exists(repo['repo_path']) and not repo_cache.get(repo['repo_path'], 'info'):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Aucun repository pour cet agent"
+        )
+    
+    borg = BorgManager(repo['repo_path'], repo['passphrase'])
+    metadata = await run_in_threadpool(repository_metadata, borg)
+    archives, info = metadata['archives'], metadata['info']
+    
+    if not archives['success'] or not info['success']:
+        failed = archives if not archives['success'] else info
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erreur borg: {failed.get('stderr', failed.get('error', '')).strip()}"
+        )
+    
+    return RepositoryInfo(
+        repo_path=repo['repo_path'],
+        manifest=info.get('manifest'),
+        archives=[
+            {'name': a.get('name', a.get('archive', '')), 'id': a.get('id'), 'start': a.get('start')}
+            for a in archives['archives']
+        ],
+        stats=info['stats'],
+        cached=bool(archives.get('cached') and info.get('cached'))
+    )
+
+@app.get(f"{API_PREFIX}/backup/{{agent_id}}/search", response_model=List[CatalogMatch])
+async def search_agent_files(
+    agent_id: int,
+    q: str = Query(..., min_length=1),
+    mode: str = Query("glob", pattern="^(glob|substring)$"),
+    limit: int = Query(100, ge=1, le=1000),
+    current_agent: Agent = Depends(get_current_agent),
+    db: Session = Depends(get_db)
+):
+    """Recherche un fichier dans les catalogues des snapshots d'un agent (sans accès au repository)"""
+    
+    if agent_id != current_agent.id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Un agent ne peut consulter que ses propres snapshots"
+        )
+    
+    snapshots = db.query(Snapshot.id, Snapshot.name).join(Job, Snapshot.job_id == Job.id).filter(
+        Job.agent_id == agent_id
+    ).order_by(Snapshot.created_at.desc()).all()
+    
+    # Parcours du plus récent au plus ancien jusqu'à atteindre la limite
+    matches = []
+    for snapshot_id, snapshot_name in snapshots:
+        for entry in search_catalog(catalog_path(snapshot_id), q, mode, limit - len(matches)):
+            matches.append(CatalogMatch(snapshot_id=snapshot_id, snapshot_name=snapshot_name, **entry))
+        if len(matches) >= limit:
+            break
+    
+    return matches
+
+# === ENDPOINTS SNAPSHOTS ===
+
+def get_agent_snapshot(db: Session, snapshot_id: int, agent: Agent) -> Snapshot:
+    """Récupère un snapshot en vérifiant qu'il appartient à l'agent"""
+    
+    snapshot = db.query(Snapshot).filter(Snapshot.id == snapshot_id).first()
+    
+    if not snapshot:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Snapshot non trouvé"
+        )
+    
+    if snapshot.job.agent_id != agent.id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Un agent ne peut consulter que ses propres snapshots"
+        )
+    
+    return snapshot
+
+@app.get(f"{API_PREFIX}/snapshots/{{snapshot_a}}/diff/{{snapshot_b}}")
+async def diff_snapshots(
+    snapshot_a: int,
+    snapshot_b: int,
+    current_agent: Agent = Depends(get_current_agent),
+    db: Session = Depends(get_db)
+):
+    """Différences entre deux snapshots en NDJSON (added/removed/modified), mises en cache par paire"""
+    
+    first = get_agent_snapshot(db, snapshot_a, current_agent)
+    second = get_agent_snapshot(db, snapshot_b, current_agent)
+    
+    if first.repo_path != second.repo_path:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Les snapshots doivent appartenir au même repository"
+        )
+    
+    cache_file = diff_cache_path(first.id, second.id)
+    if os.path.exists(cache_file):
+        return StreamingResponse(iter_cached_diff(cache_file), media_type="application/x-ndjson")
+    
+    repo = resolve_repository(db, current_agent)
+    borg = BorgManager(first.repo_path, repo['passphrase'])
+    await run_in_threadpool(refresh_repository, first.repo_path)
+    
+    return StreamingResponse(
+        stream_diff(borg.iter_diff(first.name, second.name), cache_file),
+        media_type="application/x-ndjson"
+    )
+
+def archive_items(borg: BorgManager, archive_name: str):
+    """Contenu d'une archive, lu sur une copie du repository rafraîchie depuis le stockage objet"""
+    refresh_repository(borg.repo_path)
+    return borg.iter_archive_items(archive_name)
+
+@app.get(f"{API_PREFIX}/snapshots/{{snapshot_id}}/tree", response_model=DirectoryListing)
+async def browse_snapshot(
+    snapshot_id: int,
+    path: str = "",
+    current_agent: Agent = Depends(get_current_agent),
+    db: Session = Depends(get_db)
+):
+    """Liste un niveau de répertoire d'un snapshot (un seul borg list par archive, puis cache)"""
+    
+    snapshot = get_agent_snapshot(db, snapshot_id, current_agent)
+    repo = resolve_repository(db, current_agent)
+    borg = BorgManager(snapshot.repo_path, repo['passphrase'])
+    
+    try:
+        # Peut lancer un borg list complet la première fois: hors de la boucle événementielle
+        listing = await run_in_threadpool(
+            ensure_listing, snapshot.id, lambda: archive_items(borg, snapshot.name)
+        )
+        entries = await run_in_threadpool(list_directory, listing, path)
+    except RuntimeError as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erreur lors du listing de l'archive: {str(e).strip()}"
+        )
+    
+    if entries is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Répertoire non trouvé dans le snapshot"
+        )
+    
+    return DirectoryListing(snapshot_id=snapshot.id, path=path.strip('/'), entries=entries)
+
+def parse_range_header(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Parse un en-tête Range à plage unique en (début, fin) inclusifs, None si absent"""
+    
+    if not range_header:
+        return None
+    
+    unit, _, spec = range_header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None  # Plages multiples non gérées: réponse complète
+    
+    start_str, _, end_str = spec.strip().partition('-')
+    try:
+        if start_str:
+            start = int(start_str)
+            end = int(end_str) if end_str else size - 1
+        else:
+            # bytes=-N: les N derniers octets
+            start = max(size - int(end_str), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    
+    if start > end or start >= size:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail="Plage demandée invalide",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    
+    return start, min(end, size - 1)
+
+@app.get(f"{API_PREFIX}/snapshots/{{snapshot_id}}/download")
+async def download_from_snapshot(
+    snapshot_id: int,
+    path: str = Query(..., min_length=1),
+    range_header: Optional[str] = Header(None, alias="Range"),
+    current_agent: Agent = Depends(get_current_agent),
+    db: Session = Depends(get_db)
+):
+    """Télécharge un fichier (avec support Range) ou un répertoire en tar, relayé directement depuis borg"""
+    
+    snapshot = get_agent_snapshot(db, snapshot_id, current_agent)
+    repo = resolve_repository(db, current_agent)
+    borg = BorgManager(snapshot.repo_path, repo['passphrase'])
+    await run_in_threadpool(refresh_repository, snapshot.repo_path)
+    
+    try:
+        listing = await run_in_threadpool(
+            ensure_listing, snapshot.id, lambda: borg.iter_archive_items(snapshot.name)
+        )
+        stats = await run_in_threadpool(path_stats, listing, path)
+    except RuntimeError as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erreur lors du listing de l'archive: {str(e).strip()}"
+        )
+    
+    if not stats:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Chemin non trouvé dans le snapshot"
+        )
+    
+    item_path = path.strip('/')
+    name = os.path.basename(item_path) or snapshot.name
+    
+    # Sous-arborescence: archive tar produite à la volée
+    if stats['type'] == 'd':
+        return StreamingResponse(
+            borg.iter_tar(snapshot.name, [item_path] if item_path else []),
+            media_type="application/x-tar",
+            headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(name)}.tar"}
+        )
+    
+    if stats['type'] != '-':
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Seuls les fichiers et répertoires peuvent être téléchargés"
+        )
+    
+    size = stats['size']
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f"attachment; filename*=UTF-8''{quote(name)}"
+    }
+    
+    byte_range = parse_range_header(range_header, size)
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(
+            borg.iter_file(snapshot.name, item_path),
+            media_type="application/octet-stream",
+            headers=headers
+        )
+    
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        borg.iter_file(snapshot.name, item_path, start, end - start + 1),
+        status_code=status.HTTP_206_PARTIAL_CONTENT,
+        media_type="application/octet-stream",
+        headers=headers
+    )
+
 @app.get(f"{API_PREFIX}/jobs/{{job_id}}", response_model=JobResponse)
 async def get_job_status(
     job_id: int,
@@ -263,6 +766,253 @@ async def get_job_status(
     
     return job
 
+@app.post(f"{API_PREFIX}/jobs/{{job_id}}/cancel", response_model=JobResponse)
+async def cancel_job(
+    job_id: int,
+    current_agent: Agent = Depends(get_current_agent),
+    db: Session = Depends(get_db)
+):
+    """Annule un job: immédiatement s'il est en attente, sinon le worker interrompt borg"""
+    
+    job = db.query(Job).filter(Job.id == job_id).first()
+    
+    if not job:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job non trouvé"
+        )
+    
+    if job.agent_id != current_agent.id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Un agent ne peut annuler que ses propres jobs"
+        )
+    
+    if job.status in ("completed", "failed", "cancelled"):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Job déjà terminé ({job.status})"
+        )
+    
+    if job.status == "running" and job.type not in INTERRUPTIBLE_TYPES:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Un job {job.type} en cours ne peut pas être interrompu"
+        )
+    
+    # La demande est aussi déposée pour un job en attente: un worker peut être en train de le démarrer
+    request_interrupt(job.id, 'cancel')
+    if job.status == "pending":
+        job.status = "cancelled"
+        job.error_message = "Annulé à la demande"
+        job.finished_at = datetime.utcnow()
+        db.commit()
+        db.refresh(job)
+    
+    return job
+
+def get_agent_job(db: Session, job_id: int, agent: Agent) -> Job:
+    """Récupère un job en vérifiant qu'il appartient à l'agent"""
+    
+    job = db.query(Job).filter(Job.id == job_id).first()
+    
+    if not job:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job non trouvé"
+        )
+    
+    if job.agent_id != agent.id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Un agent ne peut consulter que ses propres jobs"
+        )
+    
+    return job
+
+@app.get(f"{API_PREFIX}/agents/me/jobs", response_model=List[JobResponse])
+async def list_agent_jobs(
+    wait: int = Query(0, ge=0, le=120, description="Attente maximale (s) d'un job si aucun n'est en attente"),
+    current_agent: Agent = Depends(get_current_agent),
+    db: Session = Depends(get_db)
+):
+    """Jobs en attente que l'agent doit exécuter lui-même (long-poll avec wait)"""
+    
+    deadline = time.monotonic() + wait
+    while True:
+        jobs = pending_agent_jobs(db, current_agent)
+        remaining = deadline - time.monotonic()
+        if jobs or remaining <= 0:
+            return jobs
+        
+        # La connexion à la base est rendue au pool pendant l'attente
+        db.rollback()
+        try:
+            if not await wait_for_wakeup(current_agent.id, remaining):
+                return []
+        except Exception:
+            return []  # Redis indisponible: l'agent refera une requête
+
+@app.post(f"{API_PREFIX}/jobs/{{job_id}}/start", response_model=AgentJobSpec)
+async def start_job_on_agent(
+    job_id: int,
+    current_agent: Agent = Depends(get_current_agent),
+    db: Session = Depends(get_db)
+):
+    """Démarre un job exécuté par l'agent et lui transmet le repository cible"""
+    
+    job = get_agent_job(db, job_id, current_agent)
+    
+    if job not in pending_agent_jobs(db, current_agent):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Job non disponible pour l'agent ({job.status})"
+        )
+    
+    spec = start_agent_job(db, job, current_agent)
+    if spec is None:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Repository occupé par un autre job, nouvel essai plus tard"
+        )
+    return spec
+
+@app.post(f"{API_PREFIX}/jobs/{{job_id}}/heartbeat")
+async def job_heartbeat(
+    job_id: int,
+    progress: AgentJobProgress,
+    current_agent: Agent = Depends(get_current_agent),
+    db: Session = Depends(get_db)
+):
+    """Prolonge le bail d'un job exécuté par l'agent; la réponse signale une annulation
+    
+    Avec `estimated_bytes`, la réponse porte `error` si l'estimation dépasse le quota:
+    l'agent ne lance pas borg et rend compte de l'échec.
+    """
+    
+    job = get_agent_job(db, job_id, current_agent)
+    
+    if job.status != "running":
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Job non démarré ({job.status})"
+        )
+    
+    renewal = renew_agent_job(db, job, progress.progress, progress.log)
+    
+    # Estimation pré-vol du daemon: même contrôle de quota qu'à la création d'un job
+    if progress.estimated_bytes is not None:
+        config = job_config(job)
+        config['estimated_bytes'] = progress.estimated_bytes
+        job.config = json.dumps(config)
+        db.commit()
+        try:
+            check_tenant_quota(db, current_agent, config)
+        except HTTPException as e:
+            renewal['error'] = e.detail
+    
+    return renewal
+
+@app.get(f"{API_PREFIX}/jobs/{{job_id}}/log", response_model=List[str])
+async def get_job_log(
+    job_id: int,
+    current_agent: Agent = Depends(get_current_agent),
+    db: Session = Depends(get_db)
+):
+    """Dernières lignes du journal envoyé par l'agent pendant l'exécution du job"""
+    
+    get_agent_job(db, job_id, current_agent)
+    return job_log(job_id)
+
+@app.post(f"{API_PREFIX}/jobs/{{job_id}}/report", response_model=JobResponse)
+async def report_job(
+    job_id: int,
+    report: AgentJobReport,
+    current_agent: Agent = Depends(get_current_agent),
+    db: Session = Depends(get_db)
+):
+    """Compte rendu d'un job exécuté par l'agent (statistiques borg en cas de succès)"""
+    
+    job = get_agent_job(db, job_id, current_agent)
+    
+    # Un compte rendu gardé par l'agent pendant une panne de l'API peut arriver après que
+    # le bail a expiré: le job, déjà démarré, a seulement été remis en attente
+    late = job.status == "pending" and job_config(job).get('archive_name')
+    if job.status != "running" and not late:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Job non démarré ({job.status})"
+        )
+    
+    complete_agent_job(db, job, current_agent, report.model_dump())
+    db.refresh(job)
+    return job
+
+def get_restore_parts(db: Session, job_id: int, agent: Agent) -> List[str]:
+    """Retourne les archives préparées d'une restauration agent_pull terminée"""
+    
+    job = db.query(Job).filter(Job.id == job_id).first()
+    
+    if not job or job.type != JobType.RESTORE.value:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job de restauration non trouvé"
+        )
+    
+    if job.agent_id != agent.id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Un agent ne peut consulter que ses propres jobs"
+        )
+    
+    if job.status != "completed":
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="La restauration n'est pas terminée"
+        )
+    
+    config = json.loads(job.config) if job.config else {}
+    return config.get('parts', [])
+
+@app.get(f"{API_PREFIX}/jobs/{{job_id}}/restore/parts")
+async def list_restore_parts(
+    job_id: int,
+    current_agent: Agent = Depends(get_current_agent),
+    db: Session = Depends(get_db)
+):
+    """Liste les archives tar préparées pour une restauration agent_pull"""
+    
+    parts = get_restore_parts(db, job_id, current_agent)
+    staging = restore_staging_dir(job_id)
+    
+    return {
+        "parts": [
+            {"index": index, "size_bytes": os.path.getsize(os.path.join(staging, part))}
+            for index, part in enumerate(parts)
+            if os.path.exists(os.path.join(staging, part))
+        ]
+    }
+
+@app.get(f"{API_PREFIX}/jobs/{{job_id}}/restore/parts/{{index}}")
+async def download_restore_part(
+    job_id: int,
+    index: int,
+    current_agent: Agent = Depends(get_current_agent),
+    db: Session = Depends(get_db)
+):
+    """Télécharge une archive tar préparée (les agents en récupèrent plusieurs en parallèle)"""
+    
+    parts = get_restore_parts(db, job_id, current_agent)
+    path = os.path.join(restore_staging_dir(job_id), parts[index]) if 0 <= index < len(parts) else None
+    
+    if not path or not os.path.exists(path):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Archive de restauration non trouvée ou expirée"
+        )
+    
+    return FileResponse(path, media_type="application/x-tar", filename=f"restore-{job_id}-{index}.tar")
+
 # === ENDPOINTS TÉLÉCHARGEMENT D'AGENTS ===
 
 @app.get("/download/agent/{platform}")
@@ -348,6 +1098,7 @@ def generate_agent_package(platform: str) -> bytes:
 SaveOS Agent - Client de sauvegarde
 """
 import os
+import time
 import sys
 import json
 import requests
@@ -1,21 +1,25 @@
 """
 Schémas Pydantic pour l'API SaveOS
 """
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 from enum import Enum
 
 class JobType(str, Enum):
     BACKUP = "backup"
     RESTORE = "restore" 
     CHECK = "check"
+    PRUNE = "prune"
+    REPLICATE = "replicate"
+    RECONCILE = "reconcile"
 
 class JobStatus(str, Enum):
     PENDING = "pending"
     RUNNING = "running"
     COMPLETED = "completed"
     FAILED = "failed"
+    CANCELLED = "cancelled"
 
 class AgentStatus(str, Enum):
     ACTIVE = "active"
@@ -35,6 +39,7 @@ class AgentResponse(BaseModel):
     token: str
     status: AgentStatus
     last_seen: datetime
+    compression: Optional[str] = None
     created_at: datetime
     
     class Config:
@@ -55,11 +60,49 @@ class JobResponse(BaseModel):
     finished_at: Optional[datetime]
     snapshot_id: Optional[int]
     error_message: Optional[str]
+    progress: Optional[int] = None
     created_at: datetime
     
     class Config:
         from_attributes = True
 
+# Schémas pour les jobs exécutés par les agents
+class AgentJobSpec(BaseModel):
+    job_id: int
+    type: JobType
+    repository: str  # URL borg du repository central (borg serve via SSH)
+    passphrase: str
+    archive_name: str
+    source_paths: List[str]
+    compression: Optional[str] = None
+    exclude_patterns: List[str] = []  # Motifs sh: de borg fixés côté serveur, ajoutés à ceux de l'agent
+    checkpoint_interval: int
+    lease_ttl: int
+
+class AgentJobProgress(BaseModel):
+    progress: Optional[int] = None
+    log: List[str] = []  # Lignes de journal de borg depuis le précédent heartbeat
+    estimated_bytes: Optional[int] = None  # Estimation pré-vol envoyée avant de lancer borg
+
+class AgentJobReport(BaseModel):
+    success: bool
+    cancelled: bool = False
+    skipped: bool = False  # Aucune modification depuis le dernier snapshot: pas d'archive
+    stats: Optional[Dict[str, Any]] = {}
+    error: Optional[str] = None
+
+class RestoreMode(str, Enum):
+    TARGET = "target"  # Extraction par le worker dans un répertoire cible
+    AGENT_PULL = "agent_pull"  # Archives tar préparées que l'agent télécharge
+
+class RestoreCreate(BaseModel):
+    agent_id: int
+    snapshot_id: int
+    paths: List[str] = []  # Chemins ou motifs borg (vide = tout le snapshot)
+    mode: RestoreMode = RestoreMode.TARGET
+    target_dir: Optional[str] = None  # Mode target: relatif à la racine des restaurations du serveur
+    parallelism: int = Field(4, ge=1, le=32)
+
 # Schémas pour les snapshots
 class SnapshotResponse(BaseModel):
     id: int
@@ -67,13 +110,46 @@ class SnapshotResponse(BaseModel):
     name: str
     repo_path: str
     size_bytes: int
+    excluded_bytes: Optional[int] = None
     is_full: bool
     checksum: Optional[str]
+    missing_since: Optional[datetime] = None
     created_at: datetime
     
     class Config:
         from_attributes = True
 
+class ArchiveInfo(BaseModel):
+    name: str
+    id: Optional[str] = None
+    start: Optional[str] = None
+
+class RepositoryInfo(BaseModel):
+    repo_path: str
+    manifest: Optional[str] = None  # Version du manifest dont proviennent les données
+    archives: List[ArchiveInfo]
+    stats: Dict[str, int]
+    cached: bool
+
+class CatalogMatch(BaseModel):
+    snapshot_id: int
+    snapshot_name: str
+    path: str
+    type: str
+    size: int
+    mtime: Optional[datetime]
+
+class TreeEntry(BaseModel):
+    name: str
+    type: str  # d = répertoire, - = fichier, l = lien...
+    size: int
+    mtime: Optional[datetime]
+
+class DirectoryListing(BaseModel):
+    snapshot_id: int
+    path: str
+    entries: List[TreeEntry]
+
 # Schémas pour l'authentification
 class Token(BaseModel):
     access_token: str
@@ -83,6 +159,18 @@ class AgentHeartbeat(BaseModel):
     status: AgentStatus
     config: Optional[Dict[str, Any]] = {}
 
+# Heartbeats transmis en lot par un relais (jeton de chaque agent)
+class RelayedHeartbeat(BaseModel):
+    token: str
+    status: AgentStatus
+
+class HeartbeatBatch(BaseModel):
+    heartbeats: List[RelayedHeartbeat] = Field(..., max_length=5000)
+
+class HeartbeatBatchResult(BaseModel):
+    accepted: int
+    rejected: List[int]  # Positions des heartbeats dont le jeton est inconnu
+
 # Schémas pour les stats
 class AgentStats(BaseModel):
     total_snapshots: int
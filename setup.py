@@ -14,6 +14,7 @@ setup(
     install_requires=[
         "click>=8.1.7",
         "requests>=2.31.0",
+        "httpx[http2]>=0.27.2",
         "python-dotenv>=1.0.0",
         "borgbackup>=1.2.6",
     ],
@@ -0,0 +1,298 @@
+"""
+Tests de l'agent SaveOS (runtime, transport, relais, journal, index, exclusions)
+"""
+import pytest
+
+def test_agent_backup_stats():
+    """Les statistiques de borg create --json côté agent suivent le format du worker"""
+    import json
+    from agent.executor import parse_create_stats
+    
+    stdout = json.dumps({"archive": {"duration": 2.5, "stats": {
+        "original_size": 100, "compressed_size": 60, "deduplicated_size": 10, "nfiles": 3
+    }}})
+    assert parse_create_stats(stdout) == {
+        'original_size': 100, 'compressed_size': 60, 'deduplicated_size': 10, 'nfiles': 3, 'duration': 2.5
+    }
+    assert parse_create_stats("pas du json") == {}
+
+def test_agent_runtime_single_poll():
+    """Le runtime envoie heartbeat et attente de job en parallèle et compte ses requêtes"""
+    import asyncio
+    import httpx
+    from agent.runtime import AsyncAPIClient, AgentRuntime, LogBuffer
+    
+    seen = []
+    
+    async def handler(request):
+        seen.append((request.url.path, request.url.params.get("wait")))
+        if request.url.path.endswith("/agents/me/jobs"):
+            await asyncio.sleep(0.2)  # long-poll sans job
+            return httpx.Response(200, json=[])
+        return httpx.Response(200, json={"message": "ok"})
+    
+    client = AsyncAPIClient("http://saveos", "token", transport=httpx.MockTransport(handler))
+    runtime = AgentRuntime(client, heartbeat_interval=60, poll_wait=30, echo=lambda message: None)
+    asyncio.run(runtime.run(duration=0.5))
+    
+    assert client.requests["heartbeat"] == 1
+    assert client.requests["jobs"] >= 2
+    assert ("/api/v1/agents/me/jobs", "30") in seen
+    
+    buffer = LogBuffer(max_lines=2)
+    for line in ("a", "b", "c"):
+        buffer.append(line)
+    assert buffer.drain() == ["b", "c"] and buffer.drain() == []
+
+def test_agent_transport_breaker_and_spool(tmp_path):
+    """Disjoncteur, délai aléatoire borné et file locale des messages non remis"""
+    from agent.transport import CircuitBreaker, Spool, backoff_delay
+    
+    assert backoff_delay(3, 1.0, 5.0, rng=lambda: 0.999) < 5.0
+    assert backoff_delay(10, 1.0, 60.0, rng=lambda: 0.5) == 30.0
+    
+    now = [0.0]
+    breaker = CircuitBreaker(threshold=2, reset_timeout=10, clock=lambda: now[0], rng=lambda: 0.0)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open' and not breaker.allow()
+    now[0] = 10.0
+    assert breaker.allow() and not breaker.allow()  # un seul appel de test
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    
+    spool = Spool(tmp_path / "spool")
+    spool.put('heartbeat', {'status': 'active'}, key='agent')
+    spool.put('report', {'job_id': 3, 'report': {'success': True}}, key='3')
+    spool.put('heartbeat', {'status': 'idle'}, key='agent')
+    items = spool.items(10)
+    assert [(kind, payload.get('status')) for _, kind, payload in items] == [('report', None), ('heartbeat', 'idle')]
+    spool.remove(items[0][0])
+    assert len(spool) == 1
+
+def test_agent_client_retries_unavailable_api():
+    """Une API indisponible (503) est retentée; l'échec final est signalé comme passager"""
+    import asyncio
+    import httpx
+    from agent.runtime import AsyncAPIClient
+    
+    responses = [503, 503, 200]
+    
+    def handler(request):
+        return httpx.Response(responses.pop(0), json={"message": "ok"})
+    
+    client = AsyncAPIClient("http://saveos", "token", transport=httpx.MockTransport(handler),
+                            retry_attempts=3, retry_base=0.01)
+    assert asyncio.run(client.send_heartbeat())['success']
+    assert client.requests['heartbeat'] == 3
+    
+    responses.extend([503, 503])
+    client = AsyncAPIClient("http://saveos", "token", transport=httpx.MockTransport(handler),
+                            retry_attempts=2, retry_base=0.01)
+    result = asyncio.run(client.report_job(1, {'success': True}))
+    assert not result['success'] and result['retryable']
+
+def test_agent_client_supports_urllib3_1(monkeypatch):
+    """Le client synchrone se construit aussi avec urllib3 1.26 (sans backoff_jitter)"""
+    import importlib
+    import urllib3
+    import agent.api_client
+    
+    monkeypatch.setattr(urllib3, "__version__", "1.26.18")
+    try:
+        module = importlib.reload(agent.api_client)
+        assert module.RETRY_JITTER == {}
+        assert module.SaveOSAPIClient("http://saveos").session is not None
+    finally:
+        monkeypatch.undo()
+        importlib.reload(agent.api_client)
+
+def test_agent_relay_batches_heartbeats():
+    """Le relais acquitte les heartbeats, les envoie en un lot et relaie le reste"""
+    import asyncio
+    import json
+    import httpx
+    from agent.relay import RelayApp
+    
+    upstream = []
+    
+    def handler(request):
+        upstream.append((request.url.path, request.headers.get("authorization"), request.content))
+        if request.url.path.endswith("/batch"):
+            return httpx.Response(200, json={"accepted": 2, "rejected": []})
+        return httpx.Response(200, json=[])
+    
+    app = RelayApp("http://saveos", "relais", transport=httpx.MockTransport(handler), echo=lambda message: None)
+    
+    async def scenario():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://relay") as agent:
+            for token, status in (("a", "active"), ("b", "active"), ("a", "inactive")):
+                response = await agent.post("/api/v1/agents/heartbeat", json={"status": status},
+                                            headers={"Authorization": f"Bearer {token}"})
+                assert response.status_code == 200
+            assert upstream == []
+            
+            response = await agent.get("/api/v1/agents/me/jobs?wait=5", headers={"Authorization": "Bearer a"})
+            assert response.status_code == 200 and response.json() == []
+            assert await app.flush()
+    
+    asyncio.run(scenario())
+    
+    forwarded, batch = upstream
+    assert forwarded[:2] == ("/api/v1/agents/me/jobs", "Bearer a")
+    assert batch[:2] == ("/api/v1/agents/heartbeats/batch", "Bearer relais")
+    assert json.loads(batch[2]) == {"heartbeats": [
+        {"token": "a", "status": "inactive"}, {"token": "b", "status": "active"}
+    ]}
+    assert app.pending == {}
+
+def test_agent_change_journal(tmp_path):
+    """Le journal inotify évite une sauvegarde sans modification; chaque archive reste complète"""
+    import time
+    from agent.journal import ChangeJournal, InotifyWatcher, plan_backup
+    from agent.exclusions import ExclusionSet
+    
+    source = tmp_path / "data"
+    (source / "sub").mkdir(parents=True)
+    (source / "sub" / "a.txt").write_text("a")
+    journal = ChangeJournal(tmp_path / "journal")
+    watcher = InotifyWatcher([str(source)], journal)
+    try:
+        watcher.start()
+    except OSError:
+        pytest.skip("inotify indisponible")
+    
+    try:
+        plan = plan_backup(journal, [str(source)])
+        assert plan['reason'] and not plan['skip']
+        journal.complete(plan)
+        assert plan_backup(journal, [str(source)])['skip']
+        
+        (source / "sub" / "cache.tmp").write_text("x")
+        (source / "new").mkdir()
+        (source / "new" / "b.txt").write_text("b")
+        deadline = time.time() + 5
+        expected = {str(source / "sub" / "cache.tmp"), str(source / "new" / "b.txt")}
+        while not expected <= set(journal.pending()[0]) and time.time() < deadline:
+            time.sleep(0.05)
+        # Un répertoire créé est parcouru à l'ajout de sa surveillance: ses fichiers peuvent
+        # aussi arriver en double par inotify, on attend la fin de la rafale
+        seen = None
+        while seen != journal.pending()[0] and time.time() < deadline:
+            seen = journal.pending()[0]
+            time.sleep(0.3)
+        
+        plan = plan_backup(journal, [str(source)])
+        assert not plan['skip'] and plan['changed'] >= 2
+        journal.complete(plan)
+        assert journal.pending()[0] == []
+        
+        # Seul un fichier exclu a changé: pas de sauvegarde
+        (source / "sub" / "cache.tmp").write_text("y")
+        while not journal.pending()[0] and time.time() < deadline:
+            time.sleep(0.05)
+        assert plan_backup(journal, [str(source)], exclusions=ExclusionSet(['**/*.tmp']))['skip']
+        
+        journal.mark_overflow()
+        assert plan_backup(journal, [str(source)])['reason'] == "événements perdus"
+    finally:
+        watcher.stop()
+    assert journal.full_walk_reason([str(source)]) == "surveillance inactive"
+
+def test_agent_runtime_sends_estimate_before_borg(tmp_path):
+    """Le daemon envoie son estimation au serveur et ne lance pas borg si le quota la refuse"""
+    import json
+    import asyncio
+    import httpx
+    from agent.runtime import AsyncAPIClient, AgentRuntime
+    from agent.index import FileIndex
+    
+    source = tmp_path / "data"
+    source.mkdir()
+    (source / "a.txt").write_text("12345")
+    sent = []
+    
+    async def handler(request):
+        body = json.loads(request.content or b"{}")
+        sent.append((request.url.path, body))
+        if request.url.path.endswith("/start"):
+            return httpx.Response(200, json={"job_id": 1, "type": "backup", "repository": "ssh://r", "passphrase": "p",
+                                             "archive_name": "h_1", "source_paths": [str(source)],
+                                             "checkpoint_interval": 60, "lease_ttl": 120})
+        if request.url.path.endswith("/heartbeat"):
+            return httpx.Response(200, json={"cancel": False, "lease_ttl": 120, "error": "Quota dépassé: 5 / 1 octets"})
+        return httpx.Response(200, json={})
+    
+    class Executor:
+        def run(self, spec, cancel):
+            pytest.fail("borg lancé malgré le refus du quota")
+    
+    client = AsyncAPIClient("http://saveos", "token", transport=httpx.MockTransport(handler))
+    runtime = AgentRuntime(client, echo=lambda message: None, index=FileIndex(tmp_path / "index"))
+    assert asyncio.run(runtime._run_job(Executor(), 1))
+    
+    assert ("/api/v1/jobs/1/heartbeat", {"progress": None, "log": [], "estimated_bytes": 5}) in sent
+    assert sent[-1] == ("/api/v1/jobs/1/report", {"success": False, "error": "Quota dépassé: 5 / 1 octets"})
+
+def test_agent_file_index(tmp_path):
+    """L'index local détecte les fichiers modifiés et évite une sauvegarde inutile"""
+    from agent.index import FileIndex
+    
+    source = tmp_path / "data"
+    (source / "a" / "b").mkdir(parents=True)
+    for name in ("a/one.txt", "a/b/two.txt", "three.txt"):
+        (source / name).write_text(name)
+    roots = [str(source)]
+    index = FileIndex(tmp_path / "index")
+    
+    plan = index.plan(roots)
+    assert plan['reason'] == "index vide" and plan['files'] == 3 and plan['changed'] == 3
+    assert not plan['skip']
+    index.complete(plan)
+    
+    plan = index.plan(roots)
+    assert plan['skip'] and plan['changed'] == 0
+    
+    (source / "a" / "b" / "two.txt").write_text("modifié, plus long")
+    assert index.estimate(roots)['changed_bytes'] == len("modifié, plus long".encode())
+    plan = index.plan(roots)
+    assert not plan['skip'] and plan['changed'] == 1
+    index.complete(plan)
+    assert index.plan(roots)['skip']
+    
+    (source / "three.txt").unlink()
+    plan = index.plan(roots)
+    assert not plan['skip'] and plan['deleted'] == 1
+    index.close()
+
+def test_agent_exclusions(tmp_path):
+    """Les profils et motifs d'exclusion sont compilés, mesurés et transmis à borg"""
+    from agent.exclusions import ExclusionSet, profile_patterns, borg_args
+    from agent.index import FileIndex
+    
+    exclusions = ExclusionSet.from_config(
+        {'exclude_profiles': ['dev', 'caches'], 'exclude_patterns': ['**/*.iso', '/data/tmp?']}, system='linux'
+    )
+    assert '**/node_modules' in exclusions.patterns and '**/Library/Caches' not in exclusions.patterns
+    assert '**/Library/Caches' in profile_patterns(['caches'], 'darwin')
+    assert exclusions.excluded('/home/u/projet/node_modules')
+    assert exclusions.excluded('/home/u/projet/node_modules/lib/index.js')
+    assert exclusions.excluded('/home/u/.cache/pip/wheel')
+    assert exclusions.excluded('/home/u/image.iso') and exclusions.excluded('/data/tmp1/x')
+    assert not exclusions.excluded('/home/u/node_modules_notes.txt')
+    assert not exclusions.excluded('/home/u/image.iso.txt') and not exclusions.excluded('/data/tmp12')
+    assert borg_args(['**/*.iso']) == ['--pattern', '! sh:**/*.iso']
+    
+    source = tmp_path / "data"
+    (source / "app" / "node_modules" / "lib").mkdir(parents=True)
+    (source / "app" / "main.js").write_text("main")
+    (source / "app" / "node_modules" / "lib" / "index.js").write_text("x" * 100)
+    (source / "disk.iso").write_text("y" * 50)
+    roots = [str(source)]
+    assert exclusions.measure(roots) == {'excluded_bytes': 150, 'excluded_files': 2}
+    
+    index = FileIndex(tmp_path / "index")
+    plan = index.plan(roots, exclusions=exclusions)
+    assert plan['files'] == 1 and plan['excluded_bytes'] == 150
+    index.close()
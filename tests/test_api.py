@@ -34,4 +34,209 @@ def test_register_agent():
     data = response.json()
     assert data["hostname"] == "test-host"
     assert data["platform"] == "linux"
-    assert "token" in data
\ No newline at end of file
+    assert "token" in data
+
+def test_check_tenant_quota():
+    """Le quota est vérifié sur le compteur d'usage plus l'estimation pré-vol"""
+    from fastapi import HTTPException
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from api.database import Base, Tenant, Agent
+    from api.main import check_tenant_quota
+    
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    tenant = Tenant(name="t", quota_bytes=1000, used_bytes=800)
+    db.add(tenant)
+    db.flush()
+    agent = Agent(tenant_id=tenant.id, hostname="h", token="x")
+    db.add(agent)
+    db.commit()
+    
+    check_tenant_quota(db, agent, {})
+    check_tenant_quota(db, agent, {"estimated_bytes": 200})
+    with pytest.raises(HTTPException) as exc:
+        check_tenant_quota(db, agent, {"estimated_bytes": 201})
+    assert exc.value.status_code == 507
+
+def test_parse_range_header():
+    """Les plages HTTP simples sont bornées à la taille du fichier"""
+    from fastapi import HTTPException
+    from api.main import parse_range_header
+    
+    assert parse_range_header(None, 100) is None
+    assert parse_range_header("bytes=10-19", 100) == (10, 19)
+    assert parse_range_header("bytes=90-", 100) == (90, 99)
+    assert parse_range_header("bytes=-5", 100) == (95, 99)
+    assert parse_range_header("bytes=0-500", 100) == (0, 99)
+    assert parse_range_header("bytes=0-1,5-6", 100) is None
+    with pytest.raises(HTTPException) as exc:
+        parse_range_header("bytes=100-", 100)
+    assert exc.value.status_code == 416
+
+def test_apply_heartbeat_batch():
+    """Un lot de heartbeats relayés met à jour les agents connus en un seul UPDATE"""
+    from datetime import datetime
+    from sqlalchemy import create_engine, event
+    from sqlalchemy.orm import sessionmaker
+    from api.database import Base, Tenant, Agent
+    from api.auth import AuthManager
+    from api.main import apply_heartbeat_batch
+    from api.schemas import RelayedHeartbeat
+    
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    tenant = Tenant(name="t")
+    db.add(tenant)
+    db.flush()
+    db.add_all([
+        Agent(tenant_id=tenant.id, hostname=f"h{i}", token=AuthManager.hash_token(f"tok{i}"), status="active")
+        for i in range(3)
+    ])
+    db.commit()
+    
+    updates = []
+    event.listen(engine, "before_cursor_execute",
+                 lambda conn, cursor, statement, *args: updates.append(statement)
+                 if statement.startswith("UPDATE") else None)
+    
+    now = datetime(2026, 1, 1)
+    result = apply_heartbeat_batch(db, [
+        RelayedHeartbeat(token="tok0", status="inactive"),
+        RelayedHeartbeat(token="inconnu", status="active"),
+        RelayedHeartbeat(token="tok2", status="error"),
+    ], now=now)
+    
+    assert result == {'accepted': 2, 'rejected': [1]}
+    assert len(updates) == 1
+    agents = {agent.hostname: agent for agent in db.query(Agent).all()}
+    assert (agents["h0"].status, agents["h0"].last_seen) == ("inactive", now)
+    assert agents["h1"].status == "active" and agents["h1"].last_seen != now
+    assert agents["h2"].status == "error"
+
+def test_upgrade_schema_adds_missing_columns():
+    """Les tables créées avant l'ajout d'une colonne sont mises à niveau, une seule fois"""
+    from sqlalchemy import create_engine, inspect, text
+    from api.database import SCHEMA_UPGRADES, INDEX_UPGRADES, upgrade_schema
+
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        for table in {table for table, _, _ in SCHEMA_UPGRADES} | {table for _, table, _ in INDEX_UPGRADES}:
+            conn.execute(text(f"CREATE TABLE {table} (id INTEGER PRIMARY KEY, repo_path VARCHAR(512))"))
+        conn.execute(text("INSERT INTO tenants (id) VALUES (1)"))
+
+    upgrade_schema(engine)
+    upgrade_schema(engine)
+
+    inspector = inspect(engine)
+    for table, column, _ in SCHEMA_UPGRADES:
+        assert column in {c['name'] for c in inspector.get_columns(table)}
+    for name, table, _ in INDEX_UPGRADES:
+        assert name in {i['name'] for i in inspector.get_indexes(table)}
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT used_bytes FROM tenants")).scalar() == 0
+
+@pytest.fixture
+def agent_api():
+    """Base SQLite partagée avec l'application et agent authentifié"""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from sqlalchemy.pool import StaticPool
+    from api.database import Base, Tenant, Agent, get_db
+    from api.auth import get_current_agent
+    
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    tenant = Tenant(name="t", used_bytes=0)
+    db.add(tenant)
+    db.flush()
+    agent = Agent(tenant_id=tenant.id, hostname="h", token="x")
+    db.add(agent)
+    db.commit()
+    
+    app.dependency_overrides[get_db] = lambda: db
+    app.dependency_overrides[get_current_agent] = lambda: agent
+    yield db, agent
+    app.dependency_overrides.clear()
+    db.close()
+
+def test_list_agent_jobs_long_poll(agent_api, monkeypatch):
+    """L'agent récupère ses jobs immédiatement, ou après une attente bornée sans job"""
+    import json
+    import api.main
+    from api.database import Job
+    
+    db, agent = agent_api
+    wakeups = []
+    
+    async def no_wakeup(agent_id, timeout):
+        wakeups.append(timeout)
+        return False
+    
+    monkeypatch.setattr(api.main, "wait_for_wakeup", no_wakeup)
+    
+    response = client.get("/api/v1/agents/me/jobs")
+    assert response.status_code == 200 and response.json() == []
+    response = client.get("/api/v1/agents/me/jobs", params={"wait": 1})
+    assert response.status_code == 200 and response.json() == []
+    assert len(wakeups) == 1 and 0 < wakeups[0] <= 1
+    
+    job = Job(agent_id=agent.id, type="backup", status="pending", config=json.dumps({'execution': 'agent'}))
+    db.add(job)
+    db.commit()
+    response = client.get("/api/v1/agents/me/jobs", params={"wait": 1})
+    assert [item["id"] for item in response.json()] == [job.id]
+    assert len(wakeups) == 1
+
+def test_start_agent_job_sends_exclusions(agent_api, monkeypatch):
+    """Les exclusions de la configuration du job parviennent à l'agent au démarrage"""
+    import json
+    import worker.tasks
+    import worker.agent_jobs as agent_jobs
+    from api.database import Job
+    
+    fakeredis = pytest.importorskip("fakeredis")
+    monkeypatch.setattr(worker.tasks, "redis_conn", fakeredis.FakeRedis())
+    monkeypatch.setattr(agent_jobs, "redis_conn", worker.tasks.redis_conn)
+    monkeypatch.setattr(agent_jobs, "AGENT_REPO_URL", "ssh://saveos@backup/{repo_path}")
+    
+    db, agent = agent_api
+    job = Job(agent_id=agent.id, type="backup", status="pending", config=json.dumps({
+        'execution': 'agent', 'repo_path': '/repos/h', 'source_paths': ['/data'],
+        'exclude_patterns': ['**/*.iso']
+    }))
+    db.add(job)
+    db.commit()
+    
+    response = client.post(f"/api/v1/jobs/{job.id}/start")
+    assert response.status_code == 200
+    assert response.json()["exclude_patterns"] == ['**/*.iso']
+
+def test_agent_job_estimate_checked_against_quota(agent_api, monkeypatch):
+    """L'estimation envoyée par le daemon avant borg est soumise au quota du tenant"""
+    import json
+    import worker.tasks
+    import worker.agent_jobs as agent_jobs
+    from api.database import Job, Tenant
+    
+    fakeredis = pytest.importorskip("fakeredis")
+    monkeypatch.setattr(worker.tasks, "redis_conn", fakeredis.FakeRedis())
+    monkeypatch.setattr(agent_jobs, "redis_conn", worker.tasks.redis_conn)
+    monkeypatch.setattr(agent_jobs, "AGENT_REPO_URL", "ssh://saveos@backup/{repo_path}")
+    
+    db, agent = agent_api
+    db.query(Tenant).update({Tenant.quota_bytes: 1000, Tenant.used_bytes: 900})
+    job = Job(agent_id=agent.id, type="backup", status="pending",
+              config=json.dumps({'execution': 'agent', 'repo_path': '/repos/h'}))
+    db.add(job)
+    db.commit()
+    assert client.post(f"/api/v1/jobs/{job.id}/start").status_code == 200
+    
+    response = client.post(f"/api/v1/jobs/{job.id}/heartbeat", json={"estimated_bytes": 50})
+    assert response.status_code == 200 and "error" not in response.json()
+    response = client.post(f"/api/v1/jobs/{job.id}/heartbeat", json={"estimated_bytes": 500})
+    assert response.json()["error"].startswith("Quota dépassé")
+    assert json.loads(db.query(Job).get(job.id).config)['estimated_bytes'] == 500
@@ -151,4 +151,4 @@ def test_scripts():
         assert os.path.exists(filepath), f"Missing script {script}"
 
 if __name__ == "__main__":
-    pytest.main([__file__, "-v"])
\ No newline at end of file
+    pytest.main([__file__, "-v"])
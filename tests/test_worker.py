@@ -0,0 +1,766 @@
+"""
+Tests du worker SaveOS (sans Redis ni borg)
+"""
+import os
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from api.database import Base, Tenant, Agent, Job, Snapshot
+
+@pytest.fixture
+def db():
+    """Base SQLite en mémoire avec le schéma SaveOS"""
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+
+def test_parse_retention_policy():
+    """La politique JSON du tenant devient des options --keep-*"""
+    from worker.retention import parse_retention_policy
+
+    assert parse_retention_policy('{"daily": 30, "weekly": 12, "monthly": 0}') == {
+        'daily': 30, 'weekly': 12
+    }
+    assert parse_retention_policy('pas du json') == {}
+    assert parse_retention_policy(None) == {}
+
+def test_next_off_peak_wraps_midnight():
+    """La fenêtre creuse peut chevaucher minuit"""
+    from worker.retention import next_off_peak
+
+    window = "22:00-04:00"
+    assert next_off_peak(datetime(2024, 1, 1, 23, 30), window) == datetime(2024, 1, 1, 23, 30)
+    assert next_off_peak(datetime(2024, 1, 2, 3, 0), window) == datetime(2024, 1, 2, 3, 0)
+    assert next_off_peak(datetime(2024, 1, 2, 12, 0), window) == datetime(2024, 1, 2, 22, 0)
+
+def test_delete_snapshot_rows_in_batches(db):
+    """Les snapshots purgés sont supprimés par lots et détachés de leurs jobs"""
+    from worker.retention import delete_snapshot_rows
+
+    tenant = Tenant(name="t")
+    db.add(tenant)
+    db.flush()
+    agent = Agent(tenant_id=tenant.id, hostname="h", token="x")
+    db.add(agent)
+    db.flush()
+    for i in range(5):
+        job = Job(agent_id=agent.id, type="backup", status="completed")
+        db.add(job)
+        db.flush()
+        snapshot = Snapshot(job_id=job.id, name=f"h_{i}", repo_path="/repo")
+        db.add(snapshot)
+        db.flush()
+        job.snapshot_id = snapshot.id
+    db.commit()
+
+    deleted = delete_snapshot_rows(db, "/repo", ["h_0", "h_1", "h_2"], batch_size=2)
+
+    assert deleted == 3
+    assert db.query(Snapshot).count() == 2
+    assert db.query(Job).filter(Job.snapshot_id.is_(None)).count() == 3
+
+def test_catalog_build_and_search(tmp_path):
+    """Le catalogue d'un snapshot se construit depuis borg list --json-lines et se recherche"""
+    from worker.catalog import build_catalog, search_catalog
+
+    items = [
+        {"type": "d", "path": "home", "size": 0, "mtime": "2024-01-01T10:00:00.000000"},
+        {"type": "d", "path": "home/x", "size": 0, "mtime": "2024-01-01T10:00:00.000000"},
+        {"type": "-", "path": "home/x/report.docx", "size": 42, "mtime": "2024-01-01T10:00:00.000000"},
+        {"type": "-", "path": "home/x/notes_2024.txt", "size": 7, "mtime": None},
+    ]
+    path = str(tmp_path / "1.sqlite")
+
+    assert build_catalog(iter(items), path) == 4
+    assert [m['path'] for m in search_catalog(path, "*.docx")] == ["home/x/report.docx"]
+    assert [m['path'] for m in search_catalog(path, "/home/*/notes*")] == ["home/x/notes_2024.txt"]
+    assert [m['path'] for m in search_catalog(path, "s_2", mode="substring")] == ["home/x/notes_2024.txt"]
+    assert search_catalog(path, "x/report", mode="substring")[0]['size'] == 42
+    assert search_catalog(str(tmp_path / "absent.sqlite"), "*") == []
+
+def test_diff_stream_is_cached(tmp_path):
+    """Le diff est normalisé en NDJSON et publié en cache une fois complet"""
+    import json
+    from worker.diffs import stream_diff, iter_cached_diff
+
+    items = [
+        {"path": "a.txt", "changes": [{"type": "added", "size": 10}]},
+        {"path": "b.txt", "changes": [{"type": "modified", "added": 30, "removed": 5}, {"type": "mode"}]},
+        {"path": "old", "changes": [{"type": "removed directory"}]},
+    ]
+    cache_file = str(tmp_path / "1_2.ndjson")
+
+    lines = list(stream_diff(iter(items), cache_file))
+
+    assert [json.loads(line) for line in lines] == [
+        {"path": "a.txt", "change": "added", "size_delta": 10},
+        {"path": "b.txt", "change": "modified", "size_delta": 25},
+        {"path": "old", "change": "removed", "size_delta": 0},
+    ]
+    assert list(iter_cached_diff(cache_file)) == lines
+
+def test_catalog_browse_one_level(tmp_path):
+    """La navigation retourne un seul niveau, avec les répertoires intermédiaires et leur taille cumulée"""
+    from worker.catalog import build_catalog, list_directory
+
+    items = [
+        {"type": "d", "path": "home/x/docs", "size": 0, "mtime": "2024-01-01T10:00:00"},
+        {"type": "-", "path": "home/x/docs/a.txt", "size": 5, "mtime": "2024-01-01T10:00:00"},
+        {"type": "d", "path": "home/x/docs/sub", "size": 0, "mtime": "2024-01-01T10:00:00"},
+        {"type": "-", "path": "home/x/docs/sub/b.bin", "size": 100, "mtime": "2024-01-01T10:00:00"},
+        {"type": "d", "path": "home/x/empty", "size": 0, "mtime": "2024-01-01T10:00:00"},
+    ]
+    path = str(tmp_path / "1.sqlite")
+    build_catalog(iter(items), path)
+
+    assert [(e['name'], e['type'], e['size']) for e in list_directory(path, "/")] == [("home", "d", 105)]
+    assert [(e['name'], e['type'], e['size']) for e in list_directory(path, "/home/x/docs")] == [
+        ("sub", "d", 100),
+        ("a.txt", "-", 5),
+    ]
+    assert list_directory(path, "/home/x/empty") == []
+    assert list_directory(path, "nope") is None
+    assert list_directory(path, "home/x/docs/a.txt") is None
+
+def test_restore_units_are_split_and_balanced(tmp_path):
+    """Un gros répertoire est éclaté puis réparti par taille entre les processus"""
+    from worker.catalog import build_catalog
+    from worker.restore import expand_restore_units, split_restore_units
+
+    items = [{"type": "d", "path": "data", "size": 0}]
+    for name, size in (("a", 400), ("b", 300), ("c", 200), ("d", 100)):
+        items.append({"type": "-", "path": f"data/{name}.bin", "size": size})
+    listing = str(tmp_path / "1.sqlite")
+    build_catalog(iter(items), listing)
+
+    units = expand_restore_units(listing, ["/data", "sh:data/*.log"], parallelism=2)
+    assert sorted(u['path'] for u in units) == [
+        "data/a.bin", "data/b.bin", "data/c.bin", "data/d.bin", "sh:data/*.log"
+    ]
+
+    buckets = split_restore_units(units, 2)
+    assert sorted(b['size'] for b in buckets) == [500, 500]
+    assert sum(b['files'] for b in buckets) == 4
+
+def test_restore_target_dir_is_confined(tmp_path, monkeypatch):
+    """Le répertoire cible d'une restauration reste sous la racine de l'agent"""
+    from worker import restore
+
+    monkeypatch.setattr(restore, "RESTORE_TARGET_ROOT", str(tmp_path))
+    assert restore.restore_target_dir(7, "docs/2024") == str(tmp_path / "7" / "docs" / "2024")
+    (tmp_path / "7").mkdir()
+    (tmp_path / "7" / "evasion").symlink_to("/etc")
+    for target in ("/etc", "../8/docs", "docs/../../8", "evasion/cron.d", ""):
+        with pytest.raises(ValueError):
+            restore.restore_target_dir(7, target)
+
+def test_stream_stdout_serves_a_byte_range():
+    """Une plage est servie en sautant les octets précédents, sans tout bufferiser"""
+    import sys
+    from worker.tasks import BorgManager
+
+    borg = BorgManager("/nonexistent", "x")
+    cmd = [sys.executable, "-c", "import sys; sys.stdout.buffer.write(bytes(range(256)) * 1000)"]
+
+    chunks = list(borg._stream_stdout(cmd, offset=300, length=10, chunk_size=7))
+    assert b"".join(chunks) == bytes(range(44, 54))
+    assert len(b"".join(borg._stream_stdout(cmd))) == 256000
+
+def test_verification_cycle_progress():
+    """La couverture avance par tranches et un cycle complet est daté puis réinitialisé"""
+    from datetime import timedelta
+    from api.database import RepoVerification
+    from worker.verification import verification_lag, record_check_progress
+
+    start = datetime(2024, 1, 1)
+    state = RepoVerification(repo_path="/repo", position=0.0, cycle_started_at=start)
+    period = timedelta(days=4)
+
+    assert verification_lag(state, start + timedelta(days=1), period) == pytest.approx(0.25)
+
+    record_check_progress(state, 0.5, 100, 1000, start + timedelta(days=1))
+    assert state.position == 0.5
+    assert state.throughput_bytes == pytest.approx(5.0)
+    assert verification_lag(state, start + timedelta(days=1), period) < 0
+
+    end = start + timedelta(days=2)
+    record_check_progress(state, 1.0, 50, 1000, end)
+    assert state.position == 0.0
+    assert state.last_full_verified_at == end
+    assert state.cycle_started_at == end
+
+def test_object_store_sync_is_incremental(tmp_path):
+    """Seuls les segments nouveaux sont envoyés; un autre worker rapatrie le repository"""
+    boto3 = pytest.importorskip("boto3")
+    moto = pytest.importorskip("moto")
+    from worker.object_store import RepositoryStore
+
+    with moto.mock_s3():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="repos")
+
+        repo = tmp_path / "a" / "repo"
+        (repo / "data" / "0").mkdir(parents=True)
+        (repo / "data" / "0" / "1").write_bytes(b"x" * 300)
+        (repo / "index.1").write_bytes(b"i1")
+        (repo / "config").write_text("[repository]")
+        (repo / "lock.roster").write_text("{}")
+
+        store = RepositoryStore(str(repo), client=client, bucket="repos", prefix="r",
+                                part_size=5 * 1024 * 1024, concurrency=2)
+        assert store.push()['uploaded'] == 3
+        assert "lock.roster" not in store.remote_objects()
+
+        # Nouveau segment + nouvel index (compact / transaction suivante)
+        (repo / "data" / "0" / "2").write_bytes(b"y" * 10)
+        (repo / "index.2").write_bytes(b"i2")
+        (repo / "index.1").unlink()
+        assert store.push() == {'uploaded': 2, 'uploaded_bytes': 12, 'deleted': 1}
+        assert store.push()['uploaded'] == 0
+
+        other = RepositoryStore(str(tmp_path / "b" / "repo"), client=client, bucket="repos",
+                                prefix="r", concurrency=2)
+        assert other.pull()['downloaded'] == 4
+        assert (tmp_path / "b" / "repo" / "data" / "0" / "2").read_bytes() == b"y" * 10
+        assert other.pull()['downloaded'] == 0
+
+def test_local_replica_copies_only_changes(tmp_path):
+    """La réplication vers un chemin ne recopie que les segments nouveaux et suit les suppressions"""
+    from worker.replication import LocalReplica
+
+    repo = tmp_path / "repo"
+    (repo / "data" / "0").mkdir(parents=True)
+    (repo / "data" / "0" / "1").write_bytes(b"a" * 100)
+    (repo / "index.1").write_bytes(b"i1")
+    (repo / "lock.roster").write_text("{}")
+    target = tmp_path / "offsite"
+
+    replica = LocalReplica(str(repo), str(target), concurrency=2)
+    assert replica.push() == {'uploaded': 2, 'uploaded_bytes': 102, 'deleted': 0}
+    assert not (target / "lock.roster").exists()
+
+    (repo / "data" / "0" / "2").write_bytes(b"b" * 10)
+    (repo / "index.2").write_bytes(b"i2")
+    (repo / "index.1").unlink()
+    assert replica.push() == {'uploaded': 2, 'uploaded_bytes': 12, 'deleted': 1}
+    assert replica.push()['uploaded'] == 0
+    assert sorted(p.name for p in target.rglob("*") if p.is_file()) == ["1", "2", "index.2"]
+
+def test_replication_snapshot_links_segments(tmp_path):
+    """L'image figée partage les segments du repository et ne suit plus ses écritures"""
+    from worker.replication import snapshot_repository, staging_path
+
+    repo = tmp_path / "repo"
+    (repo / "data" / "0").mkdir(parents=True)
+    (repo / "data" / "0" / "1").write_bytes(b"x" * 100)
+    (repo / "index.1").write_bytes(b"ix")
+    staging = staging_path(str(repo))
+    assert staging == str(tmp_path / ".repo.saveos-replica")
+
+    assert snapshot_repository(str(repo), staging) == {'files': 2, 'linked': 1, 'deleted': 0}
+    assert os.stat(os.path.join(staging, "data", "0", "1")).st_ino == (repo / "data" / "0" / "1").stat().st_ino
+    assert open(os.path.join(staging, "index.1"), 'rb').read() == b"ix"
+
+    # compact supprime un segment et borg écrit un nouvel index: l'image précédente reste intacte
+    (repo / "data" / "0" / "1").unlink()
+    (repo / "data" / "0" / "2").write_bytes(b"y" * 10)
+    (repo / "index.1").unlink()
+    (repo / "index.2").write_bytes(b"iy")
+    assert os.path.exists(os.path.join(staging, "data", "0", "1"))
+
+    assert snapshot_repository(str(repo), staging) == {'files': 2, 'linked': 1, 'deleted': 2}
+    assert sorted(os.listdir(os.path.join(staging, "data", "0"))) == ["2"]
+    assert not os.path.exists(os.path.join(staging, "index.1"))
+
+def test_replication_waits_for_running_replication(db, monkeypatch):
+    """Un second job de réplication ne touche pas à l'image figée en cours d'envoi"""
+    import worker.tasks
+    from worker import replication
+
+    fakeredis = pytest.importorskip("fakeredis")
+    monkeypatch.setattr(worker.tasks, "redis_conn", fakeredis.FakeRedis())
+    monkeypatch.setattr(replication, "REPLICATION_TARGET", "/mnt/offsite")
+    monkeypatch.setattr(replication, "SessionLocal", lambda: db)
+    requeued = []
+    monkeypatch.setattr(replication, "enqueue_replication_job", lambda job_id, delay=None: requeued.append(job_id))
+    monkeypatch.setattr(replication, "snapshot_repository",
+                        lambda *args: pytest.fail("image figée reconstruite pendant un envoi"))
+
+    tenant = Tenant(name="t")
+    db.add(tenant)
+    db.flush()
+    agent = Agent(tenant_id=tenant.id, hostname="h", token="x")
+    db.add(agent)
+    db.flush()
+    job = Job(agent_id=agent.id, type="replicate", status="pending")
+    db.add(job)
+    db.commit()
+
+    repo_path = replication.resolve_repository(db, agent)['repo_path']
+    running = replication._replication_lock(repo_path)
+    assert running.acquire(blocking=False)
+
+    result = replication.process_replication_job(job.id)
+    assert requeued == [job.id] and not result['success']
+    assert db.query(Job).get(job.id).status == "pending"
+    running.release()
+
+def test_replication_lag_from_watermark(db):
+    """Le retard est l'âge du plus ancien snapshot au-delà du filigrane"""
+    from api.database import ReplicationState
+    from worker.replication import replication_lag
+
+    tenant = Tenant(name="t")
+    db.add(tenant)
+    db.flush()
+    agent = Agent(tenant_id=tenant.id, hostname="h", token="x")
+    db.add(agent)
+    db.flush()
+    job = Job(agent_id=agent.id, type="backup", status="completed")
+    db.add(job)
+    db.flush()
+    first = Snapshot(job_id=job.id, name="a", repo_path="/repo", created_at=datetime(2024, 1, 1, 10))
+    second = Snapshot(job_id=job.id, name="b", repo_path="/repo", created_at=datetime(2024, 1, 1, 11))
+    db.add_all([first, second])
+    db.commit()
+
+    state = ReplicationState(agent_id=agent.id, repo_path="/repo", watermark_snapshot_id=first.id)
+    now = datetime(2024, 1, 1, 12)
+    assert replication_lag(db, state, now) == 3600
+    state.watermark_snapshot_id = second.id
+    assert replication_lag(db, state, now) == 0
+
+def test_compression_sample_and_choice(tmp_path):
+    """L'échantillon favorise les gros fichiers; le choix pèse taux et débit"""
+    import random
+    from worker.compression import sample_files, build_sample, choose_compression
+
+    (tmp_path / "src" / "sub").mkdir(parents=True)
+    (tmp_path / "src" / "big.log").write_bytes(b"x" * 100000)
+    (tmp_path / "src" / "sub" / "small.txt").write_bytes(b"y")
+    (tmp_path / "src" / "empty").write_bytes(b"")
+
+    files = sample_files([str(tmp_path / "src")], count=1, rng=random.Random(1))
+    assert files == [str(tmp_path / "src" / "big.log")]
+    (tmp_path / "sample").mkdir()
+    assert build_sample(files, str(tmp_path / "sample"), chunk_size=1000) == 1000
+
+    mb = 1024 * 1024
+    results = [
+        {'compression': 'lz4', 'ratio': 2.0, 'throughput': 400 * mb},
+        {'compression': 'zstd,3', 'ratio': 3.0, 'throughput': 120 * mb},
+        {'compression': 'zstd,6', 'ratio': 3.03, 'throughput': 60 * mb},
+        {'compression': 'auto,zstd,9', 'ratio': 3.5, 'throughput': 10 * mb},
+    ]
+    assert choose_compression(results, min_throughput=50 * mb) == 'zstd,3'
+    assert choose_compression([{'compression': 'lz4', 'ratio': 1.01, 'throughput': mb}]) == 'none'
+    assert choose_compression([]) is None
+
+def test_inprocess_borg_keeps_key_and_stats_warm(monkeypatch):
+    """La clé est dérivée une fois et les statistiques ne sont recalculées qu'au changement de manifest"""
+    import os
+    import types
+    from worker import borg_inprocess
+
+    calls = {'key': 0, 'summarize': 0}
+    manifest = types.SimpleNamespace(id=b"m1", archives=None)
+
+    class Repository:
+        id = b"repo"
+        def __init__(self, path, exclusive=False, lock_wait=None):
+            pass
+        def __enter__(self):
+            return self
+        def __exit__(self, *args):
+            return False
+
+    class Manifest:
+        Operation = types.SimpleNamespace(READ="read")
+        @staticmethod
+        def load(repository, operations, key=None):
+            if key is None:
+                calls['key'] += 1
+                key = object()
+            return manifest, key
+
+    class Cache:
+        def __init__(self, repository, key, manifest, lock_wait=None):
+            self.chunks = self
+        def __enter__(self):
+            return self
+        def __exit__(self, *args):
+            return False
+        def summarize(self):
+            calls['summarize'] += 1
+            return (10, 8, 6, 4, 2, 3)
+
+    monkeypatch.setattr(borg_inprocess, "_borg", {
+        'Repository': Repository, 'Manifest': Manifest, 'Cache': Cache, 'bin_to_hex': bytes.hex
+    })
+    monkeypatch.setattr(borg_inprocess, "BORG_EXECUTION", "inprocess")
+    monkeypatch.setattr(borg_inprocess, "_keys", {})
+    monkeypatch.setattr(borg_inprocess, "_stats", {})
+
+    assert borg_inprocess.enabled()
+    for _ in range(3):
+        info = borg_inprocess.repo_info("/repo", "pw", {'BORG_PASSPHRASE': 'pw'})
+    assert info['stats']['unique_csize'] == 4
+    assert calls == {'key': 1, 'summarize': 1}
+
+    manifest.id = b"m2"
+    borg_inprocess.repo_info("/repo", "pw", {'BORG_PASSPHRASE': 'pw'})
+    assert calls == {'key': 1, 'summarize': 2}
+    # Autre passphrase: la clé est dérivée de nouveau; l'environnement du processus est restauré
+    monkeypatch.delenv("BORG_PASSPHRASE", raising=False)
+    borg_inprocess.repo_info("/repo", "autre", {'BORG_PASSPHRASE': 'autre'})
+    assert calls['key'] == 2
+    assert "BORG_PASSPHRASE" not in os.environ
+
+def test_repo_metadata_cache_invalidation(monkeypatch):
+    """Une valeur calculée avant une écriture n'est jamais publiée après son invalidation"""
+    fakeredis = pytest.importorskip("fakeredis")
+    import worker.tasks
+    from worker import repo_cache
+
+    monkeypatch.setattr(worker.tasks, "redis_conn", fakeredis.FakeRedis())
+    monkeypatch.setattr(repo_cache, "_store_script", None)
+
+    gen = repo_cache.generation("/repo")
+    assert repo_cache.store("/repo", "info", {'success': True, 'stats': {'unique_csize': 1}}, gen)
+    assert repo_cache.get("/repo", "info") == {'success': True, 'stats': {'unique_csize': 1}, 'cached': True}
+
+    # Un borg info lancé avant un create ne doit pas écraser l'invalidation
+    stale_gen = repo_cache.generation("/repo")
+    repo_cache.invalidate("/repo")
+    assert repo_cache.get("/repo", "info") is None
+    assert not repo_cache.store("/repo", "info", {'success': True, 'stats': {}}, stale_gen)
+    assert repo_cache.get("/repo", "info") is None
+
+def test_apply_drift_upserts_and_marks_missing(db):
+    """Archives inconnues insérées, snapshots orphelins marqués puis démarqués s'ils réapparaissent"""
+    from worker.reconcile import apply_drift
+
+    tenant = Tenant(name="t")
+    db.add(tenant)
+    db.flush()
+    agent = Agent(tenant_id=tenant.id, hostname="h", token="x")
+    db.add(agent)
+    db.flush()
+    job = Job(agent_id=agent.id, type="backup", status="completed")
+    db.add(job)
+    db.flush()
+    db.add_all([Snapshot(job_id=job.id, name=name, repo_path="/repo") for name in ("a", "b")])
+    db.commit()
+
+    archives = [{"name": "a", "start": "2024-01-01T10:00:00.000000"}]
+    archives += [{"name": f"n{i}", "start": "2024-01-02T10:00:00.000000"} for i in range(5)]
+    now = datetime(2024, 2, 1)
+
+    assert apply_drift(db, agent, "/repo", archives, batch_size=2, now=now) == {
+        'new': 5, 'missing': 1, 'restored': 0
+    }
+    assert db.query(Snapshot).filter(Snapshot.repo_path == "/repo").count() == 7
+    assert db.query(Snapshot).filter(Snapshot.name == "b").one().missing_since == now
+    assert db.query(Job).filter(Job.type == "reconcile").count() == 1
+
+    archives.append({"name": "n9.checkpoint", "start": None})
+    assert apply_drift(db, agent, "/repo", archives, now=now)['new'] == 0
+
+    archives.append({"name": "b", "start": None})
+    assert apply_drift(db, agent, "/repo", archives, now=now) == {'new': 0, 'missing': 0, 'restored': 1}
+    assert db.query(Snapshot).filter(Snapshot.missing_since.isnot(None)).count() == 0
+
+def test_repository_lease_released_from_another_thread(monkeypatch):
+    """Le verrou pris dans un thread (listing parallèle) est libéré par un autre"""
+    import threading
+    import worker.tasks
+    from worker import object_store
+
+    fakeredis = pytest.importorskip("fakeredis")
+    monkeypatch.setattr(worker.tasks, "redis_conn", fakeredis.FakeRedis())
+
+    leases = []
+    thread = threading.Thread(target=lambda: leases.append(object_store.checkout_repository("/repo", wait=1)))
+    thread.start()
+    thread.join()
+    leases[0].release()
+
+    assert worker.tasks.redis_conn.get("saveos:repo_lock:repo") is None
+    assert object_store.checkout_repository("/repo", wait=1) is not None
+
+def test_read_lease_shared_between_restores(monkeypatch):
+    """Les restaurations lisent ensemble; un job d'écriture attend leur fin, dans une limite"""
+    import worker.tasks
+    from worker import object_store
+
+    fakeredis = pytest.importorskip("fakeredis")
+    monkeypatch.setattr(worker.tasks, "redis_conn", fakeredis.FakeRedis())
+
+    first = object_store.read_repository("/repo", "job:1", wait=1)
+    second = object_store.read_repository("/repo", "job:2", wait=1)
+    assert first and second
+    assert worker.tasks.redis_conn.get("saveos:repo_lock:repo") is None
+
+    # Attente bornée: le job d'écriture rend la main sans garder le verrou
+    assert object_store.checkout_repository("/repo", wait=1.5) is None
+    assert worker.tasks.redis_conn.get("saveos:repo_lock:repo") is None
+
+    first.release()
+    second.release()
+    lease = object_store.checkout_repository("/repo", wait=1)
+    assert lease is not None
+    assert object_store.read_repository("/repo", "job:3", wait=0.1) is None
+    lease.release()
+
+def test_repository_lease_renewed_from_heartbeat_thread(monkeypatch):
+    """Le heartbeat du job renouvelle depuis son propre thread le verrou pris par le job"""
+    import threading
+    import worker.tasks
+    from worker import object_store
+
+    fakeredis = pytest.importorskip("fakeredis")
+    monkeypatch.setattr(worker.tasks, "redis_conn", fakeredis.FakeRedis())
+
+    lease = object_store.checkout_repository("/repo", wait=1, timeout=120)
+    worker.tasks.redis_conn.pexpire("saveos:repo_lock:repo", 5000)
+    errors = []
+
+    def renew():
+        try:
+            lease.renew()
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=renew)
+    thread.start()
+    thread.join()
+
+    assert errors == []
+    assert worker.tasks.redis_conn.pttl("saveos:repo_lock:repo") > 100000
+    lease.release()
+
+def test_reaper_requeues_expired_backups(db):
+    """Bail expiré: sauvegarde et restauration repartent en attente, sauf après trop de tentatives"""
+    from datetime import timedelta
+    from worker.reaper import reclaim_expired_jobs
+
+    tenant = Tenant(name="t")
+    db.add(tenant)
+    db.flush()
+    agent = Agent(tenant_id=tenant.id, hostname="h", token="x")
+    db.add(agent)
+    db.flush()
+    now = datetime(2024, 1, 1, 12)
+    expired = now - timedelta(minutes=5)
+    jobs = [
+        Job(agent_id=agent.id, type="backup", status="running", attempts=1, lease_expires_at=expired),
+        Job(agent_id=agent.id, type="backup", status="running", attempts=3, lease_expires_at=expired),
+        Job(agent_id=agent.id, type="backup", status="running", attempts=1,
+            lease_expires_at=now + timedelta(minutes=1)),
+        Job(agent_id=agent.id, type="prune", status="running"),
+        Job(agent_id=agent.id, type="restore", status="running", attempts=1, lease_expires_at=expired),
+    ]
+    db.add_all(jobs)
+    db.commit()
+
+    reclaimed = reclaim_expired_jobs(db, now=now, max_attempts=3)
+
+    assert [job.id for job in reclaimed] == [jobs[0].id, jobs[4].id]
+    assert [job.status for job in jobs] == ["pending", "failed", "running", "running", "pending"]
+    assert jobs[0].lease_expires_at is None
+
+def test_resume_backup_renames_checkpoint():
+    """Le checkpoint de la tentative précédente est mis de côté pour la reprise"""
+    from worker.tasks import resume_backup
+
+    class FakeBorg:
+        def __init__(self, names):
+            self.names = names
+            self.renamed = []
+
+        def list_archives(self, use_cache=True):
+            return {'success': True, 'archives': [{'name': name} for name in self.names]}
+
+        def rename_archive(self, name, new_name):
+            self.renamed.append((name, new_name))
+            return {'success': True}
+
+    borg = FakeBorg(["h_1", "h_2.checkpoint.resume1", "h_2.checkpoint"])
+    assert resume_backup(borg, "h_2") == {
+        'completed': False,
+        'checkpoints': ["h_2.checkpoint.resume1", "h_2.checkpoint.resume2"]
+    }
+    assert borg.renamed == [("h_2.checkpoint", "h_2.checkpoint.resume2")]
+
+    assert resume_backup(FakeBorg(["h_2"]), "h_2") == {'completed': True, 'checkpoints': []}
+
+def test_cancel_request_interrupts_process(monkeypatch):
+    """Une annulation déposée dans Redis envoie SIGINT au processus (puis SIGKILL s'il résiste)"""
+    import sys
+    import time
+    import threading
+    fakeredis = pytest.importorskip("fakeredis")
+    import worker.tasks
+    from worker.cancellation import InterruptWatcher, request_interrupt, run_interruptible
+
+    monkeypatch.setattr(worker.tasks, "redis_conn", fakeredis.FakeRedis())
+    # Les demandes arrivent après le démarrage des processus (gestion de SIGINT en place)
+    script = "import time\ntry:\n    time.sleep(30)\nexcept KeyboardInterrupt:\n    print('checkpoint')\n"
+
+    watcher = InterruptWatcher(7, poll=0.05)
+    watcher.start()
+    threading.Timer(1.0, request_interrupt, args=(7, 'cancel')).start()
+    started = time.monotonic()
+    result = run_interruptible([sys.executable, "-c", script], None, watcher.event, grace=5, poll=0.05)
+    watcher.stop()
+
+    assert watcher.reason == 'cancel'
+    assert result.stdout.strip() == 'checkpoint'
+    assert time.monotonic() - started < 10
+
+    stubborn = "import signal, time\nsignal.signal(signal.SIGINT, signal.SIG_IGN)\ntime.sleep(30)\n"
+    interrupt = threading.Event()
+    threading.Timer(1.0, interrupt.set).start()
+    result = run_interruptible([sys.executable, "-c", stubborn], None, interrupt, grace=0.2, poll=0.05)
+    assert result.returncode == -9
+
+def test_cancel_interrupts_restore_streams_and_transfers():
+    """Les extractions parallèles et les transferts de réplication s'arrêtent sur annulation"""
+    import sys
+    import time
+    import subprocess
+    import threading
+    from worker.restore import run_parallel
+    from worker.object_store import BandwidthLimiter
+    from worker.cancellation import JobInterrupted
+
+    stubborn = "import signal, sys, time\nsignal.signal(signal.SIGINT, signal.SIG_IGN)\nsys.stderr.write('x\\n')\ntime.sleep(30)\n"
+    processes = [
+        subprocess.Popen([sys.executable, "-c", stubborn], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                         text=True, start_new_session=True)
+        for _ in range(2)
+    ]
+    interrupt = threading.Event()
+    threading.Timer(0.5, interrupt.set).start()
+    started = time.monotonic()
+    errors = run_parallel(processes, lambda done, finished: None, interrupt=interrupt, grace=0.2)
+    assert len(errors) == 2 and all(p.returncode == -9 for p in processes)
+    assert time.monotonic() - started < 10
+
+    interrupt = threading.Event()
+    limiter = BandwidthLimiter(0, interrupt=interrupt)
+    limiter.consume(1024)
+    interrupt.set()
+    with pytest.raises(JobInterrupted):
+        limiter.consume(1024)
+
+def test_preemption_picks_lowest_priority_job():
+    """Une vérification cède avant une sauvegarde; à priorité égale, le job le plus récent"""
+    from worker.preemption import choose_victim
+
+    def job(job_id, job_type, hour):
+        return Job(id=job_id, type=job_type, status="running", started_at=datetime(2024, 1, 1, hour))
+
+    assert choose_victim([job(1, "backup", 1), job(2, "check", 2), job(3, "check", 3)]).id == 3
+    assert choose_victim([job(1, "backup", 1), job(2, "backup", 2), job(3, "restore", 3)]).id == 2
+    assert choose_victim([job(1, "prune", 1), job(2, "restore", 2)]) is None
+    # Job sans date de démarrage (fuseau quelconque): choisi en dernier, sans erreur
+    pending = Job(id=4, type="check", status="running", started_at=None)
+    assert choose_victim([pending, job(5, "check", 1)]).id == 5
+    assert choose_victim([pending, job(6, "backup", 1)]).id == 4
+
+def test_agent_job_lifecycle(db, monkeypatch):
+    """Un job d'agent démarre sous bail puis son compte rendu crée le snapshot"""
+    import json
+    import worker.agent_jobs as agent_jobs
+
+    import worker.tasks
+
+    fakeredis = pytest.importorskip("fakeredis")
+    monkeypatch.setattr(worker.tasks, "redis_conn", fakeredis.FakeRedis())
+    monkeypatch.setattr(agent_jobs, "redis_conn", worker.tasks.redis_conn)
+    enqueued = []
+    monkeypatch.setattr(agent_jobs, "AGENT_REPO_URL", "ssh://saveos@backup/{repo_path}")
+    monkeypatch.setattr(agent_jobs.low_queue, "enqueue", lambda *args, **kwargs: enqueued.append(args))
+    monkeypatch.setattr(agent_jobs.repo_cache, "invalidate", lambda repo_path: None)
+
+    tenant = Tenant(name="t", used_bytes=0)
+    db.add(tenant)
+    db.flush()
+    agent = Agent(tenant_id=tenant.id, hostname="h", token="x")
+    db.add(agent)
+    db.flush()
+    job = Job(agent_id=agent.id, type="backup", status="pending",
+              config=json.dumps({'execution': 'agent', 'repo_path': '/repos/h', 'source_paths': ['/data']}))
+    db.add_all([job, Job(agent_id=agent.id, type="backup", status="pending")])
+    db.commit()
+
+    assert agent_jobs.pending_agent_jobs(db, agent) == [job]
+    spec = agent_jobs.start_agent_job(db, job, agent)
+    assert spec['repository'] == "ssh://saveos@backup/repos/h"
+    assert spec['archive_name'].startswith("h_")
+    assert job.status == "running" and job.lease_expires_at is not None
+    # Le repository reste réservé au job entre les requêtes de l'agent
+    assert worker.tasks.redis_conn.get("saveos:repo_lock:repos/h") == f"job:{job.id}".encode()
+    assert not agent_jobs.renew_agent_job(db, job, progress=50)['cancel']
+    from worker.object_store import checkout_repository
+    assert checkout_repository("/repos/h", wait=0.1) is None
+
+    # Chiffres annoncés par l'agent ignorés: usage et taille viennent du repository
+    agent_jobs.complete_agent_job(db, job, agent, {
+        'success': True, 'stats': {'compressed_size': 0, 'deduplicated_size': 0}
+    })
+    assert job.status == "completed"
+    assert worker.tasks.redis_conn.get("saveos:repo_lock:repos/h") is None
+    assert job.snapshot.name == spec['archive_name']
+    assert db.query(Tenant).one().used_bytes == 0
+    assert len(enqueued) == 1
+
+    class Borg:
+        def __init__(self, info):
+            self.info = info
+
+        def archive_info(self, name):
+            return self.info
+
+    agent_jobs.verify_agent_archive(db, job.snapshot, Borg({
+        'success': True, 'stats': {'compressed_size': 60, 'deduplicated_size': 10}
+    }))
+    assert job.snapshot.size_bytes == 60
+    assert db.query(Tenant).one().used_bytes == 10
+
+    # Succès annoncé sans archive dans le repository
+    other = Job(agent_id=agent.id, type="backup", status="pending",
+                config=json.dumps({'execution': 'agent', 'repo_path': '/repos/h', 'archive_name': 'fantome'}))
+    db.add(other)
+    db.commit()
+    agent_jobs.start_agent_job(db, other, agent)
+    agent_jobs.complete_agent_job(db, other, agent, {'success': True, 'stats': {}})
+    agent_jobs.verify_agent_archive(db, other.snapshot, Borg({'success': False, 'exists': False}))
+    assert other.status == "failed" and other.snapshot_id is None
+    assert db.query(Snapshot).filter(Snapshot.name == "fantome").count() == 0
+
+def test_agent_wakeup_long_poll(monkeypatch):
+    """Un job assigné réveille immédiatement l'attente de l'agent"""
+    import asyncio
+    import worker.agent_jobs as agent_jobs
+    fakeredis = pytest.importorskip("fakeredis")
+    from fakeredis import aioredis
+
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(agent_jobs, "redis_conn", fakeredis.FakeRedis(server=server))
+    monkeypatch.setattr(agent_jobs, "_async_redis", aioredis.FakeRedis(server=server))
+
+    async def scenario():
+        waiting = asyncio.ensure_future(agent_jobs.wait_for_wakeup(7, 5))
+        await asyncio.sleep(0.1)
+        agent_jobs.notify_agent(7)
+        return await asyncio.wait_for(waiting, 2)
+
+    assert asyncio.run(scenario()) is True
+    assert asyncio.run(agent_jobs.wait_for_wakeup(8, 1)) is False
@@ -47,6 +47,19 @@ export interface Snapshot {
   created_at: string
 }
 
+export interface TreeEntry {
+  name: string
+  type: string // 'd' = répertoire, '-' = fichier
+  size: number
+  mtime?: string
+}
+
+export interface DirectoryListing {
+  snapshot_id: number
+  path: string
+  entries: TreeEntry[]
+}
+
 // API Functions
 export const api = {
   // Santé de l'API
@@ -131,6 +144,14 @@ export const api = {
     ]
   },
 
+  // Navigation dans un snapshot (un niveau de répertoire à la fois)
+  async getSnapshotTree(snapshotId: number, path: string = ''): Promise<DirectoryListing> {
+    const response = await apiClient.get(`/api/v1/snapshots/${snapshotId}/tree`, {
+      params: { path }
+    })
+    return response.data
+  },
+
   // Téléchargement d'agent
   async downloadAgent(platform: string): Promise<Blob> {
     const response = await apiClient.get(`/download/agent/${platform}`, {
@@ -0,0 +1,280 @@
+"""
+Sauvegardes exécutées par les agents (le worker ne fait que coordonner)
+
+Un job de sauvegarde dont la configuration demande execution="agent" n'est pas mis en
+file RQ: l'agent le récupère, lance borg create localement vers le repository central
+(borg serve via SSH) et renvoie ses statistiques. Chunking et compression sont ainsi
+répartis sur le parc; le worker vérifie l'archive dans le repository (statistiques et
+usage lus par borg info, jamais repris de l'agent), l'indexe puis la réplique.
+
+Le job suit les mêmes règles que côté worker: bail renouvelé par l'agent, nom d'archive
+fixé au premier démarrage pour reprendre depuis un checkpoint, annulation relayée.
+"""
+import os
+import json
+import math
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional
+
+import redis
+import redis.asyncio
+
+from api.database import Job, Snapshot, Agent
+from worker.tasks import (
+    BorgManager, SessionLocal, low_queue, redis_conn, adjust_tenant_usage,
+    REDIS_URL, DEFAULT_REPO_ROOT, DEFAULT_PASSPHRASE, BORG_CHECKPOINT_INTERVAL, JOB_LEASE_TTL
+)
+from worker.catalog import build_catalog, catalog_path
+from worker.object_store import job_lease
+from worker.cancellation import interrupt_reason, clear_interrupt
+from worker import repo_cache
+
+# URL borg du repository central vue depuis les agents, ex. "ssh://saveos@backup.example.com/{repo_path}"
+AGENT_REPO_URL = os.getenv("AGENT_REPO_URL", "")
+# Durée de vie d'un signal de réveil qu'aucun agent n'a consommé
+AGENT_WAKE_TTL = 3600
+# Journal d'un job d'agent: dernières lignes conservées et durée de conservation
+JOB_LOG_MAX_LINES = int(os.getenv("JOB_LOG_MAX_LINES", "1000"))
+JOB_LOG_TTL = 7 * 24 * 3600
+
+_async_redis = None
+
+def job_config(job: Job) -> Dict[str, Any]:
+    try:
+        return json.loads(job.config) if job.config else {}
+    except ValueError:
+        return {}
+
+def is_agent_job(job: Job) -> bool:
+    """Vrai si le job est exécuté par l'agent lui-même"""
+    return job_config(job).get('execution') == 'agent'
+
+def agent_repository_url(repo_path: str) -> Optional[str]:
+    """Adresse du repository pour borg côté agent (None si l'exécution par les agents n'est pas configurée)"""
+    if not AGENT_REPO_URL:
+        return None
+    return AGENT_REPO_URL.format(repo_path=repo_path.lstrip('/'))
+
+def pending_agent_jobs(db, agent: Agent) -> List[Job]:
+    """Jobs en attente que l'agent doit exécuter"""
+    jobs = db.query(Job).filter(
+        Job.agent_id == agent.id,
+        Job.status == "pending"
+    ).order_by(Job.created_at).all()
+    return [job for job in jobs if is_agent_job(job)]
+
+def _wake_key(agent_id: int) -> str:
+    return f"saveos:agent_wake:{agent_id}"
+
+def notify_agent(agent_id: int):
+    """Réveille la requête d'attente (long-poll) de l'agent: un job vient de lui être assigné"""
+    try:
+        pipe = redis_conn.pipeline(transaction=True)
+        pipe.rpush(_wake_key(agent_id), 1)
+        pipe.expire(_wake_key(agent_id), AGENT_WAKE_TTL)
+        pipe.execute()
+    except redis.RedisError:
+        pass  # L'agent verra le job à sa prochaine requête
+
+async def wait_for_wakeup(agent_id: int, timeout: float) -> bool:
+    """Attend (sans bloquer la boucle asyncio) qu'un job soit assigné à l'agent"""
+    global _async_redis
+    if _async_redis is None:
+        _async_redis = redis.asyncio.from_url(REDIS_URL)
+    # Secondes entières (0 signifierait une attente infinie)
+    return await _async_redis.blpop([_wake_key(agent_id)], timeout=max(math.ceil(timeout), 1)) is not None
+
+def _log_key(job_id: int) -> str:
+    return f"saveos:job_log:{job_id}"
+
+def append_job_log(job_id: int, lines: List[str]):
+    """Ajoute les lignes envoyées par l'agent au journal du job (seules les dernières sont gardées)"""
+    if not lines:
+        return
+    pipe = redis_conn.pipeline(transaction=True)
+    pipe.rpush(_log_key(job_id), *lines)
+    pipe.ltrim(_log_key(job_id), -JOB_LOG_MAX_LINES, -1)
+    pipe.expire(_log_key(job_id), JOB_LOG_TTL)
+    pipe.execute()
+
+def job_log(job_id: int) -> List[str]:
+    return [line.decode() for line in redis_conn.lrange(_log_key(job_id), 0, -1)]
+
+def agent_job_repository(job: Job, agent: Agent) -> str:
+    return job_config(job).get('repo_path', f'{DEFAULT_REPO_ROOT}/{agent.hostname}')
+
+def start_agent_job(db, job: Job, agent: Agent) -> Optional[Dict[str, Any]]:
+    """Passe le job en cours sous bail et retourne ce dont l'agent a besoin pour lancer borg
+
+    Le verrou du repository est pris au nom du job (comme par un worker): prune,
+    vérification et réplication attendent la fin de l'écriture. None si un autre job le détient.
+    """
+    config = job_config(job)
+    repo_path = agent_job_repository(job, agent)
+    if not job_lease(repo_path, job.id, JOB_LEASE_TTL).claim():
+        return None
+
+    # Nom fixé au premier démarrage: une reprise retrouve le checkpoint de la tentative précédente
+    if not config.get('archive_name'):
+        config['archive_name'] = f"{agent.hostname}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}"
+        job.config = json.dumps(config)
+
+    job.status = "running"
+    job.started_at = job.started_at or datetime.utcnow()
+    job.attempts = (job.attempts or 0) + 1
+    job.worker_id = f"agent:{agent.id}"
+    job.lease_expires_at = datetime.utcnow() + timedelta(seconds=JOB_LEASE_TTL)
+    db.commit()
+
+    return {
+        'job_id': job.id,
+        'type': job.type,
+        'repository': agent_repository_url(repo_path),
+        'passphrase': config.get('passphrase', DEFAULT_PASSPHRASE),
+        'archive_name': config['archive_name'],
+        'source_paths': config.get('source_paths', []),
+        'exclude_patterns': config.get('exclude_patterns', []),
+        # La recommandation du conseiller repose sur des fichiers du worker, pas sur ceux de l'agent
+        'compression': config.get('compression'),
+        'checkpoint_interval': BORG_CHECKPOINT_INTERVAL,
+        'lease_ttl': JOB_LEASE_TTL
+    }
+
+def renew_agent_job(db, job: Job, progress: Optional[int] = None,
+                    log: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Prolonge le bail d'un job d'agent et son verrou; indique à l'agent si le job doit être interrompu"""
+    job.lease_expires_at = datetime.utcnow() + timedelta(seconds=JOB_LEASE_TTL)
+    if progress is not None:
+        job.progress = max(0, min(int(progress), 100))
+    db.commit()
+    append_job_log(job.id, log or [])
+    # Verrou expiré et repris par un autre job: l'agent ne doit plus écrire
+    lost = not job_lease(agent_job_repository(job, job.agent), job.id, JOB_LEASE_TTL).claim()
+    return {'cancel': lost or interrupt_reason(job.id) == 'cancel', 'lease_ttl': JOB_LEASE_TTL}
+
+def complete_agent_job(db, job: Job, agent: Agent, report: Dict[str, Any]) -> Dict[str, Any]:
+    """Enregistre le compte rendu d'un agent (snapshot et usage en cas de succès)"""
+    config = job_config(job)
+    repo_path = agent_job_repository(job, agent)
+    now = datetime.utcnow()
+    result = {'success': False, 'message': ''}
+
+    job_lease(repo_path, job.id).release()
+    job.lease_expires_at = None
+    job.finished_at = now
+    # Le repository a changé sans passer par BorgManager
+    repo_cache.invalidate(repo_path)
+
+    if report.get('cancelled'):
+        job.status = "cancelled"
+        job.error_message = "Annulé à la demande"
+        db.commit()
+        clear_interrupt(job.id)
+        result['message'] = f"Job {job.id} annulé"
+        return result
+
+    if not report.get('success'):
+        job.status = "failed"
+        job.error_message = report.get('error') or "Échec de la sauvegarde sur l'agent"
+        db.commit()
+        result['message'] = f"Échec de la sauvegarde: {job.error_message}"
+        return result
+
+    if report.get('skipped'):
+        job.status = "completed"
+        job.progress = 100
+        db.commit()
+        result['success'] = True
+        result['message'] = "Aucune modification depuis le dernier snapshot"
+        return result
+
+    stats = report.get('stats') or {}
+    # Taille et usage ne sont pas repris des chiffres de l'agent: finalize_agent_backup
+    # les lit dans le repository (et retire le snapshot si l'archive n'y est pas)
+    snapshot = Snapshot(
+        job_id=job.id,
+        name=config['archive_name'],
+        repo_path=repo_path,
+        size_bytes=0,
+        excluded_bytes=stats.get('excluded_bytes'),
+        is_full=True,  # Les archives de l'agent sont toujours complètes
+        created_at=now
+    )
+    db.add(snapshot)
+    db.flush()
+
+    job.status = "completed"
+    job.progress = 100
+    job.snapshot_id = snapshot.id
+    db.commit()
+
+    # Indexation et réplication restent côté serveur
+    low_queue.enqueue(finalize_agent_backup, snapshot.id, job_timeout='2h')
+
+    result['success'] = True
+    result['message'] = f"Sauvegarde réussie: {snapshot.name}"
+    result['snapshot_id'] = snapshot.id
+    return result
+
+def verify_agent_archive(db, snapshot: Snapshot, borg: BorgManager) -> Dict[str, Any]:
+    """Vérifie l'archive annoncée par l'agent et compte son usage d'après le repository"""
+    job = snapshot.job
+    info = borg.archive_info(snapshot.name)
+    if not info['success']:
+        if info.get('exists', True):
+            raise RuntimeError(info.get('stderr', info.get('error')))
+        # Succès annoncé sans archive: le job échoue, aucun snapshot n'est gardé
+        job.status = "failed"
+        job.error_message = f"Archive {snapshot.name} absente du repository"
+        job.snapshot_id = None
+        db.delete(snapshot)
+        db.commit()
+        return info
+
+    snapshot.size_bytes = info['stats']['compressed_size']
+    adjust_tenant_usage(db, job.agent.tenant_id, info['stats']['deduplicated_size'])
+    db.commit()
+    return info
+
+def finalize_agent_backup(snapshot_id: int) -> Dict[str, Any]:
+    """Vérifie et catalogue l'archive envoyée par un agent, puis demande sa réplication"""
+
+    db = SessionLocal()
+    result = {'success': False, 'message': ''}
+
+    try:
+        snapshot = db.query(Snapshot).filter(Snapshot.id == snapshot_id).first()
+        if not snapshot:
+            result['message'] = f"Snapshot {snapshot_id} non trouvé"
+            return result
+
+        job = snapshot.job
+        agent = job.agent
+        passphrase = job_config(job).get('passphrase', DEFAULT_PASSPHRASE)
+        borg = BorgManager(snapshot.repo_path, passphrase)
+
+        info = verify_agent_archive(db, snapshot, borg)
+        if not info['success']:
+            result['message'] = job.error_message
+            return result
+        result['stats'] = info['stats']
+
+        result['catalog_entries'] = build_catalog(
+            borg.iter_archive_items(snapshot.name),
+            catalog_path(snapshot.id)
+        )
+
+        # Import local: replication dépend de worker.tasks comme ce module
+        from worker.replication import request_replication
+        result['replication_job_id'] = request_replication(db, agent)
+
+        result['success'] = True
+        result['message'] = f"Archive {snapshot.name} indexée"
+
+    except Exception as e:
+        result['message'] = f"Erreur lors de l'indexation de l'archive: {str(e)}"
+
+    finally:
+        db.close()
+
+    return result
@@ -0,0 +1,123 @@
+"""
+Exécution de borg dans le processus du worker (BORG_EXECUTION=inprocess)
+
+Les opérations courtes et fréquentes (liste des archives, statistiques) sont servies
+par l'API Python de borg 1.x au lieu d'un sous-processus. Les modules borg et la clé
+déchiffrée (dérivation coûteuse de la passphrase) restent chargés d'un job à l'autre,
+ainsi que les statistiques du cache tant que le manifest du repository ne change pas.
+Les verrous borg ne sont tenus que le temps de chaque opération.
+
+Toute erreur (borg absent ou d'une version incompatible, repository verrouillé...)
+renvoie None: l'appelant se replie alors sur le sous-processus.
+"""
+import os
+import threading
+from typing import Dict, Any, Optional
+
+BORG_EXECUTION = os.getenv("BORG_EXECUTION", "subprocess")
+# Attente maximale (secondes) du verrou du repository ou du cache
+BORG_LOCK_WAIT = int(os.getenv("BORG_LOCK_WAIT", "10"))
+
+_lock = threading.Lock()
+# repo_path -> {'passphrase', 'repository_id', 'key'}
+_keys: Dict[str, Dict[str, Any]] = {}
+# repo_path -> {'manifest_id', 'stats'}
+_stats: Dict[str, Dict[str, Any]] = {}
+_borg = None
+
+def enabled() -> bool:
+    return BORG_EXECUTION == 'inprocess' and _load_borg() is not None
+
+def _load_borg():
+    """Importe borg une seule fois (None s'il n'est pas importable dans cet interpréteur)"""
+    global _borg
+    if _borg is None:
+        try:
+            from borg.repository import Repository
+            from borg.helpers import Manifest, bin_to_hex
+            from borg.cache import Cache
+            _borg = {'Repository': Repository, 'Manifest': Manifest, 'Cache': Cache,
+                     'bin_to_hex': bin_to_hex}
+        except ImportError:
+            _borg = False
+    return _borg or None
+
+def _with_manifest(repo_path: str, passphrase: str, env: Dict[str, str], func):
+    """Ouvre le repository sous verrou partagé, charge le manifest avec la clé en cache et appelle func"""
+    borg = _load_borg()
+    Manifest = borg['Manifest']
+
+    with _lock:
+        # borg lit la passphrase et ses réglages (BORG_*) dans l'environnement du processus
+        saved = {name: os.environ.get(name) for name in env if name.startswith('BORG_')}
+        os.environ.update({name: value for name, value in env.items() if name.startswith('BORG_')})
+        try:
+            with borg['Repository'](repo_path, exclusive=False, lock_wait=BORG_LOCK_WAIT) as repository:
+                cached = _keys.get(repo_path)
+                if (cached and cached['passphrase'] == passphrase
+                        and cached['repository_id'] == repository.id):
+                    manifest, key = Manifest.load(repository, (Manifest.Operation.READ,), key=cached['key'])
+                else:
+                    manifest, key = Manifest.load(repository, (Manifest.Operation.READ,))
+                    _keys[repo_path] = {'passphrase': passphrase, 'repository_id': repository.id, 'key': key}
+                return func(repository, manifest, key)
+        except Exception:
+            # Clé ou repository remplacés: on repart de zéro au prochain appel
+            _keys.pop(repo_path, None)
+            _stats.pop(repo_path, None)
+            raise
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+def list_archives(repo_path: str, passphrase: str, env: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    """Équivalent de `borg list --json` (mêmes champs que la sortie JSON)"""
+    def collect(repository, manifest, key):
+        archives = []
+        for info in manifest.archives.list(sort_by=['ts']):
+            # borg affiche les dates en heure locale, sans fuseau
+            timestamp = info.ts.astimezone().replace(tzinfo=None).isoformat(timespec='microseconds')
+            archives.append({
+                'archive': info.name,
+                'name': info.name,
+                'id': _load_borg()['bin_to_hex'](info.id),
+                'start': timestamp,
+                'time': timestamp
+            })
+        return archives, manifest.id.hex()
+
+    try:
+        archives, manifest_id = _with_manifest(repo_path, passphrase, env, collect)
+    except Exception:
+        return None
+    return {'success': True, 'archives': archives, 'manifest': manifest_id, 'stderr': ''}
+
+def repo_info(repo_path: str, passphrase: str, env: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    """Équivalent des statistiques de `borg info --json` (recalculées seulement si le manifest change)"""
+    def collect(repository, manifest, key):
+        cached = _stats.get(repo_path)
+        if cached and cached['manifest_id'] == manifest.id:
+            return cached['stats'], manifest.id.hex()
+
+        with _load_borg()['Cache'](repository, key, manifest, lock_wait=BORG_LOCK_WAIT) as cache:
+            (total_size, total_csize, unique_size, unique_csize,
+             total_unique_chunks, total_chunks) = cache.chunks.summarize()
+        stats = {
+            'total_chunks': total_chunks,
+            'total_csize': total_csize,
+            'total_size': total_size,
+            'total_unique_chunks': total_unique_chunks,
+            'unique_csize': unique_csize,
+            'unique_size': unique_size
+        }
+        _stats[repo_path] = {'manifest_id': manifest.id, 'stats': stats}
+        return stats, manifest.id.hex()
+
+    try:
+        stats, manifest_id = _with_manifest(repo_path, passphrase, env, collect)
+    except Exception:
+        return None
+    return {'success': True, 'stats': stats, 'manifest': manifest_id, 'stderr': ''}
@@ -0,0 +1,109 @@
+"""
+Interruption des jobs en cours (annulation à la demande)
+
+L'API dépose une demande dans Redis; le worker qui exécute le job la surveille depuis
+un thread et interrompt borg proprement: SIGINT d'abord (borg écrit un checkpoint et
+libère ses verrous), puis SIGKILL si le processus ne s'est pas arrêté après le délai
+de grâce. Le job libère ensuite son verrou de repository et son slot. Les transferts
+de réplication, sans processus à signaler, s'arrêtent au bloc suivant (JobInterrupted).
+"""
+import os
+import signal
+import subprocess
+import threading
+from typing import List, Dict, Optional
+
+import redis
+
+# Délai (secondes) laissé à borg entre SIGINT et SIGKILL
+JOB_CANCEL_GRACE = int(os.getenv("JOB_CANCEL_GRACE", "30"))
+# Fréquence de consultation des demandes d'interruption
+JOB_INTERRUPT_POLL = float(os.getenv("JOB_INTERRUPT_POLL", "1"))
+# Une demande non consommée (job jamais démarré) finit par expirer
+INTERRUPT_TTL = 24 * 3600
+# Types de jobs dont le worker surveille les demandes d'interruption en cours d'exécution
+INTERRUPTIBLE_TYPES = ('backup', 'restore', 'check', 'prune', 'replicate')
+
+class JobInterrupted(Exception):
+    """Levée par un transfert (sans processus borg à signaler) dont le job doit s'arrêter"""
+
+def _redis():
+    # Import local: worker.tasks utilise ce module depuis BorgManager
+    from worker.tasks import redis_conn
+    return redis_conn
+
+def _key(job_id: int) -> str:
+    return f"saveos:job_interrupt:{job_id}"
+
+def request_interrupt(job_id: int, reason: str = 'cancel'):
+    """Demande l'interruption d'un job"""
+    _redis().set(_key(job_id), reason, ex=INTERRUPT_TTL)
+
+def interrupt_reason(job_id: int) -> Optional[str]:
+    """Motif de l'interruption demandée, None s'il n'y en a pas"""
+    value = _redis().get(_key(job_id))
+    return value.decode() if value else None
+
+def clear_interrupt(job_id: int):
+    try:
+        _redis().delete(_key(job_id))
+    except redis.RedisError:
+        pass
+
+class InterruptWatcher:
+    """Surveille en tâche de fond la demande d'interruption d'un job"""
+
+    def __init__(self, job_id: int, poll: float = JOB_INTERRUPT_POLL):
+        self.job_id = job_id
+        self.poll = poll
+        self.event = threading.Event()
+        self.reason = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.poll):
+            try:
+                reason = interrupt_reason(self.job_id)
+            except redis.RedisError:
+                continue
+            if reason:
+                self.reason = reason
+                self.event.set()
+                return
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"interrupt-{self.job_id}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+def run_interruptible(cmd: List[str], env: Dict[str, str], interrupt: Optional[threading.Event] = None,
+                      grace: float = JOB_CANCEL_GRACE, poll: float = 0.5) -> subprocess.CompletedProcess:
+    """Équivalent de subprocess.run(capture_output=True, text=True) arrêtable par `interrupt`"""
+    if interrupt is None:
+        return subprocess.run(cmd, env=env, capture_output=True, text=True, check=False)
+
+    # Groupe de processus dédié: les signaux atteignent aussi les éventuels sous-processus de borg
+    process = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                               start_new_session=True)
+    signalled = False
+
+    while True:
+        try:
+            stdout, stderr = process.communicate(timeout=grace if signalled else poll)
+            break
+        except subprocess.TimeoutExpired:
+            if signalled:
+                # borg n'a pas terminé son checkpoint à temps
+                os.killpg(process.pid, signal.SIGKILL)
+                stdout, stderr = process.communicate()
+                break
+            if interrupt.is_set():
+                os.killpg(process.pid, signal.SIGINT)
+                signalled = True
+
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
@@ -0,0 +1,302 @@
+"""
+Catalogue des fichiers de chaque snapshot SaveOS (SQLite par snapshot)
+
+Les chemins sont stockés en table de répertoires + nom de fichier: chaque
+préfixe de répertoire n'est écrit qu'une seule fois, ce qui garde le
+catalogue compact même pour des millions de fichiers.
+"""
+import os
+import uuid
+import sqlite3
+from datetime import datetime
+from typing import Dict, Any, Callable, Iterable, List, Optional
+
+# Répertoire partagé entre le worker et l'API
+CATALOG_ROOT = os.getenv("CATALOG_ROOT", "/tmp/saveos_catalogs")
+# Listings construits à la demande pour les snapshots sans catalogue (éviction LRU)
+LISTING_CACHE_ROOT = os.getenv("LISTING_CACHE_ROOT", "/tmp/saveos_cache/listings")
+LISTING_CACHE_MAX_BYTES = int(os.getenv("LISTING_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+# Nombre d'entrées insérées par transaction lors de l'ingestion
+CATALOG_BATCH_SIZE = 5000
+
+_SCHEMA = """
+CREATE TABLE dirs (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL DEFAULT 0,
+    files INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE entries (
+    dir_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER
+);
+"""
+
+# Les index sont créés après l'ingestion (beaucoup plus rapide que maintenus à chaque insert)
+_INDEXES = """
+CREATE INDEX entries_name ON entries(name);
+CREATE INDEX entries_dir ON entries(dir_id);
+"""
+
+_FULL_PATH = "CASE WHEN d.path = '' THEN e.name ELSE d.path || '/' || e.name END"
+
+def catalog_path(snapshot_id: int) -> str:
+    """Chemin du fichier catalogue d'un snapshot"""
+    return os.path.join(CATALOG_ROOT, f"{snapshot_id}.sqlite")
+
+def listing_path(snapshot_id: int) -> str:
+    """Chemin du listing en cache d'un snapshot"""
+    return os.path.join(LISTING_CACHE_ROOT, f"{snapshot_id}.sqlite")
+
+def _parse_mtime(value: Optional[str]) -> Optional[int]:
+    """Convertit un mtime ISO de borg en timestamp (secondes)"""
+    if not value:
+        return None
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        return None
+
+def build_catalog(items: Iterable[Dict[str, Any]], path: str) -> int:
+    """Construit un catalogue depuis un flux d'entrées `borg list --json-lines`"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+
+    conn = sqlite3.connect(tmp_path)
+    count = 0
+    try:
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.executescript(_SCHEMA)
+
+        dir_ids = {}
+        dir_sizes = {}
+        dir_files = {}
+        dir_entries = set()
+
+        def dir_id_for(directory: str) -> int:
+            # Les ancêtres sont enregistrés aussi pour pouvoir naviguer depuis la racine
+            dir_id = dir_ids.get(directory)
+            if dir_id is None:
+                if directory:
+                    dir_id_for(directory.rpartition('/')[0])
+                dir_id = conn.execute("INSERT INTO dirs (path) VALUES (?)", (directory,)).lastrowid
+                dir_ids[directory] = dir_id
+            return dir_id
+
+        batch = []
+        for item in items:
+            item_path = item['path'].rstrip('/')
+            directory, _, name = item_path.rpartition('/')
+            item_type = item.get('type', '-')
+            size = item.get('size', 0) or 0
+
+            batch.append((dir_id_for(directory), name, item_type, size, _parse_mtime(item.get('mtime'))))
+            dir_sizes[directory] = dir_sizes.get(directory, 0) + size
+            dir_files[directory] = dir_files.get(directory, 0) + 1
+            if item_type == 'd':
+                dir_entries.add(item_path)
+                # Un répertoire vide doit rester navigable: sa propre ligne existe sans enfant
+                dir_id_for(item_path)
+
+            if len(batch) >= CATALOG_BATCH_SIZE:
+                conn.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?)", batch)
+                count += len(batch)
+                batch = []
+
+        if batch:
+            conn.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?)", batch)
+            count += len(batch)
+
+        # Répertoires intermédiaires non archivés (ex: "home" pour /home/x/Documents)
+        conn.executemany("INSERT INTO entries VALUES (?, ?, 'd', 0, NULL)", [
+            (dir_ids[directory.rpartition('/')[0]], directory.rpartition('/')[2])
+            for directory in dir_ids
+            if directory and directory not in dir_entries
+        ])
+
+        # Taille et nombre d'entrées cumulés: on remonte des répertoires les plus profonds vers la racine
+        for directory in sorted(dir_ids, key=lambda d: d.count('/') if d else -1, reverse=True):
+            if directory:
+                parent = directory.rpartition('/')[0]
+                dir_sizes[parent] = dir_sizes.get(parent, 0) + dir_sizes.get(directory, 0)
+                dir_files[parent] = dir_files.get(parent, 0) + dir_files.get(directory, 0)
+        conn.executemany("UPDATE dirs SET size = ?, files = ? WHERE id = ?", [
+            (dir_sizes.get(directory, 0), dir_files.get(directory, 0), dir_id)
+            for directory, dir_id in dir_ids.items()
+        ])
+
+        conn.executescript(_INDEXES)
+        conn.commit()
+    finally:
+        conn.close()
+
+    try:
+        # Remplacement atomique: un lecteur ne voit jamais de catalogue partiel
+        os.replace(tmp_path, path)
+    except OSError:
+        os.unlink(tmp_path)
+        raise
+    return count
+
+def list_directory(path: str, directory: str) -> Optional[List[Dict[str, Any]]]:
+    """Liste un seul niveau de répertoire d'un catalogue (None si le répertoire n'existe pas)"""
+    directory = directory.strip('/')
+
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        row = conn.execute("SELECT id FROM dirs WHERE path = ?", (directory,)).fetchone()
+        if not row:
+            # Catalogues antérieurs: un répertoire vide n'y a pas de ligne propre
+            parent, _, name = directory.rpartition('/')
+            exists = directory and conn.execute(
+                "SELECT 1 FROM entries e JOIN dirs d ON d.id = e.dir_id "
+                "WHERE d.path = ? AND e.name = ? AND e.type = 'd'",
+                (parent, name)
+            ).fetchone()
+            return [] if exists else None
+
+        prefix = f"{directory}/" if directory else ""
+        rows = conn.execute(
+            "SELECT e.name, e.type, COALESCE(sub.size, e.size), e.mtime "
+            "FROM entries e "
+            "LEFT JOIN dirs sub ON e.type = 'd' AND sub.path = ? || e.name "
+            "WHERE e.dir_id = ? "
+            "ORDER BY e.type != 'd', e.name",
+            (prefix, row[0])
+        ).fetchall()
+    finally:
+        conn.close()
+
+    return [
+        {
+            'name': row[0],
+            'type': row[1],
+            'size': row[2],
+            'mtime': datetime.fromtimestamp(row[3]) if row[3] is not None else None
+        }
+        for row in rows
+    ]
+
+def ensure_listing(snapshot_id: int, items_factory: Callable[[], Iterable[Dict[str, Any]]]) -> str:
+    """Retourne un catalogue navigable: le catalogue persistant, sinon un listing construit une seule fois"""
+    path = catalog_path(snapshot_id)
+    if os.path.exists(path):
+        return path
+
+    path = listing_path(snapshot_id)
+    if os.path.exists(path):
+        # La date de modification sert de date de dernier accès pour l'éviction
+        os.utime(path)
+        return path
+
+    build_catalog(items_factory(), path)
+    evict_listings()
+    return path
+
+def evict_listings(max_bytes: int = LISTING_CACHE_MAX_BYTES) -> int:
+    """Supprime les listings les moins récemment utilisés au-delà du budget disque"""
+    if not os.path.isdir(LISTING_CACHE_ROOT):
+        return 0
+
+    listings = []
+    for name in os.listdir(LISTING_CACHE_ROOT):
+        if name.endswith('.sqlite'):
+            path = os.path.join(LISTING_CACHE_ROOT, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            listings.append((stat.st_mtime, stat.st_size, path))
+
+    listings.sort()
+    total = sum(size for _, size, _ in listings)
+    evicted = 0
+    # Le listing le plus récent est toujours conservé
+    for _, size, path in listings[:-1]:
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        evicted += 1
+
+    return evicted
+
+def path_stats(path: str, item_path: str) -> Optional[Dict[str, Any]]:
+    """Taille et nombre d'entrées d'un chemin (récursif pour un répertoire), None s'il est absent"""
+    item_path = item_path.strip('/')
+    directory, _, name = item_path.rpartition('/')
+
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        row = conn.execute("SELECT size, files FROM dirs WHERE path = ?", (item_path,)).fetchone()
+        if row:
+            return {'type': 'd', 'size': row[0], 'files': row[1] + 1}
+
+        row = conn.execute(
+            "SELECT e.type, e.size FROM entries e JOIN dirs d ON d.id = e.dir_id "
+            "WHERE d.path = ? AND e.name = ?",
+            (directory, name)
+        ).fetchone()
+        if row:
+            return {'type': row[0], 'size': row[1], 'files': 1}
+    finally:
+        conn.close()
+
+    return None
+
+def delete_catalog(snapshot_id: int):
+    """Supprime le catalogue (et le listing en cache) d'un snapshot s'ils existent"""
+    for path in (catalog_path(snapshot_id), listing_path(snapshot_id)):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+def _escape_like(value: str) -> str:
+    """Échappe les jokers LIKE"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def search_catalog(path: str, pattern: str, mode: str = "glob", limit: int = 100) -> List[Dict[str, Any]]:
+    """Recherche dans un catalogue par motif glob ou sous-chaîne"""
+    if not os.path.exists(path):
+        return []
+
+    if mode == "substring":
+        where = f"{_FULL_PATH} LIKE ? ESCAPE '\\'"
+        param = f"%{_escape_like(pattern)}%"
+    else:
+        pattern = pattern.lstrip('/')
+        if '/' in pattern:
+            where = f"{_FULL_PATH} GLOB ?"
+        else:
+            # Motif sans répertoire: on ne compare que le nom (évite la concaténation)
+            where = "e.name GLOB ?"
+        param = pattern
+
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        rows = conn.execute(
+            f"SELECT {_FULL_PATH}, e.type, e.size, e.mtime "
+            f"FROM entries e JOIN dirs d ON d.id = e.dir_id "
+            f"WHERE {where} LIMIT ?",
+            (param, limit)
+        ).fetchall()
+    finally:
+        conn.close()
+
+    return [
+        {
+            'path': row[0],
+            'type': row[1],
+            'size': row[2],
+            'mtime': datetime.fromtimestamp(row[3]) if row[3] is not None else None
+        }
+        for row in rows
+    ]
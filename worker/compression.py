@@ -0,0 +1,226 @@
+"""
+Conseiller de compression SaveOS
+
+Un échantillon des fichiers de l'agent (tiré proportionnellement à leur taille) est
+sauvegardé dans des repositories jetables avec plusieurs algorithmes; le meilleur
+compromis taux de compression / débit devient l'option --compression de l'agent.
+L'échantillon est lu sur le worker: les agents qui exécutent eux-mêmes leurs
+sauvegardes (execution="agent") ne sont pas évalués.
+"""
+import os
+import json
+import math
+import heapq
+import random
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional
+
+from api.database import Job, Agent
+from worker.tasks import BorgManager, SessionLocal, low_queue
+
+# Algorithmes évalués (auto,X: borg teste la compressibilité de chaque chunk avec lz4)
+COMPRESSION_CANDIDATES = os.getenv(
+    "COMPRESSION_CANDIDATES", "lz4;zstd,1;zstd,3;zstd,6;auto,zstd,3;auto,zstd,9"
+).split(';')
+# Taille de l'échantillon: nombre de fichiers, octets lus par fichier et au total
+COMPRESSION_SAMPLE_FILES = int(os.getenv("COMPRESSION_SAMPLE_FILES", "200"))
+COMPRESSION_SAMPLE_CHUNK = int(os.getenv("COMPRESSION_SAMPLE_CHUNK", str(4 * 1024 * 1024)))
+COMPRESSION_SAMPLE_BYTES = int(os.getenv("COMPRESSION_SAMPLE_BYTES", str(128 * 1024 * 1024)))
+# Nombre maximum de fichiers parcourus pour constituer l'échantillon
+COMPRESSION_SCAN_LIMIT = int(os.getenv("COMPRESSION_SCAN_LIMIT", "50000"))
+# Débit minimum (octets/s) pour qu'un algorithme soit retenu
+COMPRESSION_MIN_THROUGHPUT = int(os.getenv("COMPRESSION_MIN_THROUGHPUT", str(50 * 1024 * 1024)))
+# Âge maximum d'une recommandation avant nouvelle évaluation
+COMPRESSION_ADVICE_MAX_AGE = timedelta(days=int(os.getenv("COMPRESSION_ADVICE_MAX_AGE_DAYS", "30")))
+# Gain minimum pour préférer un algorithme plus lent, et en dessous duquel on ne compresse pas
+COMPRESSION_MIN_GAIN = 1.02
+COMPRESSION_USELESS_RATIO = 1.05
+
+def sample_files(source_paths: List[str], count: int = COMPRESSION_SAMPLE_FILES,
+                 scan_limit: int = COMPRESSION_SCAN_LIMIT, rng: Optional[random.Random] = None) -> List[str]:
+    """Tire des fichiers au hasard, pondérés par leur taille (réservoir pondéré A-Res)"""
+    rng = rng or random.Random()
+    reservoir = []  # Tas (clé, chemin): la plus petite clé est évincée en premier
+    scanned = 0
+    pending = list(source_paths)
+
+    while pending and scanned < scan_limit:
+        path = pending.pop()
+        try:
+            if os.path.isfile(path) and not os.path.islink(path):
+                entries = [(path, os.path.getsize(path))]
+            else:
+                entries = []
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            entries.append((entry.path, entry.stat(follow_symlinks=False).st_size))
+        except OSError:
+            continue
+
+        for file_path, size in entries:
+            if size <= 0:
+                continue
+            scanned += 1
+            key = math.log(rng.random() or 1e-12) / size
+            if len(reservoir) < count:
+                heapq.heappush(reservoir, (key, file_path))
+            elif key > reservoir[0][0]:
+                heapq.heapreplace(reservoir, (key, file_path))
+
+    return [file_path for _, file_path in reservoir]
+
+def build_sample(files: List[str], sample_dir: str, chunk_size: int = COMPRESSION_SAMPLE_CHUNK,
+                 max_bytes: int = COMPRESSION_SAMPLE_BYTES) -> int:
+    """Copie le début de chaque fichier échantillonné dans un répertoire de travail"""
+    total = 0
+    for index, file_path in enumerate(files):
+        if total >= max_bytes:
+            break
+        try:
+            with open(file_path, 'rb') as f:
+                data = f.read(min(chunk_size, max_bytes - total))
+        except OSError:
+            continue
+        # L'extension est conservée: certains types de fichiers se ressemblent davantage entre eux
+        name = f"{index}{os.path.splitext(file_path)[1][:16]}"
+        with open(os.path.join(sample_dir, name), 'wb') as out:
+            out.write(data)
+        total += len(data)
+    return total
+
+def benchmark_compression(sample_dir: str, candidates: List[str] = COMPRESSION_CANDIDATES) -> List[Dict[str, Any]]:
+    """Sauvegarde l'échantillon avec chaque algorithme dans un repository jetable"""
+    results = []
+    for spec in candidates:
+        work_dir = tempfile.mkdtemp(prefix="saveos_bench_")
+        try:
+            borg = BorgManager(os.path.join(work_dir, "repo"), "benchmark")
+            # Cache et clés isolés: rien ne subsiste dans la configuration borg du worker
+            borg.env['BORG_CACHE_DIR'] = os.path.join(work_dir, "cache")
+            borg.env['BORG_CONFIG_DIR'] = os.path.join(work_dir, "config")
+
+            init_result = borg.init_repo()
+            if not init_result['success']:
+                raise RuntimeError(init_result.get('stderr', init_result.get('error')))
+
+            backup = borg.create_backup([sample_dir], "benchmark", compression=spec)
+            stats = backup.get('stats', {})
+            if not backup['success'] or not stats.get('compressed_size'):
+                continue
+
+            duration = stats.get('duration') or 0
+            results.append({
+                'compression': spec,
+                'ratio': stats['original_size'] / stats['compressed_size'],
+                'throughput': stats['original_size'] / duration if duration else 0.0
+            })
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+def choose_compression(results: List[Dict[str, Any]],
+                       min_throughput: int = COMPRESSION_MIN_THROUGHPUT) -> Optional[str]:
+    """Meilleur taux parmi les algorithmes assez rapides; un gain marginal ne justifie pas plus de CPU"""
+    if not results:
+        return None
+    if max(r['ratio'] for r in results) < COMPRESSION_USELESS_RATIO:
+        return 'none'  # Données déjà compressées (médias, archives...): ne pas dépenser de CPU
+
+    fast = [r for r in results if r['throughput'] >= min_throughput]
+    # Aucun algorithme assez rapide: le plus rapide l'emporte
+    if not fast:
+        return max(results, key=lambda r: r['throughput'])['compression']
+
+    best = None
+    for result in sorted(fast, key=lambda r: r['throughput'], reverse=True):
+        if best is None or result['ratio'] > best['ratio'] * COMPRESSION_MIN_GAIN:
+            best = result
+    return best['compression']
+
+def _last_backup_config(db, agent: Agent) -> Dict[str, Any]:
+    """Configuration de la dernière sauvegarde de l'agent (chemins, mode d'exécution)"""
+    last_job = db.query(Job).filter(
+        Job.agent_id == agent.id,
+        Job.type == "backup",
+        Job.config.isnot(None)
+    ).order_by(Job.created_at.desc()).first()
+
+    try:
+        return json.loads(last_job.config) if last_job else {}
+    except (TypeError, ValueError):
+        return {}
+
+def advise_compression(agent_id: int) -> Dict[str, Any]:
+    """Évalue les algorithmes sur un échantillon de l'agent et enregistre la recommandation"""
+
+    db = SessionLocal()
+    result = {'success': False, 'message': ''}
+    sample_dir = None
+
+    try:
+        agent = db.query(Agent).filter(Agent.id == agent_id).first()
+        if not agent:
+            result['message'] = f"Agent {agent_id} non trouvé"
+            return result
+
+        config = _last_backup_config(db, agent)
+        if config.get('execution') == 'agent':
+            # Les source_paths n'existent que sur la machine de l'agent: rien à échantillonner ici
+            result['message'] = f"Sauvegardes exécutées par {agent.hostname}: compression non évaluée"
+            return result
+
+        files = sample_files(config.get('source_paths', []))
+        if not files:
+            result['message'] = f"Aucun fichier à échantillonner pour {agent.hostname}"
+            return result
+
+        sample_dir = tempfile.mkdtemp(prefix="saveos_sample_")
+        sample_bytes = build_sample(files, sample_dir)
+
+        benchmarks = benchmark_compression(sample_dir)
+        compression = choose_compression(benchmarks)
+        if not compression:
+            result['message'] = "Aucun algorithme n'a pu être évalué"
+            return result
+
+        agent.compression = compression
+        agent.compression_updated_at = datetime.utcnow()
+        db.commit()
+
+        result['success'] = True
+        result['message'] = f"Compression recommandée pour {agent.hostname}: {compression}"
+        result['compression'] = compression
+        result['sample_bytes'] = sample_bytes
+        result['benchmarks'] = benchmarks
+
+    except Exception as e:
+        result['message'] = f"Erreur lors de l'évaluation de la compression: {str(e)}"
+
+    finally:
+        if sample_dir:
+            shutil.rmtree(sample_dir, ignore_errors=True)
+        db.close()
+
+    return result
+
+def schedule_compression_advice() -> int:
+    """Réévalue la compression des agents sans recommandation récente"""
+    db = SessionLocal()
+    try:
+        expiry = datetime.utcnow() - COMPRESSION_ADVICE_MAX_AGE
+        agent_ids = [agent_id for (agent_id,) in db.query(Agent.id).filter(
+            db.query(Job.id).filter(Job.agent_id == Agent.id, Job.type == "backup").exists(),
+            (Agent.compression_updated_at.is_(None)) | (Agent.compression_updated_at < expiry)
+        ).all()]
+    finally:
+        db.close()
+
+    for agent_id in agent_ids:
+        low_queue.enqueue(advise_compression, agent_id, job_timeout='1h')
+
+    return len(agent_ids)
@@ -0,0 +1,75 @@
+"""
+Différences entre snapshots SaveOS (borg diff) avec cache NDJSON par paire
+"""
+import os
+import glob
+import json
+import uuid
+from typing import Dict, Any, Iterable, Iterator
+
+# Les archives étant immuables, un diff calculé reste valide jusqu'au prune
+DIFF_CACHE_ROOT = os.getenv("DIFF_CACHE_ROOT", "/tmp/saveos_cache/diffs")
+
+def diff_cache_path(snapshot_a: int, snapshot_b: int) -> str:
+    """Chemin du cache NDJSON du diff a -> b"""
+    return os.path.join(DIFF_CACHE_ROOT, f"{snapshot_a}_{snapshot_b}.ndjson")
+
+def normalize_diff_entry(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Réduit une entrée `borg diff --json-lines` à (chemin, changement, delta de taille)"""
+    change = "modified"
+    size_delta = 0
+
+    for detail in item.get('changes', []):
+        kind = detail.get('type', '')
+        if kind == 'added':
+            change = "added"
+            size_delta += detail.get('size', 0)
+        elif kind == 'removed':
+            change = "removed"
+            size_delta -= detail.get('size', 0)
+        elif kind == 'modified':
+            size_delta += detail.get('added', 0) - detail.get('removed', 0)
+        elif kind.startswith('added '):  # added directory, added link...
+            change = "added"
+        elif kind.startswith('removed '):
+            change = "removed"
+
+    return {'path': item.get('path', ''), 'change': change, 'size_delta': size_delta}
+
+def stream_diff(items: Iterable[Dict[str, Any]], cache_file: str) -> Iterator[str]:
+    """Produit le diff en NDJSON tout en l'écrivant dans le cache (publié seulement si complet)"""
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_path = f"{cache_file}.{uuid.uuid4().hex}.tmp"
+    complete = False
+
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as out:
+            try:
+                for item in items:
+                    line = json.dumps(normalize_diff_entry(item)) + "\n"
+                    out.write(line)
+                    yield line
+            except RuntimeError as e:
+                # Le statut HTTP est déjà parti: l'erreur est signalée dans le flux
+                yield json.dumps({'error': str(e).strip()}) + "\n"
+                return
+        os.replace(tmp_path, cache_file)
+        complete = True
+    finally:
+        if not complete and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+def iter_cached_diff(cache_file: str) -> Iterator[str]:
+    """Relit un diff en cache ligne par ligne"""
+    with open(cache_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            yield line
+
+def delete_cached_diffs(snapshot_id: int):
+    """Supprime les diffs en cache impliquant un snapshot"""
+    for pattern in (f"{snapshot_id}_*.ndjson", f"*_{snapshot_id}.ndjson"):
+        for path in glob.glob(os.path.join(DIFF_CACHE_ROOT, pattern)):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,430 @@
+"""
+Stockage objet (S3/MinIO) des repositories borg
+
+Les workers travaillent sur une copie locale du repository, synchronisée avec le
+bucket avant et après chaque job. Les segments borg (data/) étant immuables, seuls
+les nouveaux segments sont transférés; les gros fichiers passent en multipart, avec
+plusieurs fichiers et plusieurs parts en parallèle.
+"""
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Any, Optional
+
+# Backend des repositories: "local" (disque du worker) ou "s3" (bucket MinIO/S3)
+REPO_STORAGE = os.getenv("REPO_STORAGE", "local")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL", f"http://{os.getenv('MINIO_ENDPOINT', 'localhost:9000')}")
+S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY", os.getenv("MINIO_ROOT_USER", "saveos"))
+S3_SECRET_KEY = os.getenv("S3_SECRET_KEY", os.getenv("MINIO_ROOT_PASSWORD", "saveos123456"))
+S3_BUCKET = os.getenv("S3_BUCKET", "saveos-repos")
+S3_PREFIX = os.getenv("S3_PREFIX", "repos")
+# Taille des parts multipart et nombre de transferts simultanés
+S3_PART_SIZE = int(os.getenv("S3_PART_SIZE", str(64 * 1024 * 1024)))
+S3_CONCURRENCY = int(os.getenv("S3_CONCURRENCY", "8"))
+# Durée maximale de détention du verrou d'un repository (un job à la fois par repository)
+REPO_LOCK_TIMEOUT = int(os.getenv("REPO_LOCK_TIMEOUT", str(12 * 3600)))
+# Attente maximale du verrou par un job (secondes) et délai avant sa nouvelle tentative
+REPO_LOCK_WAIT = int(os.getenv("REPO_LOCK_WAIT", "600"))
+REPO_LOCK_RETRY_DELAY = int(os.getenv("REPO_LOCK_RETRY_DELAY", "300"))
+
+# État de la dernière synchronisation, conservé dans la copie locale (.saveos-*)
+SYNC_STATE_FILE = ".saveos-sync.json"
+# Verrous locaux de borg: propres à chaque machine, jamais synchronisés
+LOCAL_ONLY = ('lock.exclusive', 'lock.roster')
+
+def s3_client():
+    """Client S3 configuré pour MinIO (boto3 n'est requis qu'avec REPO_STORAGE=s3)"""
+    import boto3
+
+    return boto3.client(
+        's3',
+        endpoint_url=S3_ENDPOINT_URL,
+        aws_access_key_id=S3_ACCESS_KEY,
+        aws_secret_access_key=S3_SECRET_KEY
+    )
+
+def _transfer_config(part_size: int, concurrency: int):
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(
+        multipart_threshold=part_size,
+        multipart_chunksize=part_size,
+        max_concurrency=concurrency,
+        use_threads=True
+    )
+
+class BandwidthLimiter:
+    """Seau à jetons partagé entre les threads de transfert (0 = débit illimité)
+
+    Consulté à chaque bloc transféré, il arrête aussi les transferts dès que `interrupt` est levé.
+    """
+
+    def __init__(self, bytes_per_second: int, interrupt: Optional[threading.Event] = None):
+        self.rate = bytes_per_second
+        self.interrupt = interrupt
+        self.allowance = float(bytes_per_second)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount: int):
+        """Bloque l'appelant le temps nécessaire pour rester sous le débit maximum"""
+        if self.interrupt is not None and self.interrupt.is_set():
+            from worker.cancellation import JobInterrupted
+            raise JobInterrupted("Transfert interrompu")
+        if self.rate <= 0 or amount <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.allowance + (now - self.updated) * self.rate, self.rate)
+            self.updated = now
+            self.allowance -= amount
+            wait = -self.allowance / self.rate if self.allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+def is_segment(rel_path: str) -> bool:
+    """Les segments borg sont écrits une seule fois puis supprimés par compact"""
+    return rel_path.startswith('data/')
+
+def scan_repository(path: str) -> Dict[str, Dict[str, int]]:
+    """Fichiers d'un repository: chemin relatif -> taille et mtime (verrous et état exclus)"""
+    files = {}
+    if not os.path.isdir(path):
+        return files
+
+    for root, dirs, names in os.walk(path):
+        dirs[:] = [d for d in dirs if d not in LOCAL_ONLY]
+        for name in names:
+            full_path = os.path.join(root, name)
+            rel_path = os.path.relpath(full_path, path).replace(os.sep, '/')
+            if rel_path in LOCAL_ONLY or name.startswith('.saveos-'):
+                continue
+            stat = os.stat(full_path)
+            files[rel_path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    return files
+
+def run_transfers(func, rel_paths, concurrency: int):
+    """Exécute les transferts en parallèle (chacun pouvant lui-même être multipart)"""
+    if not rel_paths:
+        return
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # list() propage la première erreur de transfert
+        list(executor.map(func, rel_paths))
+
+class RepositoryStore:
+    """Synchronisation incrémentale d'un repository local avec un préfixe du bucket"""
+
+    def __init__(self, local_path: str, client=None, bucket: str = S3_BUCKET,
+                 prefix: Optional[str] = None, part_size: int = S3_PART_SIZE,
+                 concurrency: int = S3_CONCURRENCY, limiter: Optional[BandwidthLimiter] = None,
+                 state_file: str = SYNC_STATE_FILE):
+        self.local_path = local_path
+        self.limiter = limiter
+        self.state_file = state_file
+        self.client = client or s3_client()
+        self.bucket = bucket
+        self.prefix = (prefix if prefix is not None
+                       else f"{S3_PREFIX}/{local_path.strip('/')}").strip('/')
+        self.concurrency = max(concurrency, 1)
+        self.transfer_config = _transfer_config(part_size, self.concurrency)
+
+    def _key(self, rel_path: str) -> str:
+        return f"{self.prefix}/{rel_path}"
+
+    def _local(self, rel_path: str) -> str:
+        return os.path.join(self.local_path, *rel_path.split('/'))
+
+    def remote_objects(self) -> Dict[str, Dict[str, Any]]:
+        """Objets du repository dans le bucket: chemin relatif -> taille et ETag"""
+        objects = {}
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{self.prefix}/"):
+            for obj in page.get('Contents', []):
+                rel_path = obj['Key'][len(self.prefix) + 1:]
+                objects[rel_path] = {'size': obj['Size'], 'etag': obj['ETag']}
+        return objects
+
+    def local_files(self) -> Dict[str, Dict[str, int]]:
+        """Fichiers de la copie locale: chemin relatif -> taille et mtime"""
+        return scan_repository(self.local_path)
+
+    def _load_state(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(os.path.join(self.local_path, self.state_file), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self, remote: Dict[str, Dict[str, Any]]):
+        """Mémorise, pour chaque objet, l'ETag distant et la version locale correspondante"""
+        local = self.local_files()
+        state = {
+            rel_path: {**obj, **local[rel_path]}
+            for rel_path, obj in remote.items() if rel_path in local
+        }
+        tmp_path = os.path.join(self.local_path, f"{self.state_file}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, os.path.join(self.local_path, self.state_file))
+
+    def _upload(self, rel_path: str):
+        self.client.upload_file(
+            self._local(rel_path), self.bucket, self._key(rel_path),
+            Config=self.transfer_config, Callback=self.limiter.consume if self.limiter else None
+        )
+
+    def _download(self, rel_path: str):
+        path = self._local(rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Téléchargement à côté puis renommage: jamais de fichier tronqué dans le repository
+        tmp_path = f"{path}.part"
+        self.client.download_file(
+            self.bucket, self._key(rel_path), tmp_path,
+            Config=self.transfer_config, Callback=self.limiter.consume if self.limiter else None
+        )
+        os.replace(tmp_path, path)
+
+    def push(self) -> Dict[str, int]:
+        """Envoie les modifications locales: nouveaux segments d'abord, index ensuite, puis purge"""
+        state = self._load_state()
+        remote = self.remote_objects()
+        local = self.local_files()
+
+        changed = [
+            rel_path for rel_path, info in local.items()
+            if rel_path not in remote
+            or remote[rel_path]['size'] != info['size']
+            or (not is_segment(rel_path)
+                and state.get(rel_path, {}).get('mtime_ns') != info['mtime_ns'])
+        ]
+        # Le bucket reste cohérent à tout instant: les index ne référencent que des segments déjà présents
+        run_transfers(self._upload, sorted(p for p in changed if is_segment(p)), self.concurrency)
+        run_transfers(self._upload, sorted(p for p in changed if not is_segment(p)), self.concurrency)
+
+        removed = [rel_path for rel_path in remote if rel_path not in local]
+        for i in range(0, len(removed), 1000):
+            self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={'Objects': [{'Key': self._key(p)} for p in removed[i:i + 1000]]}
+            )
+
+        self._save_state(self.remote_objects())
+        return {
+            'uploaded': len(changed),
+            'uploaded_bytes': sum(local[p]['size'] for p in changed),
+            'deleted': len(removed)
+        }
+
+    def pull(self) -> Dict[str, int]:
+        """Met la copie locale à jour depuis le bucket (objets nouveaux ou modifiés seulement)"""
+        state = self._load_state()
+        remote = self.remote_objects()
+        if not remote:
+            return {'downloaded': 0, 'downloaded_bytes': 0, 'deleted': 0}
+
+        os.makedirs(self.local_path, exist_ok=True)
+        local = self.local_files()
+        changed = [
+            rel_path for rel_path, obj in remote.items()
+            if rel_path not in local
+            or local[rel_path]['size'] != obj['size']
+            or state.get(rel_path, {}).get('etag') != obj['etag']
+            or state.get(rel_path, {}).get('mtime_ns') != local[rel_path]['mtime_ns']
+        ]
+        run_transfers(self._download, sorted(changed), self.concurrency)
+
+        removed = [rel_path for rel_path in local if rel_path not in remote]
+        for rel_path in removed:
+            os.unlink(self._local(rel_path))
+
+        self._save_state(remote)
+        return {
+            'downloaded': len(changed),
+            'downloaded_bytes': sum(remote[p]['size'] for p in changed),
+            'deleted': len(removed)
+        }
+
+class RepositoryLease:
+    """Repository réservé par un job (verrou Redis partagé entre workers)"""
+
+    def __init__(self, store: Optional[RepositoryStore], lock, repo_path: str = ''):
+        self.store = store
+        self.lock = lock
+        self.repo_path = repo_path
+
+    def push(self) -> Dict[str, int]:
+        """Envoie la copie locale vers le bucket (sans effet en stockage local)"""
+        return self.store.push() if self.store else {}
+
+    def renew(self):
+        """Repart pour une durée complète de verrou (jobs longs sous heartbeat, depuis leur thread)"""
+        from redis.exceptions import LockError
+
+        try:
+            self.lock.reacquire()
+        except LockError as e:
+            raise RuntimeError(f"Verrou du repository perdu: {e}") from e
+
+    def release(self):
+        try:
+            self.lock.release()
+        except Exception:
+            pass  # Verrou expiré: un autre job a pu reprendre la main
+
+    def claim(self) -> bool:
+        """Prend le verrou avec le jeton de la réservation, ou le prolonge s'il lui appartient déjà
+
+        Une première prise échoue tant que des restaurations lisent le repository.
+        """
+        if self.lock.acquire(blocking=False, token=self.lock.local.token):
+            if _active_readers(self.repo_path):
+                self.lock.release()
+                return False
+            return True
+        try:
+            self.renew()
+        except RuntimeError:
+            return False
+        return True
+
+def _repository_lock(repo_path: str, timeout: int = REPO_LOCK_TIMEOUT):
+    from worker.tasks import redis_conn
+
+    # Jeton non lié au thread: le verrou est pris, renouvelé (heartbeat) et libéré
+    # depuis des threads différents
+    return redis_conn.lock(f"saveos:repo_lock:{repo_path.strip('/')}", timeout=timeout, thread_local=False)
+
+def job_lease(repo_path: str, job_id: int, timeout: int = REPO_LOCK_TIMEOUT) -> RepositoryLease:
+    """Réservation d'un repository au nom d'un job dont chaque requête arrive séparément (job d'agent)
+
+    Le jeton du verrou est dérivé du job: la réservation est reconstituée à chaque requête
+    pour être prise (claim), renouvelée ou libérée, quel que soit le processus de l'API.
+    """
+    lock = _repository_lock(repo_path, timeout)
+    lock.local.token = f"job:{job_id}".encode()
+    return RepositoryLease(None, lock, repo_path)
+
+def _readers_key(repo_path: str) -> str:
+    return f"saveos:repo_readers:{repo_path.strip('/')}"
+
+class ReadLease:
+    """Lecture d'un repository (restauration): partagée entre lecteurs, exclusive des jobs d'écriture
+
+    Les lecteurs sont inscrits avec une échéance dans un ensemble trié Redis: un lecteur
+    disparu sans se retirer n'empêche plus les écritures une fois son échéance passée.
+    """
+
+    def __init__(self, repo_path: str, reader: str, timeout: int = REPO_LOCK_TIMEOUT):
+        self.repo_path = repo_path
+        self.reader = reader
+        self.timeout = timeout
+
+    def renew(self):
+        from worker.tasks import redis_conn
+
+        redis_conn.zadd(_readers_key(self.repo_path), {self.reader: time.time() + self.timeout})
+
+    def release(self):
+        from worker.tasks import redis_conn
+
+        redis_conn.zrem(_readers_key(self.repo_path), self.reader)
+
+def _active_readers(repo_path: str) -> int:
+    from worker.tasks import redis_conn
+
+    key = _readers_key(repo_path)
+    redis_conn.zremrangebyscore(key, '-inf', time.time())
+    return redis_conn.zcard(key)
+
+def _acquire_interruptible(lock, wait: Optional[float], interrupt: threading.Event) -> bool:
+    """Attend le verrou par tranches d'une seconde pour rester sensible à une annulation"""
+    deadline = None if wait is None else time.monotonic() + wait
+    while not interrupt.is_set():
+        step = 1.0 if deadline is None else min(1.0, deadline - time.monotonic())
+        if step <= 0:
+            return False
+        if lock.acquire(blocking_timeout=step):
+            return True
+    return False
+
+def _drain_readers(repo_path: str, lock, deadline: Optional[float],
+                   interrupt: Optional[threading.Event] = None) -> bool:
+    """Attend, verrou tenu (aucun nouveau lecteur ne peut s'inscrire), la fin des lectures en cours"""
+    while _active_readers(repo_path):
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        if interrupt is not None and interrupt.is_set():
+            return False
+        # Un verrou à durée courte (renouvelé par heartbeat une fois le job lancé) ne doit pas expirer ici
+        lock.reacquire()
+        time.sleep(1.0)
+    return True
+
+def checkout_repository(repo_path: str, wait: Optional[float] = REPO_LOCK_WAIT, timeout: int = REPO_LOCK_TIMEOUT,
+                        on_acquire: Optional[Callable[[RepositoryLease], None]] = None,
+                        interrupt: Optional[threading.Event] = None) -> Optional[RepositoryLease]:
+    """Réserve un repository pour un job et, en stockage objet, rapatrie sa copie locale
+
+    L'attente du verrou puis de la fin des lectures en cours est bornée par `wait`
+    (REPO_LOCK_WAIT par défaut): None est retourné si le repository reste occupé (ou si
+    `interrupt` est levé pendant l'attente), et le job doit être replanifié.
+    Un `timeout` court suppose que le job renouvelle le verrou (RepositoryLease.renew):
+    `on_acquire` reçoit la réservation dès la prise du verrou, avant le rapatriement.
+    """
+    deadline = None if wait is None else time.monotonic() + wait
+    lock = _repository_lock(repo_path, timeout)
+    if interrupt is not None:
+        acquired = _acquire_interruptible(lock, wait, interrupt)
+    else:
+        acquired = lock.acquire(blocking_timeout=wait)
+    if not acquired:
+        return None
+    try:
+        if not _drain_readers(repo_path, lock, deadline, interrupt):
+            lock.release()
+            return None
+        lease = RepositoryLease(RepositoryStore(repo_path) if REPO_STORAGE == 's3' else None, lock, repo_path)
+        if on_acquire:
+            on_acquire(lease)
+        if lease.store:
+            lease.store.pull()
+    except Exception:
+        lock.release()
+        raise
+    return lease
+
+def read_repository(repo_path: str, reader: str, wait: Optional[float] = REPO_LOCK_WAIT,
+                    timeout: int = REPO_LOCK_TIMEOUT) -> Optional[ReadLease]:
+    """Réserve un repository en lecture seule (plusieurs lecteurs simultanés)
+
+    Le verrou n'est tenu que le temps de l'inscription (et, en stockage objet, du
+    rapatriement de la copie locale): borg lit ensuite sous son propre verrou partagé.
+    None est retourné si un job d'écriture garde le verrou au-delà de `wait`.
+    """
+    lock = _repository_lock(repo_path)
+    if not lock.acquire(blocking_timeout=wait):
+        return None
+    try:
+        if REPO_STORAGE == 's3':
+            RepositoryStore(repo_path).pull()
+        lease = ReadLease(repo_path, reader, timeout)
+        lease.renew()
+    finally:
+        lock.release()
+    return lease
+
+def refresh_repository(repo_path: str, wait: int = 5) -> bool:
+    """Rafraîchit une copie locale en lecture seule; garde la copie existante si un job écrit"""
+    if REPO_STORAGE != 's3':
+        return True
+
+    lock = _repository_lock(repo_path)
+    if not lock.acquire(blocking_timeout=wait):
+        return False
+    try:
+        RepositoryStore(repo_path).pull()
+    finally:
+        lock.release()
+    return True
@@ -0,0 +1,60 @@
+"""
+Préemption des jobs de faible priorité au profit des restaurations
+
+Quand une restauration est admise alors qu'aucun worker n'est libre, le job préemptible
+de plus faible priorité reçoit une demande d'interruption. Le worker arrête borg sur un
+checkpoint, remet le job en attente et le renvoie dans sa file: la restauration, déjà
+en file, passe devant et le job reprendra plus tard là où il s'était arrêté.
+"""
+import os
+from datetime import datetime
+from typing import List, Optional
+
+from rq import Worker
+
+from api.database import Job
+from worker.tasks import redis_conn
+from worker.cancellation import request_interrupt, interrupt_reason
+from worker.agent_jobs import is_agent_job
+
+PREEMPTION_ENABLED = os.getenv("PREEMPTION_ENABLED", "true").lower() == "true"
+
+# Jobs capables de reprendre après interruption, du moins au plus prioritaire
+PREEMPTIBLE_PRIORITY = {
+    'check': 0,   # borg reprend la vérification au prochain passage
+    'backup': 1,  # la sauvegarde reprend depuis son checkpoint
+}
+
+def free_worker_available() -> bool:
+    """Vrai si au moins un worker RQ est inactif (ou si aucun n'est enregistré)"""
+    workers = Worker.all(connection=redis_conn)
+    return not workers or any(worker.get_state() != 'busy' for worker in workers)
+
+def choose_victim(running: List[Job]) -> Optional[Job]:
+    """Job préemptible de plus faible priorité; à égalité le plus récent, qui perd le moins de travail"""
+    candidates = [job for job in running if job.type in PREEMPTIBLE_PRIORITY]
+    if not candidates:
+        return None
+    # Plus récent d'abord (started_at décroissant); un job sans started_at passe en dernier
+    return max(candidates, key=lambda job: (
+        -PREEMPTIBLE_PRIORITY[job.type],
+        job.started_at is not None,
+        job.started_at or datetime.min
+    ))
+
+def preempt_for_restore(db) -> Optional[int]:
+    """Libère un worker pour une restauration qui vient d'être mise en file"""
+    if not PREEMPTION_ENABLED or free_worker_available():
+        return None
+
+    # Un job déjà en cours d'interruption libérera son worker sans aide; un job d'agent n'en occupe pas
+    running = [
+        job for job in db.query(Job).filter(Job.status == "running").all()
+        if not is_agent_job(job) and not interrupt_reason(job.id)
+    ]
+    victim = choose_victim(running)
+    if not victim:
+        return None
+
+    request_interrupt(victim.id, 'preempt')
+    return victim.id
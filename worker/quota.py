@@ -0,0 +1,79 @@
+"""
+Réconciliation des compteurs d'usage des tenants avec l'espace réel des repositories
+"""
+import os
+from typing import Dict, Any
+
+from api.database import Job, Agent, Tenant
+from worker.tasks import BorgManager, SessionLocal, low_queue, resolve_repository
+from worker.object_store import refresh_repository
+
+def reconcile_tenant_usage(tenant_id: int) -> Dict[str, Any]:
+    """Recalcule l'usage d'un tenant depuis `borg info` et corrige la dérive du compteur"""
+
+    db = SessionLocal()
+    result = {'success': False, 'message': ''}
+
+    try:
+        tenant = db.query(Tenant).filter(Tenant.id == tenant_id).first()
+        if not tenant:
+            result['message'] = f"Tenant {tenant_id} non trouvé"
+            return result
+
+        # Un job en cours modifierait le compteur pendant la mesure
+        busy = db.query(Job.id).join(Agent, Job.agent_id == Agent.id).filter(
+            Agent.tenant_id == tenant_id,
+            Job.status == "running"
+        ).first()
+        if busy:
+            result['message'] = f"Tenant {tenant_id} occupé, réconciliation reportée"
+            return result
+
+        repos = {}
+        for agent in tenant.agents:
+            repo = resolve_repository(db, agent)
+            refresh_repository(repo['repo_path'])
+            if os.path.exists(repo['repo_path']):
+                repos[repo['repo_path']] = repo['passphrase']
+
+        actual_bytes = 0
+        for repo_path, passphrase in repos.items():
+            # Mesure de référence: jamais depuis le cache
+            info = BorgManager(repo_path, passphrase).repo_info(use_cache=False)
+            if not info['success']:
+                result['message'] = f"borg info a échoué pour {repo_path}"
+                return result
+            actual_bytes += info['stats'].get('unique_csize', 0)
+
+        drift = actual_bytes - (tenant.used_bytes or 0)
+        if drift:
+            db.query(Tenant).filter(Tenant.id == tenant_id).update(
+                {Tenant.used_bytes: actual_bytes}, synchronize_session=False
+            )
+            db.commit()
+
+        result['success'] = True
+        result['message'] = f"Usage du tenant {tenant_id} réconcilié"
+        result['used_bytes'] = actual_bytes
+        result['drift_bytes'] = drift
+
+    except Exception as e:
+        result['message'] = f"Erreur lors de la réconciliation: {str(e)}"
+
+    finally:
+        db.close()
+
+    return result
+
+def schedule_quota_reconciliation() -> int:
+    """Planifie la réconciliation de chaque tenant dans la file basse priorité"""
+    db = SessionLocal()
+    try:
+        tenant_ids = [tenant_id for (tenant_id,) in db.query(Tenant.id).all()]
+    finally:
+        db.close()
+
+    for tenant_id in tenant_ids:
+        low_queue.enqueue(reconcile_tenant_usage, tenant_id, job_timeout='1h')
+
+    return len(tenant_ids)
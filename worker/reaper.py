@@ -0,0 +1,73 @@
+"""
+Reprise des jobs dont le worker a disparu
+
+Un job en cours détient un bail (Job.lease_expires_at) que le heartbeat de son worker
+prolonge. Un bail expiré signifie que le worker est mort (conteneur tué, OOM...): le
+job est remis en attente puis réenfilé au lieu de rester « running » indéfiniment: une
+sauvegarde reprend depuis sa dernière archive de checkpoint, une restauration est relancée.
+"""
+import os
+from datetime import datetime
+from typing import List, Optional
+
+from api.database import Job
+from worker.tasks import SessionLocal, enqueue_backup_job
+from worker.restore import enqueue_restore_job
+from worker.agent_jobs import is_agent_job, notify_agent, agent_job_repository
+from worker.object_store import job_lease
+
+# Nombre maximum de tentatives avant d'abandonner un job
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+# Types de jobs sous bail et fonction qui les réenfile
+RESUMABLE_JOBS = {
+    'backup': enqueue_backup_job,
+    'restore': enqueue_restore_job,  # Relancée en entier: l'extraction n'a pas de checkpoint
+}
+
+def reclaim_expired_jobs(db, now: Optional[datetime] = None,
+                         max_attempts: int = JOB_MAX_ATTEMPTS) -> List[Job]:
+    """Remet en attente les jobs au bail expiré (ou les marque échoués après trop de tentatives)"""
+    now = now or datetime.utcnow()
+    expired = db.query(Job).filter(
+        Job.status == "running",
+        Job.lease_expires_at < now
+    ).all()
+
+    reclaimed = []
+    for job in expired:
+        if is_agent_job(job):
+            # L'agent ne renouvelle plus le verrou qu'il détenait au nom du job
+            job_lease(agent_job_repository(job, job.agent), job.id).release()
+        job.worker_id = None
+        job.lease_expires_at = None
+        if job.type not in RESUMABLE_JOBS or (job.attempts or 0) >= max_attempts:
+            job.status = "failed"
+            job.error_message = f"Worker perdu après {job.attempts or 0} tentative(s)"
+            job.finished_at = now
+        else:
+            job.status = "pending"
+            job.error_message = "Worker perdu: job remis en file"
+            reclaimed.append(job)
+
+    db.commit()
+    return reclaimed
+
+def reap_expired_jobs() -> int:
+    """Réenfile les jobs dont le worker a disparu"""
+    db = SessionLocal()
+    try:
+        reclaimed = []
+        for job in reclaim_expired_jobs(db):
+            # Un job exécuté par un agent n'est pas mis en file: l'agent est réveillé pour le reprendre
+            if is_agent_job(job):
+                notify_agent(job.agent_id)
+            else:
+                reclaimed.append((job.id, job.type))
+    finally:
+        db.close()
+
+    for job_id, job_type in reclaimed:
+        RESUMABLE_JOBS[job_type](job_id)
+
+    return len(reclaimed)
@@ -0,0 +1,176 @@
+"""
+Réconciliation de la table snapshots avec les archives réelles des repositories
+
+Les listes d'archives sont lues en parallèle (un borg list par repository), puis
+comparées aux snapshots en base: les archives inconnues sont insérées, les snapshots
+dont l'archive a disparu sont marqués manquants (et démarqués si elle réapparaît),
+le tout par lots d'instructions.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional, Tuple
+
+from sqlalchemy import insert, update
+
+from api.database import Job, Snapshot, Agent
+from worker.tasks import BorgManager, SessionLocal, low_queue, resolve_repository
+from worker.object_store import checkout_repository
+from worker.quota import reconcile_tenant_usage
+
+# Nombre de repositories listés simultanément
+RECONCILE_CONCURRENCY = int(os.getenv("RECONCILE_CONCURRENCY", "8"))
+# Taille des lots d'INSERT / UPDATE
+RECONCILE_BATCH_SIZE = int(os.getenv("RECONCILE_BATCH_SIZE", "500"))
+# Attente maximale du verrou d'un repository: s'il est occupé, il sera réconcilié au prochain passage
+RECONCILE_LOCK_WAIT = 5
+
+def parse_archive_time(value: Optional[str]) -> datetime:
+    """Convertit l'heure locale affichée par borg en UTC naïf (convention de la base)"""
+    if not value:
+        return datetime.utcnow()
+    return datetime.fromisoformat(value).astimezone(timezone.utc).replace(tzinfo=None)
+
+def diff_snapshots(archive_names: List[str], rows: List[Tuple[int, str, Optional[datetime]]]) -> Dict[str, list]:
+    """Compare les archives du repository aux snapshots (id, nom, missing_since) en base
+
+    Les checkpoints (`*.checkpoint*`) d'une sauvegarde en cours ou interrompue ne sont pas des snapshots.
+    """
+    archives = set(archive_names)
+    known = {name for _, name, _ in rows}
+    return {
+        'new': [name for name in archive_names if name not in known and '.checkpoint' not in name],
+        'missing': [row_id for row_id, name, missing in rows if name not in archives and missing is None],
+        'restored': [row_id for row_id, name, missing in rows if name in archives and missing is not None]
+    }
+
+def _batches(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def apply_drift(db, agent: Agent, repo_path: str, archives: List[Dict[str, Any]],
+                batch_size: int = RECONCILE_BATCH_SIZE, now: Optional[datetime] = None) -> Dict[str, int]:
+    """Applique l'écart entre un repository et la base par lots d'instructions"""
+    now = now or datetime.utcnow()
+    rows = db.query(Snapshot.id, Snapshot.name, Snapshot.missing_since).filter(
+        Snapshot.repo_path == repo_path
+    ).all()
+    drift = diff_snapshots([a.get('name', a.get('archive')) for a in archives], rows)
+
+    if drift['new']:
+        # Les archives inconnues sont rattachées au job de réconciliation qui les a trouvées
+        job = Job(agent_id=agent.id, type="reconcile", status="completed",
+                  started_at=now, finished_at=now)
+        db.add(job)
+        db.flush()
+
+        by_name = {a.get('name', a.get('archive')): a for a in archives}
+        values = [{
+            'job_id': job.id,
+            'name': name,
+            'repo_path': repo_path,
+            'size_bytes': 0,
+            'is_full': True,
+            'created_at': parse_archive_time(by_name[name].get('start'))
+        } for name in drift['new']]
+        for batch in _batches(values, batch_size):
+            db.execute(insert(Snapshot), batch)
+
+    for batch in _batches(drift['missing'], batch_size):
+        db.execute(update(Snapshot).where(Snapshot.id.in_(batch)).values(missing_since=now))
+    for batch in _batches(drift['restored'], batch_size):
+        db.execute(update(Snapshot).where(Snapshot.id.in_(batch)).values(missing_since=None))
+
+    db.commit()
+    return {key: len(value) for key, value in drift.items()}
+
+def _list_repository(repo_path: str, passphrase: str):
+    """Réserve le repository (sans attendre longtemps) et liste ses archives hors cache"""
+    lease = checkout_repository(repo_path, wait=RECONCILE_LOCK_WAIT)
+    if not lease:
+        return None, None
+    try:
+        if not os.path.exists(repo_path):
+            return lease, {'success': True, 'archives': None}
+        return lease, BorgManager(repo_path, passphrase).list_archives(use_cache=False)
+    except Exception:
+        lease.release()
+        raise
+
+def reconcile_snapshots() -> Dict[str, Any]:
+    """Réconcilie les snapshots de tous les repositories connus"""
+
+    db = SessionLocal()
+    result = {'success': False, 'message': '', 'repositories': {}}
+    totals = {'new': 0, 'missing': 0, 'restored': 0, 'skipped': 0, 'failed': 0}
+    drifted_tenants = set()
+
+    try:
+        repos = {}
+        for agent in db.query(Agent).all():
+            repo = resolve_repository(db, agent)
+            repos[repo['repo_path']] = (agent, repo['passphrase'])
+
+        with ThreadPoolExecutor(max_workers=RECONCILE_CONCURRENCY) as executor:
+            futures = {
+                executor.submit(_list_repository, repo_path, passphrase): repo_path
+                for repo_path, (_, passphrase) in repos.items()
+            }
+            # Les écritures en base restent dans ce thread (session non partagée)
+            for future in as_completed(futures):
+                repo_path = futures[future]
+                agent = repos[repo_path][0]
+                try:
+                    lease, listing = future.result()
+                except Exception as e:
+                    totals['failed'] += 1
+                    result['repositories'][repo_path] = {'error': str(e)}
+                    continue
+
+                if not lease:
+                    totals['skipped'] += 1
+                    continue
+                try:
+                    if not listing['success']:
+                        raise RuntimeError(listing.get('stderr', listing.get('error')))
+                    if listing['archives'] is None:
+                        continue  # Aucun repository encore créé pour cet agent
+
+                    counts = apply_drift(db, agent, repo_path, listing['archives'])
+                except Exception as e:
+                    db.rollback()
+                    totals['failed'] += 1
+                    result['repositories'][repo_path] = {'error': str(e)}
+                    continue
+                finally:
+                    lease.release()
+
+                result['repositories'][repo_path] = counts
+                for key, value in counts.items():
+                    totals[key] += value
+                if any(counts.values()):
+                    drifted_tenants.add(agent.tenant_id)
+
+        # Les compteurs d'usage suivent les archives retrouvées ou disparues
+        for tenant_id in drifted_tenants:
+            low_queue.enqueue(reconcile_tenant_usage, tenant_id, job_timeout='1h')
+
+        result['success'] = True
+        result['drift'] = totals
+        result['message'] = (
+            f"Réconciliation: {totals['new']} snapshot(s) ajouté(s), "
+            f"{totals['missing']} manquant(s), {totals['restored']} retrouvé(s)"
+        )
+
+    except Exception as e:
+        result['message'] = f"Erreur lors de la réconciliation: {str(e)}"
+
+    finally:
+        db.close()
+
+    return result
+
+def schedule_snapshot_reconciliation() -> int:
+    """Planifie une réconciliation globale dans la file basse priorité"""
+    low_queue.enqueue(reconcile_snapshots, job_timeout='2h')
+    return 1
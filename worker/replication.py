@@ -0,0 +1,347 @@
+"""
+Réplication hors site des repositories SaveOS
+
+Après chaque sauvegarde, un job de réplication recopie vers une cible secondaire
+(autre chemin local ou bucket S3/MinIO) uniquement les segments nouveaux ou modifiés.
+Le filigrane (dernier snapshot répliqué) est conservé en base pour mesurer le retard.
+
+Le verrou du repository n'est tenu que le temps d'en figer une image (liens physiques
+vers les segments, immuables une fois écrits, et copie des index): le transfert, long
+et bridé en débit, part de cette image sans bloquer les sauvegardes. Un verrou de
+réplication par repository réserve l'image au job qui l'envoie, jusqu'à la fin de l'envoi.
+"""
+import os
+import shutil
+from datetime import datetime, timedelta
+from typing import Dict, Any, Optional
+
+from sqlalchemy import func
+
+from api.database import Job, Snapshot, Agent, ReplicationState
+from worker.tasks import SessionLocal, low_queue, resolve_repository, cancel_job
+from worker.cancellation import InterruptWatcher, JobInterrupted, clear_interrupt
+from worker.object_store import (
+    RepositoryStore, BandwidthLimiter, checkout_repository, scan_repository, run_transfers, is_segment,
+    REPO_LOCK_RETRY_DELAY
+)
+
+# Cible de réplication: chemin local ("/mnt/offsite") ou bucket ("s3://bucket/prefixe"); vide = désactivée
+REPLICATION_TARGET = os.getenv("REPLICATION_TARGET", "")
+REPLICATION_S3_ENDPOINT_URL = os.getenv("REPLICATION_S3_ENDPOINT_URL", "http://localhost:9000")
+REPLICATION_S3_ACCESS_KEY = os.getenv("REPLICATION_S3_ACCESS_KEY", "")
+REPLICATION_S3_SECRET_KEY = os.getenv("REPLICATION_S3_SECRET_KEY", "")
+# Débit maximum (octets/s, 0 = illimité) et transferts simultanés par job
+REPLICATION_BANDWIDTH = int(os.getenv("REPLICATION_BANDWIDTH", "0"))
+REPLICATION_CONCURRENCY = int(os.getenv("REPLICATION_CONCURRENCY", "4"))
+
+REPLICA_STATE_FILE = ".saveos-replica.json"
+# Durée maximale d'un job de réplication (secondes), aussi celle de son verrou de réplication
+REPLICATION_JOB_TIMEOUT = 12 * 3600
+COPY_CHUNK_SIZE = 1024 * 1024
+
+def staging_path(repo_path: str) -> str:
+    """Image figée d'un repository, conservée entre deux réplications (même système de fichiers)"""
+    repo_path = repo_path.rstrip('/')
+    return os.path.join(os.path.dirname(repo_path), f".{os.path.basename(repo_path)}.saveos-replica")
+
+def snapshot_repository(repo_path: str, staging: str) -> Dict[str, int]:
+    """Met l'image figée à jour (à appeler sous le verrou du repository)
+
+    Les segments sont liés physiquement (copiés si le lien est impossible): ils ne sont
+    jamais réécrits, seulement supprimés par compact (le lien survit à la suppression). Les autres
+    fichiers (index, hints, config) sont copiés avec leur date de modification.
+    """
+    source = scan_repository(repo_path)
+    current = scan_repository(staging)
+
+    linked = 0
+    for rel_path, info in source.items():
+        existing = current.get(rel_path)
+        if existing and existing['size'] == info['size'] and (
+                is_segment(rel_path) or existing['mtime_ns'] == info['mtime_ns']):
+            continue
+
+        src = os.path.join(repo_path, *rel_path.split('/'))
+        dst = os.path.join(staging, *rel_path.split('/'))
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if existing:
+            os.unlink(dst)
+        if is_segment(rel_path):
+            try:
+                os.link(src, dst)
+                linked += 1
+                continue
+            except OSError:
+                pass  # Autre système de fichiers: copie
+        shutil.copy2(src, dst)
+
+    removed = [rel_path for rel_path in current if rel_path not in source]
+    for rel_path in removed:
+        os.unlink(os.path.join(staging, *rel_path.split('/')))
+
+    return {'files': len(source), 'linked': linked, 'deleted': len(removed)}
+
+class LocalReplica:
+    """Copie miroir incrémentale d'un repository vers un autre chemin (disque, montage distant)"""
+
+    def __init__(self, local_path: str, target_path: str, concurrency: int = REPLICATION_CONCURRENCY,
+                 limiter: Optional[BandwidthLimiter] = None):
+        self.local_path = local_path
+        self.target_path = target_path
+        self.concurrency = max(concurrency, 1)
+        self.limiter = limiter
+
+    def _copy(self, rel_path: str):
+        src = os.path.join(self.local_path, *rel_path.split('/'))
+        dst = os.path.join(self.target_path, *rel_path.split('/'))
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+
+        tmp_path = f"{dst}.part"
+        with open(src, 'rb') as fin, open(tmp_path, 'wb') as fout:
+            while True:
+                chunk = fin.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if self.limiter:
+                    self.limiter.consume(len(chunk))
+                fout.write(chunk)
+            fout.flush()
+            os.fsync(fout.fileno())
+        shutil.copystat(src, tmp_path)
+        os.replace(tmp_path, dst)
+
+    def push(self) -> Dict[str, int]:
+        """Même ordre que pour le stockage objet: segments, puis index, puis suppressions"""
+        local = scan_repository(self.local_path)
+        remote = scan_repository(self.target_path)
+
+        changed = [
+            rel_path for rel_path, info in local.items()
+            if rel_path not in remote
+            or remote[rel_path]['size'] != info['size']
+            or (not is_segment(rel_path) and remote[rel_path]['mtime_ns'] != info['mtime_ns'])
+        ]
+        run_transfers(self._copy, sorted(p for p in changed if is_segment(p)), self.concurrency)
+        run_transfers(self._copy, sorted(p for p in changed if not is_segment(p)), self.concurrency)
+
+        removed = [rel_path for rel_path in remote if rel_path not in local]
+        for rel_path in removed:
+            os.unlink(os.path.join(self.target_path, *rel_path.split('/')))
+
+        return {
+            'uploaded': len(changed),
+            'uploaded_bytes': sum(local[p]['size'] for p in changed),
+            'deleted': len(removed)
+        }
+
+def replication_target_for(repo_path: str, target: str = REPLICATION_TARGET,
+                            limiter: Optional[BandwidthLimiter] = None, source_path: Optional[str] = None):
+    """Construit la destination de réplication d'un repository (chemin local ou bucket)
+
+    `source_path` est la copie à envoyer (image figée), par défaut le repository lui-même;
+    la destination reste nommée d'après le repository.
+    """
+    source_path = source_path or repo_path
+    if target.startswith('s3://'):
+        import boto3
+
+        bucket, _, prefix = target[len('s3://'):].partition('/')
+        client = boto3.client(
+            's3',
+            endpoint_url=REPLICATION_S3_ENDPOINT_URL,
+            aws_access_key_id=REPLICATION_S3_ACCESS_KEY,
+            aws_secret_access_key=REPLICATION_S3_SECRET_KEY
+        )
+        return RepositoryStore(
+            source_path,
+            client=client,
+            bucket=bucket,
+            prefix=f"{prefix.strip('/')}/{repo_path.strip('/')}".strip('/'),
+            concurrency=REPLICATION_CONCURRENCY,
+            limiter=limiter,
+            state_file=REPLICA_STATE_FILE
+        )
+
+    return LocalReplica(
+        source_path,
+        os.path.join(target, repo_path.strip('/')),
+        concurrency=REPLICATION_CONCURRENCY,
+        limiter=limiter
+    )
+
+def _replication_lock(repo_path: str):
+    """Un seul job de réplication par repository: il possède l'image figée jusqu'à la fin de l'envoi"""
+    from worker.tasks import redis_conn
+
+    return redis_conn.lock(f"saveos:replication_lock:{repo_path.strip('/')}",
+                           timeout=REPLICATION_JOB_TIMEOUT, thread_local=False)
+
+def replication_lag(db, state: ReplicationState, now: datetime) -> float:
+    """Âge (secondes) du plus ancien snapshot pas encore présent sur la copie hors site"""
+    oldest = db.query(func.min(Snapshot.created_at)).filter(
+        Snapshot.repo_path == state.repo_path,
+        Snapshot.id > (state.watermark_snapshot_id or 0)
+    ).scalar()
+    if not oldest:
+        return 0.0
+    return max((now - oldest).total_seconds(), 0.0)
+
+def _fail_job(db, job: Job, message: str, result: Dict[str, Any]) -> Dict[str, Any]:
+    """Marque un job comme échoué"""
+    job.status = "failed"
+    job.error_message = message
+    job.finished_at = datetime.utcnow()
+    db.commit()
+    result['message'] = message
+    return result
+
+def process_replication_job(job_id: int) -> Dict[str, Any]:
+    """Traite un job de réplication: copie incrémentale puis avancement du filigrane"""
+
+    db = SessionLocal()
+    result = {'success': False, 'message': ''}
+    repo_lease = None
+    replication_lock = None
+    watcher = None
+
+    try:
+        job = db.query(Job).filter(Job.id == job_id).first()
+        if not job:
+            result['message'] = f"Job {job_id} non trouvé"
+            return result
+
+        if job.status == "cancelled":
+            result['message'] = f"Job {job_id} annulé"
+            return result
+
+        agent = db.query(Agent).filter(Agent.id == job.agent_id).first()
+        if not agent:
+            result['message'] = f"Agent {job.agent_id} non trouvé"
+            return result
+
+        if not REPLICATION_TARGET:
+            return _fail_job(db, job, "Aucune cible de réplication configurée (REPLICATION_TARGET)", result)
+
+        repo_path = resolve_repository(db, agent)['repo_path']
+
+        # Un autre job envoie encore l'image figée de ce repository: elle ne doit pas changer sous lui
+        replication_lock = _replication_lock(repo_path)
+        if not replication_lock.acquire(blocking=False):
+            replication_lock = None
+            enqueue_replication_job(job_id, delay=timedelta(seconds=REPO_LOCK_RETRY_DELAY))
+            result['message'] = f"Réplication déjà en cours, job {job_id} replanifié"
+            return result
+
+        # Le verrou garantit une image cohérente: aucune écriture borg pendant qu'elle est figée
+        repo_lease = checkout_repository(repo_path)
+        if not repo_lease:
+            enqueue_replication_job(job_id, delay=timedelta(seconds=REPO_LOCK_RETRY_DELAY))
+            result['message'] = f"Repository occupé, job {job_id} replanifié"
+            return result
+
+        job.status = "running"
+        job.started_at = datetime.utcnow()
+        db.commit()
+
+        # Tous les snapshots enregistrés avant la prise du verrou seront sur la copie
+        latest = db.query(Snapshot).filter(
+            Snapshot.repo_path == repo_path
+        ).order_by(Snapshot.id.desc()).first()
+
+        if not os.path.exists(repo_path):
+            return _fail_job(db, job, f"Repository {repo_path} introuvable", result)
+
+        staging = staging_path(repo_path)
+        snapshot_repository(repo_path, staging)
+        repo_lease.release()
+        repo_lease = None
+
+        # Transfert sans le verrou, depuis l'image figée; une annulation l'arrête au bloc suivant
+        watcher = InterruptWatcher(job.id)
+        watcher.start()
+        limiter = BandwidthLimiter(REPLICATION_BANDWIDTH, interrupt=watcher.event)
+        try:
+            transfer = replication_target_for(repo_path, limiter=limiter, source_path=staging).push()
+        except JobInterrupted:
+            return cancel_job(db, job, result)
+
+        state = get_replication_state(db, agent, repo_path)
+        state.target = REPLICATION_TARGET
+        state.last_replicated_at = datetime.utcnow()
+        state.last_transfer_bytes = transfer['uploaded_bytes']
+        if latest:
+            state.watermark_snapshot_id = latest.id
+            state.watermark_at = latest.created_at
+
+        job.status = "completed"
+        job.finished_at = datetime.utcnow()
+        db.commit()
+
+        result['success'] = True
+        result['message'] = f"Réplication réussie: {transfer['uploaded']} fichier(s) transféré(s)"
+        result.update(transfer)
+
+    except Exception as e:
+        if 'job' in locals() and job:
+            _fail_job(db, job, str(e), result)
+        result['message'] = f"Erreur lors du traitement du job: {str(e)}"
+
+    finally:
+        if watcher:
+            watcher.stop()
+            clear_interrupt(job_id)
+        if repo_lease:
+            repo_lease.release()
+        if replication_lock:
+            try:
+                replication_lock.release()
+            except Exception:
+                pass  # Verrou expiré avec le job
+        db.close()
+
+    return result
+
+def get_replication_state(db, agent: Agent, repo_path: str) -> ReplicationState:
+    """Retourne (en le créant au besoin) le filigrane de réplication d'un repository"""
+    state = db.query(ReplicationState).filter(ReplicationState.repo_path == repo_path).first()
+    if not state:
+        state = ReplicationState(agent_id=agent.id, repo_path=repo_path)
+        db.add(state)
+        db.flush()
+    return state
+
+def enqueue_replication_job(job_id: int, delay: Optional[timedelta] = None) -> str:
+    """Ajoute un job de réplication à la file basse priorité (après `delay` pour une nouvelle tentative)"""
+    if delay:
+        job = low_queue.enqueue_in(delay, process_replication_job, job_id, job_timeout=REPLICATION_JOB_TIMEOUT)
+    else:
+        job = low_queue.enqueue(
+            process_replication_job,
+            job_id,
+            job_timeout=REPLICATION_JOB_TIMEOUT
+        )
+    return job.id
+
+def request_replication(db, agent: Agent) -> Optional[int]:
+    """Crée un job de réplication après une sauvegarde (un seul en attente par agent)"""
+    if not REPLICATION_TARGET:
+        return None
+
+    # Un job encore en attente prendra aussi le nouveau snapshot en compte
+    pending = db.query(Job.id).filter(
+        Job.agent_id == agent.id,
+        Job.type == "replicate",
+        Job.status == "pending"
+    ).first()
+    if pending:
+        return None
+
+    # Le filigrane existe dès la première demande pour que le retard soit mesuré
+    get_replication_state(db, agent, resolve_repository(db, agent)['repo_path'])
+    job = Job(agent_id=agent.id, type="replicate", status="pending")
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+
+    enqueue_replication_job(job.id)
+    return job.id
@@ -0,0 +1,80 @@
+"""
+Cache Redis des métadonnées des repositories (liste des archives, statistiques borg info)
+
+Chaque repository a un hash Redis avec un compteur de génération. create, prune et
+compact incrémentent la génération: un résultat calculé avant une écriture n'est jamais
+publié après elle. Chaque entrée mémorise aussi la version du manifest dont elle provient.
+Redis indisponible n'empêche rien: le cache est simplement ignoré.
+"""
+import os
+import json
+from typing import Dict, Any, Optional
+
+import redis
+
+# Durée de vie d'une entrée sans invalidation (filet de sécurité en cas d'écriture hors SaveOS)
+REPO_META_TTL = int(os.getenv("REPO_META_TTL", str(24 * 3600)))
+
+# Publication conditionnelle: seulement si aucune invalidation n'a eu lieu pendant le calcul
+_STORE_SCRIPT = """
+if (redis.call('HGET', KEYS[1], 'gen') or '0') == ARGV[1] then
+    redis.call('HSET', KEYS[1], ARGV[2], ARGV[3])
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+    return 1
+end
+return 0
+"""
+_store_script = None
+
+def _redis():
+    # Import local: worker.tasks utilise ce module depuis BorgManager
+    from worker.tasks import redis_conn
+    return redis_conn
+
+def _key(repo_path: str) -> str:
+    return f"saveos:repo_meta:{repo_path}"
+
+def generation(repo_path: str) -> Optional[str]:
+    """Génération courante du repository, à lire avant de calculer une valeur à mettre en cache"""
+    try:
+        return (_redis().hget(_key(repo_path), 'gen') or b'0').decode()
+    except redis.RedisError:
+        return None
+
+def get(repo_path: str, kind: str) -> Optional[Dict[str, Any]]:
+    """Retourne une valeur en cache ('archives' ou 'info'), None si absente"""
+    try:
+        value = _redis().hget(_key(repo_path), kind)
+    except redis.RedisError:
+        return None
+    if not value:
+        return None
+    result = json.loads(value)
+    result['cached'] = True
+    return result
+
+def store(repo_path: str, kind: str, result: Dict[str, Any], gen: Optional[str]) -> bool:
+    """Publie une valeur calculée à la génération `gen` (ignorée si le repository a changé depuis)"""
+    global _store_script
+    if gen is None:
+        return False
+    try:
+        if _store_script is None:
+            _store_script = _redis().register_script(_STORE_SCRIPT)
+        return bool(_store_script(
+            keys=[_key(repo_path)],
+            args=[gen, kind, json.dumps(result), REPO_META_TTL]
+        ))
+    except redis.RedisError:
+        return False
+
+def invalidate(repo_path: str):
+    """Invalide les métadonnées après une écriture (create, prune, compact...)"""
+    try:
+        pipe = _redis().pipeline(transaction=True)
+        pipe.hincrby(_key(repo_path), 'gen', 1)
+        pipe.hdel(_key(repo_path), 'archives', 'info')
+        pipe.expire(_key(repo_path), REPO_META_TTL)
+        pipe.execute()
+    except redis.RedisError:
+        pass
@@ -0,0 +1,323 @@
+"""
+Restauration SaveOS - extraction parallèle et sélective d'un snapshot
+
+Les chemins demandés sont découpés en unités (les plus gros répertoires sont
+éclatés grâce au catalogue du snapshot), puis répartis par taille entre
+plusieurs processus borg extract / export-tar exécutés en parallèle.
+"""
+import os
+import json
+import time
+import signal
+import shutil
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Callable, Optional
+
+from api.database import Job, Snapshot, Agent
+from worker.tasks import (
+    BorgManager, SessionLocal, queue, resolve_repository, cancel_job, JobHeartbeat, worker_identity, JOB_LEASE_TTL
+)
+from worker.cancellation import InterruptWatcher, clear_interrupt, JOB_CANCEL_GRACE
+from worker.catalog import ensure_listing, list_directory, path_stats
+from worker.object_store import read_repository, REPO_LOCK_RETRY_DELAY
+
+# Zone de préparation des archives tar téléchargées par les agents (mode agent_pull)
+RESTORE_STAGING_ROOT = os.getenv("RESTORE_STAGING_ROOT", "/tmp/saveos_restores")
+RESTORE_STAGING_TTL = timedelta(hours=int(os.getenv("RESTORE_STAGING_TTL_HOURS", "24")))
+# Racine des extractions sur le worker (mode target): le target_dir d'un agent y est relatif
+RESTORE_TARGET_ROOT = os.getenv("RESTORE_TARGET_ROOT", "/srv/saveos/restores")
+# Durée maximale d'une restauration (secondes), aussi échéance de sa réservation en lecture
+RESTORE_JOB_TIMEOUT = 12 * 3600
+# Intervalle minimum entre deux mises à jour de la progression en base
+PROGRESS_INTERVAL = 2
+
+# Préfixes de motifs borg (sh:, re:, fm:...) et jokers: taille inconnue, non découpables
+_PATTERN_PREFIXES = ('sh:', 're:', 'fm:', 'pp:', 'pf:')
+
+def restore_staging_dir(job_id: int) -> str:
+    """Répertoire de préparation d'un job de restauration"""
+    return os.path.join(RESTORE_STAGING_ROOT, str(job_id))
+
+def restore_target_dir(agent_id: int, target_dir: str) -> str:
+    """Répertoire d'extraction confiné sous RESTORE_TARGET_ROOT/<agent_id> (ValueError sinon)"""
+    parts = (target_dir or '').replace('\\', '/').split('/')
+    if not target_dir or os.path.isabs(target_dir) or '..' in parts:
+        raise ValueError("target_dir doit être un chemin relatif, sans '..'")
+    base = os.path.realpath(os.path.join(RESTORE_TARGET_ROOT, str(agent_id)))
+    path = os.path.realpath(os.path.join(base, target_dir))
+    # Un lien symbolique ne doit pas faire sortir de la racine de l'agent
+    if path != base and not path.startswith(base + os.sep):
+        raise ValueError("target_dir sort de la racine des restaurations")
+    return path
+
+def _is_pattern(path: str) -> bool:
+    return path.startswith(_PATTERN_PREFIXES) or any(c in path for c in '*?[')
+
+def expand_restore_units(listing: str, paths: List[str], parallelism: int) -> List[Dict[str, Any]]:
+    """Découpe les chemins demandés en unités, en éclatant les plus gros répertoires"""
+    units = []
+    for path in (paths or ['']):
+        if _is_pattern(path):
+            units.append({'path': path, 'type': '?', 'size': 0, 'files': 0})
+            continue
+        path = path.strip('/')
+        stats = path_stats(listing, path)
+        if stats:
+            units.append({'path': path, **stats})
+
+    # Viser quelques unités par processus pour un équilibrage correct
+    target = parallelism * 4
+    while len(units) < target:
+        splittable = [u for u in units if u['type'] == 'd' and u['files'] > 1]
+        if not splittable:
+            break
+
+        biggest = max(splittable, key=lambda u: u['size'])
+        units.remove(biggest)
+        prefix = f"{biggest['path']}/" if biggest['path'] else ""
+        for child in list_directory(listing, biggest['path']) or []:
+            child_path = f"{prefix}{child['name']}"
+            stats = path_stats(listing, child_path)
+            if stats:
+                units.append({'path': child_path, **stats})
+
+    return units
+
+def split_restore_units(units: List[Dict[str, Any]], workers: int) -> List[Dict[str, Any]]:
+    """Répartit les unités entre processus (plus grosse unité vers le lot le moins chargé)"""
+    buckets = [{'paths': [], 'size': 0, 'files': 0} for _ in range(max(workers, 1))]
+
+    for unit in sorted(units, key=lambda u: u['size'], reverse=True):
+        bucket = min(buckets, key=lambda b: b['size'])
+        bucket['paths'].append(unit['path'])
+        bucket['size'] += unit['size']
+        bucket['files'] += unit['files']
+
+    return [b for b in buckets if b['paths']]
+
+def _signal_all(processes: list, sig: int):
+    for process in processes:
+        if process.poll() is None:
+            try:
+                os.killpg(process.pid, sig)
+            except ProcessLookupError:
+                pass
+
+def run_parallel(processes: list, on_progress: Callable[[int, int], None],
+                 interrupt: Optional[threading.Event] = None, grace: float = JOB_CANCEL_GRACE) -> List[str]:
+    """Suit des processus borg --list en parallèle et retourne les erreurs des processus en échec
+
+    Si `interrupt` est levé, les processus reçoivent SIGINT puis SIGKILL après `grace` secondes.
+    """
+    counters = [0] * len(processes)
+    tails = [deque(maxlen=20) for _ in processes]
+
+    def follow(index: int, process):
+        for line in process.stderr:
+            counters[index] += 1
+            tails[index].append(line)
+
+    threads = [
+        threading.Thread(target=follow, args=(i, p), daemon=True)
+        for i, p in enumerate(processes)
+    ]
+    for thread in threads:
+        thread.start()
+
+    last_update = 0.0
+    signalled_at = None
+    while any(p.poll() is None for p in processes):
+        if interrupt is not None and interrupt.is_set():
+            if signalled_at is None:
+                _signal_all(processes, signal.SIGINT)
+                signalled_at = time.monotonic()
+            elif time.monotonic() - signalled_at >= grace:
+                _signal_all(processes, signal.SIGKILL)
+        if time.time() - last_update >= PROGRESS_INTERVAL:
+            finished = sum(1 for p in processes if p.poll() is not None)
+            on_progress(sum(counters), finished)
+            last_update = time.time()
+        time.sleep(0.5)
+
+    for thread in threads:
+        thread.join()
+
+    return [''.join(tails[i]).strip() for i, p in enumerate(processes) if p.returncode != 0]
+
+def _fail_job(db, job: Job, message: str, result: Dict[str, Any]) -> Dict[str, Any]:
+    """Marque un job comme échoué"""
+    job.status = "failed"
+    job.error_message = message
+    job.finished_at = datetime.utcnow()
+    db.commit()
+    result['message'] = message
+    return result
+
+def process_restore_job(job_id: int) -> Dict[str, Any]:
+    """Traite un job de restauration"""
+
+    db = SessionLocal()
+    result = {'success': False, 'message': ''}
+    processes = []
+    staging = None
+    repo_lease = None
+    watcher = None
+    heartbeat = None
+
+    try:
+        job = db.query(Job).filter(Job.id == job_id).first()
+        if not job:
+            result['message'] = f"Job {job_id} non trouvé"
+            return result
+
+        # Une tentative reprise par le reaper a pu finir entre-temps, ou le job être annulé en attente
+        if job.status in ("completed", "cancelled"):
+            result['message'] = f"Job {job_id} déjà terminé"
+            return result
+
+        agent = db.query(Agent).filter(Agent.id == job.agent_id).first()
+        if not agent:
+            result['message'] = f"Agent {job.agent_id} non trouvé"
+            return result
+
+        config = json.loads(job.config) if job.config else {}
+        snapshot = db.query(Snapshot).filter(Snapshot.id == config.get('snapshot_id')).first()
+        if not snapshot or snapshot.job.agent_id != agent.id:
+            return _fail_job(db, job, f"Snapshot {config.get('snapshot_id')} non trouvé", result)
+
+        # Lecture seule, partagée avec les autres restaurations: seuls les jobs d'écriture
+        # (sauvegarde, prune, vérification, réplication) attendent la fin de l'extraction.
+        # L'inscription expire avec le bail si le worker disparaît
+        repo_lease = read_repository(snapshot.repo_path, f"job:{job.id}", timeout=JOB_LEASE_TTL)
+        if not repo_lease:
+            enqueue_restore_job(job_id, delay=timedelta(seconds=REPO_LOCK_RETRY_DELAY))
+            result['message'] = f"Repository occupé, job {job_id} replanifié"
+            return result
+
+        # Sous bail renouvelé par le heartbeat, comme les sauvegardes: le reaper reprend le job
+        # si le worker meurt
+        job.status = "running"
+        job.started_at = datetime.utcnow()
+        job.snapshot_id = snapshot.id
+        job.progress = 0
+        job.attempts = (job.attempts or 0) + 1
+        job.worker_id = worker_identity()
+        job.lease_expires_at = datetime.utcnow() + timedelta(seconds=JOB_LEASE_TTL)
+        db.commit()
+
+        heartbeat = JobHeartbeat(job.id)
+        heartbeat.watch(repo_lease)
+        heartbeat.start()
+
+        watcher = InterruptWatcher(job.id)
+        watcher.start()
+
+        repo = resolve_repository(db, agent)
+        borg = BorgManager(snapshot.repo_path, repo['passphrase'])
+        parallelism = max(int(config.get('parallelism', 4)), 1)
+
+        # Le catalogue donne tailles et nombres d'entrées pour découper le travail
+        listing = ensure_listing(snapshot.id, lambda: borg.iter_archive_items(snapshot.name))
+        units = expand_restore_units(listing, config.get('paths') or [], parallelism)
+        if not units:
+            return _fail_job(db, job, "Aucun chemin demandé n'existe dans le snapshot", result)
+        buckets = split_restore_units(units, parallelism)
+
+        if config.get('mode') == 'agent_pull':
+            staging = restore_staging_dir(job.id)
+            os.makedirs(staging, exist_ok=True)
+            parts = [f"part-{i}.tar" for i in range(len(buckets))]
+            for part, bucket in zip(parts, buckets):
+                processes.append(borg.start_export_tar(
+                    snapshot.name, [p for p in bucket['paths'] if p], os.path.join(staging, part)
+                ))
+        else:
+            try:
+                target_dir = restore_target_dir(agent.id, config.get('target_dir'))
+            except ValueError as e:
+                return _fail_job(db, job, f"Répertoire cible refusé: {e}", result)
+            os.makedirs(target_dir, exist_ok=True)
+            parts = []
+            for bucket in buckets:
+                processes.append(borg.start_extract(
+                    snapshot.name, [p for p in bucket['paths'] if p], target_dir
+                ))
+
+        expected = sum(b['files'] for b in buckets)
+
+        def on_progress(done: int, finished: int):
+            if expected:
+                job.progress = min(99, done * 100 // expected)
+            else:
+                job.progress = finished * 100 // len(processes)
+            db.commit()
+
+        errors = run_parallel(processes, on_progress, interrupt=watcher.event)
+        if watcher.reason == 'cancel':
+            if staging:
+                shutil.rmtree(staging, ignore_errors=True)
+            return cancel_job(db, job, result)
+        if errors:
+            if staging:
+                shutil.rmtree(staging, ignore_errors=True)
+            return _fail_job(db, job, "\n".join(errors), result)
+
+        config['parts'] = parts
+        job.config = json.dumps(config)
+        job.progress = 100
+        job.status = "completed"
+        job.finished_at = datetime.utcnow()
+        db.commit()
+
+        result['success'] = True
+        result['message'] = f"Restauration réussie: {len(processes)} flux parallèle(s)"
+        result['streams'] = len(processes)
+
+    except Exception as e:
+        if 'job' in locals() and job:
+            _fail_job(db, job, str(e), result)
+        result['message'] = f"Erreur lors du traitement du job: {str(e)}"
+
+    finally:
+        if heartbeat:
+            heartbeat.stop()
+        if watcher:
+            watcher.stop()
+            clear_interrupt(job_id)
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+        if repo_lease:
+            repo_lease.release()
+        db.close()
+
+    return result
+
+def enqueue_restore_job(job_id: int, delay: Optional[timedelta] = None) -> str:
+    """Ajoute un job de restauration à la queue (après `delay` pour une nouvelle tentative)"""
+    if delay:
+        job = queue.enqueue_in(delay, process_restore_job, job_id, job_timeout=RESTORE_JOB_TIMEOUT)
+    else:
+        job = queue.enqueue(
+            process_restore_job,
+            job_id,
+            job_timeout=RESTORE_JOB_TIMEOUT
+        )
+    return job.id
+
+def cleanup_restore_staging() -> int:
+    """Supprime les archives de restauration préparées et expirées"""
+    if not os.path.isdir(RESTORE_STAGING_ROOT):
+        return 0
+
+    expiry = time.time() - RESTORE_STAGING_TTL.total_seconds()
+    removed = 0
+    for name in os.listdir(RESTORE_STAGING_ROOT):
+        path = os.path.join(RESTORE_STAGING_ROOT, name)
+        if os.path.isdir(path) and os.path.getmtime(path) < expiry:
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+
+    return removed
@@ -0,0 +1,292 @@
+"""
+Moteur de rétention SaveOS - applique Tenant.retention_policy via borg prune/compact
+"""
+import os
+import json
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional
+
+from api.database import Job, Snapshot, Agent, Tenant
+from worker.tasks import (
+    BorgManager, SessionLocal, low_queue, resolve_repository, adjust_tenant_usage, cancel_job
+)
+from worker.cancellation import InterruptWatcher, clear_interrupt
+from worker.slots import SlotPool, storage_volume
+from worker.catalog import delete_catalog
+from worker.diffs import delete_cached_diffs
+from worker.object_store import checkout_repository, REPO_LOCK_RETRY_DELAY
+
+# Fenêtre creuse (UTC) pendant laquelle les prunes sont autorisés, ex: "22:00-04:00"
+PRUNE_WINDOW = os.getenv("PRUNE_WINDOW", "01:00-05:00")
+# Nombre maximum de prunes simultanés sur un même volume de stockage
+PRUNE_MAX_PER_VOLUME = int(os.getenv("PRUNE_MAX_PER_VOLUME", "1"))
+# Taille des lots pour la suppression des snapshots en base
+PRUNE_BATCH_SIZE = int(os.getenv("PRUNE_BATCH_SIZE", "500"))
+# Délai avant une nouvelle tentative quand le volume est saturé
+PRUNE_RETRY_DELAY = timedelta(minutes=5)
+
+RETENTION_PERIODS = ('hourly', 'daily', 'weekly', 'monthly', 'yearly')
+
+def parse_retention_policy(policy: Optional[str]) -> Dict[str, int]:
+    """Convertit la politique JSON d'un tenant en options --keep-* pour borg prune"""
+    keep = {}
+    if not policy:
+        return keep
+
+    try:
+        data = json.loads(policy)
+    except (TypeError, ValueError):
+        return keep
+
+    for period in RETENTION_PERIODS:
+        try:
+            count = int(data.get(period, 0))
+        except (TypeError, ValueError):
+            continue
+        if count > 0:
+            keep[period] = count
+
+    return keep
+
+def _parse_window(window: str):
+    """Parse une fenêtre "HH:MM-HH:MM" en couple (début, fin)"""
+    start, end = window.split('-')
+    return (
+        datetime.strptime(start.strip(), "%H:%M").time(),
+        datetime.strptime(end.strip(), "%H:%M").time()
+    )
+
+def in_off_peak(now: datetime, window: str = PRUNE_WINDOW) -> bool:
+    """Indique si un instant est dans la fenêtre creuse (qui peut passer minuit)"""
+    start, end = _parse_window(window)
+    current = now.time()
+    if start <= end:
+        return start <= current < end
+    return current >= start or current < end
+
+def next_off_peak(now: datetime, window: str = PRUNE_WINDOW) -> datetime:
+    """Retourne le premier instant >= now situé dans la fenêtre creuse"""
+    if in_off_peak(now, window):
+        return now
+
+    start, _ = _parse_window(window)
+    candidate = datetime.combine(now.date(), start)
+    if candidate <= now:
+        candidate += timedelta(days=1)
+    return candidate
+
+def delete_snapshot_rows(db, repo_path: str, archive_names: List[str],
+                         batch_size: int = PRUNE_BATCH_SIZE) -> int:
+    """Supprime les snapshots d'archives purgées par lots d'instructions DELETE"""
+    deleted = 0
+    names = sorted(archive_names)
+
+    for i in range(0, len(names), batch_size):
+        batch = names[i:i + batch_size]
+        snapshot_ids = [snapshot_id for (snapshot_id,) in db.query(Snapshot.id).filter(
+            Snapshot.repo_path == repo_path,
+            Snapshot.name.in_(batch)
+        ).all()]
+        if not snapshot_ids:
+            continue
+
+        # Détacher les jobs qui référencent encore ces snapshots
+        db.query(Job).filter(Job.snapshot_id.in_(snapshot_ids)).update(
+            {Job.snapshot_id: None}, synchronize_session=False
+        )
+        deleted += db.query(Snapshot).filter(
+            Snapshot.id.in_(snapshot_ids)
+        ).delete(synchronize_session=False)
+        db.commit()
+
+        for snapshot_id in snapshot_ids:
+            delete_catalog(snapshot_id)
+            delete_cached_diffs(snapshot_id)
+
+    return deleted
+
+def _fail_job(db, job: Job, message: str, result: Dict[str, Any]) -> Dict[str, Any]:
+    """Marque un job comme échoué"""
+    job.status = "failed"
+    job.error_message = message
+    job.finished_at = datetime.utcnow()
+    db.commit()
+    result['message'] = message
+    return result
+
+def process_prune_job(job_id: int) -> Dict[str, Any]:
+    """Traite un job de rétention: prune + compact puis mise à jour de la base"""
+
+    db = SessionLocal()
+    result = {'success': False, 'message': ''}
+    slots = None
+    token = None
+    repo_lease = None
+    watcher = None
+
+    try:
+        job = db.query(Job).filter(Job.id == job_id).first()
+        if not job:
+            result['message'] = f"Job {job_id} non trouvé"
+            return result
+
+        if job.status == "cancelled":
+            result['message'] = f"Job {job_id} annulé"
+            return result
+
+        agent = db.query(Agent).filter(Agent.id == job.agent_id).first()
+        if not agent:
+            result['message'] = f"Agent {job.agent_id} non trouvé"
+            return result
+
+        tenant = db.query(Tenant).filter(Tenant.id == agent.tenant_id).first()
+        keep = parse_retention_policy(tenant.retention_policy if tenant else None)
+        if not keep:
+            return _fail_job(db, job, "Politique de rétention vide ou invalide", result)
+
+        repo = resolve_repository(db, agent)
+        repo_path = repo['repo_path']
+
+        # Limiter la charge par volume: si saturé, on repasse plus tard en heures creuses
+        slots = SlotPool(f"prune:{storage_volume(repo_path)}", PRUNE_MAX_PER_VOLUME)
+        token = slots.acquire()
+        if not token:
+            enqueue_prune_job(job_id, at=next_off_peak(datetime.utcnow() + PRUNE_RETRY_DELAY))
+            result['message'] = f"Volume saturé, job {job_id} replanifié"
+            return result
+
+        watcher = InterruptWatcher(job.id)
+        watcher.start()
+        repo_lease = checkout_repository(repo_path, interrupt=watcher.event)
+        if watcher.reason == 'cancel':
+            return cancel_job(db, job, result)
+        if not repo_lease:
+            enqueue_prune_job(job_id, at=next_off_peak(datetime.utcnow() + timedelta(seconds=REPO_LOCK_RETRY_DELAY)))
+            result['message'] = f"Repository occupé, job {job_id} replanifié"
+            return result
+
+        job.status = "running"
+        job.started_at = datetime.utcnow()
+        db.commit()
+
+        if not os.path.exists(repo_path):
+            job.status = "completed"
+            job.finished_at = datetime.utcnow()
+            db.commit()
+            result['success'] = True
+            result['message'] = f"Aucun repository pour {agent.hostname}"
+            return result
+
+        borg = BorgManager(repo_path, repo['passphrase'])
+
+        archives_before = borg.list_archives(use_cache=False)
+        if not archives_before['success']:
+            return _fail_job(db, job, archives_before.get('stderr', archives_before.get('error')), result)
+        info_before = borg.repo_info(use_cache=False)
+
+        # Un prune interrompu est annulé par borg (transaction non validée)
+        prune_result = borg.prune(keep, interrupt=watcher.event)
+        if not prune_result['success'] and watcher.reason == 'cancel':
+            return cancel_job(db, job, result)
+        if not prune_result['success']:
+            return _fail_job(db, job, prune_result.get('stderr', prune_result.get('error')), result)
+
+        # Les archives sont déjà purgées: un compact interrompu reprendra au prochain passage,
+        # la base est mise à jour avant de marquer le job annulé
+        compact_result = borg.compact(interrupt=watcher.event)
+        if not compact_result['success'] and watcher.reason != 'cancel':
+            return _fail_job(db, job, compact_result.get('stderr', compact_result.get('error')), result)
+
+        # Le bucket doit refléter la purge avant que la base ne l'enregistre
+        if repo_lease:
+            result['sync'] = repo_lease.push()
+
+        archives_after = borg.list_archives()
+        if not archives_after['success']:
+            return _fail_job(db, job, archives_after.get('stderr', archives_after.get('error')), result)
+        info_after = borg.repo_info()
+
+        # Les archives purgées sont celles qui ont disparu du repository
+        kept = {a['name'] for a in archives_after['archives']}
+        pruned = [a['name'] for a in archives_before['archives'] if a['name'] not in kept]
+        deleted_rows = delete_snapshot_rows(db, repo_path, pruned)
+
+        # Comptabilité incrémentale: on applique l'écart d'espace réellement occupé
+        freed_bytes = 0
+        if info_before['success'] and info_after['success']:
+            freed_bytes = (info_before['stats'].get('unique_csize', 0)
+                           - info_after['stats'].get('unique_csize', 0))
+            adjust_tenant_usage(db, agent.tenant_id, -freed_bytes)
+
+        result['pruned_archives'] = len(pruned)
+        result['deleted_snapshots'] = deleted_rows
+        result['freed_bytes'] = freed_bytes
+        if watcher.reason == 'cancel':
+            return cancel_job(db, job, result)
+
+        job.status = "completed"
+        job.finished_at = datetime.utcnow()
+        db.commit()
+
+        result['success'] = True
+        result['message'] = f"Rétention appliquée: {len(pruned)} archive(s) purgée(s)"
+
+    except Exception as e:
+        if 'job' in locals() and job:
+            _fail_job(db, job, str(e), result)
+        result['message'] = f"Erreur lors du traitement du job: {str(e)}"
+
+    finally:
+        if watcher:
+            watcher.stop()
+            clear_interrupt(job_id)
+        if repo_lease:
+            repo_lease.release()
+        if token:
+            slots.release(token)
+        db.close()
+
+    return result
+
+def enqueue_prune_job(job_id: int, at: Optional[datetime] = None) -> str:
+    """Planifie un job de rétention dans la file basse priorité, en heures creuses"""
+    job = low_queue.enqueue_at(
+        at or next_off_peak(datetime.utcnow()),
+        process_prune_job,
+        job_id,
+        job_timeout='6h'
+    )
+    return job.id
+
+def schedule_prune_jobs() -> int:
+    """Crée un job de rétention pour chaque agent ayant des snapshots"""
+    db = SessionLocal()
+    scheduled = 0
+
+    try:
+        agents = db.query(Agent).filter(
+            db.query(Snapshot.id).join(Job, Snapshot.job_id == Job.id)
+            .filter(Job.agent_id == Agent.id).exists()
+        ).all()
+
+        for agent in agents:
+            # Ne pas empiler de prune si un autre est déjà en attente
+            pending = db.query(Job.id).filter(
+                Job.agent_id == agent.id,
+                Job.type == "prune",
+                Job.status.in_(["pending", "running"])
+            ).first()
+            if pending:
+                continue
+
+            job = Job(agent_id=agent.id, type="prune", status="pending")
+            db.add(job)
+            db.commit()
+            db.refresh(job)
+
+            enqueue_prune_job(job.id)
+            scheduled += 1
+    finally:
+        db.close()
+
+    return scheduled
@@ -0,0 +1,50 @@
+"""
+Planificateur des tâches périodiques du worker SaveOS
+"""
+import os
+import time
+from typing import Callable, List, Tuple
+
+from worker.tasks import redis_conn
+from worker.retention import schedule_prune_jobs
+from worker.quota import schedule_quota_reconciliation
+from worker.restore import cleanup_restore_staging
+from worker.verification import schedule_check_jobs
+from worker.compression import schedule_compression_advice
+from worker.reconcile import schedule_snapshot_reconciliation
+from worker.reaper import reap_expired_jobs
+
+# Fréquence de réveil du planificateur
+SCHEDULER_TICK = int(os.getenv("SCHEDULER_TICK", "60"))
+
+# (nom, intervalle en secondes, fonction) - chaque tâche s'exécute une fois par intervalle
+PERIODIC_TASKS: List[Tuple[str, int, Callable[[], int]]] = [
+    ('prune', int(os.getenv("PRUNE_SCHEDULE_INTERVAL", "86400")), schedule_prune_jobs),
+    ('quota', int(os.getenv("QUOTA_RECONCILE_INTERVAL", "21600")), schedule_quota_reconciliation),
+    ('restore_cleanup', 3600, cleanup_restore_staging),
+    ('check', int(os.getenv("CHECK_SCHEDULE_INTERVAL", "3600")), schedule_check_jobs),
+    ('compression', int(os.getenv("COMPRESSION_SCHEDULE_INTERVAL", "86400")), schedule_compression_advice),
+    ('reconcile', int(os.getenv("RECONCILE_INTERVAL", "21600")), schedule_snapshot_reconciliation),
+    ('reaper', int(os.getenv("JOB_REAPER_INTERVAL", "60")), reap_expired_jobs),
+]
+
+def run_pending():
+    """Exécute les tâches périodiques dues (une seule instance par intervalle, même à plusieurs)"""
+    for name, interval, func in PERIODIC_TASKS:
+        # SET NX EX sert de verrou: seul le premier planificateur de l'intervalle s'exécute
+        if redis_conn.set(f"saveos:periodic:{name}", int(time.time()), nx=True, ex=interval):
+            try:
+                count = func()
+                print(f"Tâche périodique {name}: {count} job(s) planifié(s)")
+            except Exception as e:
+                print(f"Erreur lors de la tâche périodique {name}: {e}")
+
+def start_scheduler():
+    """Démarre la boucle du planificateur"""
+    print("Planificateur SaveOS démarré")
+    while True:
+        run_pending()
+        time.sleep(SCHEDULER_TICK)
+
+if __name__ == '__main__':
+    start_scheduler()
@@ -0,0 +1,58 @@
+"""
+Pools de slots partagés entre workers SaveOS (sémaphores Redis)
+"""
+import os
+import time
+import uuid
+from typing import Optional
+
+from worker.tasks import redis_conn
+
+# Les slots expirent d'eux-mêmes si un worker meurt sans les libérer
+DEFAULT_SLOT_TTL = 6 * 3600
+
+# Purge des slots expirés puis réservation atomique si la limite n'est pas atteinte
+_ACQUIRE_SCRIPT = redis_conn.register_script("""
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[3]) then
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[4])
+    return 1
+end
+return 0
+""")
+
+class SlotPool:
+    """Sémaphore à compteur stocké dans un sorted set Redis (score = expiration)"""
+
+    def __init__(self, name: str, limit: int, ttl: int = DEFAULT_SLOT_TTL):
+        self.key = f"saveos:slots:{name}"
+        self.limit = limit
+        self.ttl = ttl
+
+    def acquire(self) -> Optional[str]:
+        """Réserve un slot et retourne son jeton, ou None si le pool est plein"""
+        token = uuid.uuid4().hex
+        now = time.time()
+        acquired = _ACQUIRE_SCRIPT(
+            keys=[self.key],
+            args=[now, now + self.ttl, self.limit, token]
+        )
+        return token if acquired else None
+
+    def release(self, token: str):
+        """Libère un slot précédemment réservé"""
+        redis_conn.zrem(self.key, token)
+
+    def in_use(self) -> int:
+        """Nombre de slots actuellement occupés"""
+        redis_conn.zremrangebyscore(self.key, '-inf', time.time())
+        return redis_conn.zcard(self.key)
+
+def storage_volume(path: str) -> str:
+    """Retourne le point de montage qui héberge un chemin (même s'il n'existe pas encore)"""
+    current = os.path.realpath(path)
+    while not os.path.exists(current):
+        current = os.path.dirname(current)
+    while not os.path.ismount(current):
+        current = os.path.dirname(current)
+    return current
@@ -0,0 +1,239 @@
+"""
+Vérification tournante des repositories SaveOS (borg check partiel et borné dans le temps)
+
+Chaque job vérifie une tranche du repository (--max-duration), borg reprenant
+au segment suivant lors du passage suivant. Le planificateur fait tourner les
+vérifications pour que chaque repository soit entièrement vérifié sur la période.
+"""
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Any, Optional
+
+from api.database import Job, Snapshot, Agent, RepoVerification
+from worker.tasks import BorgManager, SessionLocal, low_queue, resolve_repository, cancel_job, preempt_job
+from worker.cancellation import InterruptWatcher, clear_interrupt
+from worker.slots import SlotPool, storage_volume
+from worker.object_store import checkout_repository, REPO_LOCK_RETRY_DELAY
+
+# Période sur laquelle chaque repository doit être entièrement vérifié
+CHECK_PERIOD = timedelta(days=int(os.getenv("CHECK_PERIOD_DAYS", "7")))
+# Durée maximale d'un passage de vérification (secondes)
+CHECK_MAX_DURATION = int(os.getenv("CHECK_MAX_DURATION", "3600"))
+# Nombre de vérifications lancées par passage du planificateur
+CHECK_MAX_PER_TICK = int(os.getenv("CHECK_MAX_PER_TICK", "4"))
+# Nombre maximum de vérifications simultanées sur un même volume
+CHECK_MAX_PER_VOLUME = int(os.getenv("CHECK_MAX_PER_VOLUME", "1"))
+# Délai avant une nouvelle tentative quand le volume est saturé
+CHECK_RETRY_DELAY = timedelta(minutes=10)
+
+def get_verification_state(db, agent: Agent, repo_path: str) -> RepoVerification:
+    """Retourne (en le créant au besoin) l'état de vérification d'un repository"""
+    state = db.query(RepoVerification).filter(RepoVerification.repo_path == repo_path).first()
+    if not state:
+        state = RepoVerification(
+            agent_id=agent.id,
+            repo_path=repo_path,
+            position=0.0,
+            cycle_started_at=datetime.utcnow()
+        )
+        db.add(state)
+        db.commit()
+        db.refresh(state)
+    return state
+
+def verification_lag(state: RepoVerification, now: datetime, period: timedelta = CHECK_PERIOD) -> float:
+    """Retard de vérification: part du repository qui devrait déjà être vérifiée mais ne l'est pas"""
+    elapsed = (now - (state.cycle_started_at or now)).total_seconds()
+    required = min(elapsed / period.total_seconds(), 1.0)
+    return required - (state.position or 0.0)
+
+def record_check_progress(state: RepoVerification, position: float, elapsed_seconds: float,
+                          repo_bytes: int, now: datetime):
+    """Met à jour la couverture et le débit après un passage de vérification"""
+    previous = state.position or 0.0
+    checked = max(position - previous, 0.0)
+    if elapsed_seconds > 0 and repo_bytes:
+        state.throughput_bytes = checked * repo_bytes / elapsed_seconds
+
+    state.last_check_at = now
+    if position >= 1.0:
+        # Cycle terminé: le repository a été entièrement vérifié
+        state.last_full_verified_at = now
+        state.cycle_started_at = now
+        state.position = 0.0
+    else:
+        state.position = position
+
+def _fail_job(db, job: Job, message: str, result: Dict[str, Any]) -> Dict[str, Any]:
+    """Marque un job comme échoué"""
+    job.status = "failed"
+    job.error_message = message
+    job.finished_at = datetime.utcnow()
+    db.commit()
+    result['message'] = message
+    return result
+
+def process_check_job(job_id: int) -> Dict[str, Any]:
+    """Traite un job de vérification partielle d'un repository"""
+
+    db = SessionLocal()
+    result = {'success': False, 'message': ''}
+    slots = None
+    token = None
+    repo_lease = None
+    watcher = None
+
+    try:
+        job = db.query(Job).filter(Job.id == job_id).first()
+        if not job:
+            result['message'] = f"Job {job_id} non trouvé"
+            return result
+
+        if job.status == "cancelled":
+            result['message'] = f"Job {job_id} annulé"
+            return result
+
+        agent = db.query(Agent).filter(Agent.id == job.agent_id).first()
+        if not agent:
+            result['message'] = f"Agent {job.agent_id} non trouvé"
+            return result
+
+        repo = resolve_repository(db, agent)
+        repo_path = repo['repo_path']
+
+        slots = SlotPool(f"check:{storage_volume(repo_path)}", CHECK_MAX_PER_VOLUME)
+        token = slots.acquire()
+        if not token:
+            enqueue_check_job(job_id, delay=CHECK_RETRY_DELAY)
+            result['message'] = f"Volume saturé, job {job_id} replanifié"
+            return result
+
+        watcher = InterruptWatcher(job.id)
+        watcher.start()
+        repo_lease = checkout_repository(repo_path, interrupt=watcher.event)
+        if watcher.reason == 'cancel':
+            return cancel_job(db, job, result)
+        if watcher.reason == 'preempt':
+            preempt_job(db, job, result)
+            enqueue_check_job(job_id)
+            return result
+        if not repo_lease:
+            enqueue_check_job(job_id, delay=timedelta(seconds=REPO_LOCK_RETRY_DELAY))
+            result['message'] = f"Repository occupé, job {job_id} replanifié"
+            return result
+        if not os.path.exists(repo_path):
+            return _fail_job(db, job, f"Repository {repo_path} introuvable", result)
+
+        job.status = "running"
+        job.started_at = datetime.utcnow()
+        db.commit()
+
+        borg = BorgManager(repo_path, repo['passphrase'])
+        state = get_verification_state(db, agent, repo_path)
+        info = borg.repo_info()
+
+        started = datetime.utcnow()
+        check_result = borg.check(CHECK_MAX_DURATION, interrupt=watcher.event)
+        finished = datetime.utcnow()
+
+        # borg mémorise la position de reprise dans le repository lui-même
+        if repo_lease:
+            repo_lease.push()
+
+        if not check_result['success'] and watcher.reason == 'cancel':
+            return cancel_job(db, job, result)
+        if not check_result['success'] and watcher.reason == 'preempt':
+            preempt_job(db, job, result)
+            enqueue_check_job(job_id)
+            return result
+        if not check_result['success']:
+            # Erreur d'intégrité ou d'exécution: visible dans le job, position inchangée
+            return _fail_job(db, job, check_result.get('stderr', check_result.get('error')), result)
+
+        position = check_result['position']
+        if position is None:
+            position = 1.0  # Repository vide ou vérifié d'une traite
+        record_check_progress(
+            state,
+            position,
+            (finished - started).total_seconds(),
+            info['stats'].get('unique_csize', 0) if info['success'] else 0,
+            finished
+        )
+
+        job.status = "completed"
+        job.finished_at = finished
+        db.commit()
+
+        result['success'] = True
+        result['message'] = f"Vérification de {repo_path}: {position:.0%} du cycle"
+        result['position'] = position
+
+    except Exception as e:
+        if 'job' in locals() and job:
+            _fail_job(db, job, str(e), result)
+        result['message'] = f"Erreur lors du traitement du job: {str(e)}"
+
+    finally:
+        if watcher:
+            watcher.stop()
+            clear_interrupt(job_id)
+        if repo_lease:
+            repo_lease.release()
+        if token:
+            slots.release(token)
+        db.close()
+
+    return result
+
+def enqueue_check_job(job_id: int, delay: Optional[timedelta] = None) -> str:
+    """Ajoute un job de vérification à la file basse priorité"""
+    # Marge au-delà de --max-duration pour le démarrage de borg et l'écriture de l'index
+    job_timeout = CHECK_MAX_DURATION + 900
+    if delay:
+        job = low_queue.enqueue_in(delay, process_check_job, job_id, job_timeout=job_timeout)
+    else:
+        job = low_queue.enqueue(process_check_job, job_id, job_timeout=job_timeout)
+    return job.id
+
+def schedule_check_jobs() -> int:
+    """Lance les vérifications des repositories les plus en retard sur leur cycle"""
+    db = SessionLocal()
+    now = datetime.utcnow()
+    scheduled = 0
+
+    try:
+        agents = db.query(Agent).filter(
+            db.query(Snapshot.id).join(Job, Snapshot.job_id == Job.id)
+            .filter(Job.agent_id == Agent.id).exists()
+        ).all()
+
+        candidates = []
+        for agent in agents:
+            pending = db.query(Job.id).filter(
+                Job.agent_id == agent.id,
+                Job.type == "check",
+                Job.status.in_(["pending", "running"])
+            ).first()
+            if pending:
+                continue
+
+            repo = resolve_repository(db, agent)
+            state = get_verification_state(db, agent, repo['repo_path'])
+            lag = verification_lag(state, now)
+            if lag > 0:
+                candidates.append((lag, agent))
+
+        candidates.sort(key=lambda c: c[0], reverse=True)
+        for _, agent in candidates[:CHECK_MAX_PER_TICK]:
+            job = Job(agent_id=agent.id, type="check", status="pending")
+            db.add(job)
+            db.commit()
+            db.refresh(job)
+
+            enqueue_check_job(job.id)
+            scheduled += 1
+    finally:
+        db.close()
+
+    return scheduled